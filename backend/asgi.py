@@ -0,0 +1,7 @@
+"""
+ASGI entry point: ``uvicorn asgi:app``.
+"""
+from flaskr import create_app
+from flaskr.aio import create_asgi_app
+
+app = create_asgi_app(create_app())
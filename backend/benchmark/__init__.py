@@ -0,0 +1,10 @@
+"""
+Load benchmark for the trivia API.
+
+Builds a synthetic dataset of the requested size in a local SQLite or
+Postgres database, drives each endpoint through the Flask test client
+and writes throughput, latency percentiles, queries and rows fetched
+per request to a JSON report that can be diffed between commits::
+
+    python -m benchmark --database sqlite:////tmp/bench.db --dataset 10k
+"""
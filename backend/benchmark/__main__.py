@@ -0,0 +1,54 @@
+import argparse
+import json
+import sys
+
+from . import datasets, runner
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmark',
+        description='Benchmark the trivia API against a synthetic dataset.')
+    parser.add_argument('--database', required=True,
+                        help='SQLAlchemy URL of a local SQLite or Postgres '
+                             'database; its tables are overwritten')
+    parser.add_argument('--dataset', choices=sorted(datasets.DATASETS),
+                        default='10k')
+    parser.add_argument('--questions', type=int,
+                        help='override the number of questions')
+    parser.add_argument('--leaderboard', type=int,
+                        help='override the number of leaderboard entries')
+    parser.add_argument('--requests', type=int, default=runner.REQUESTS)
+    parser.add_argument('--warmup', type=int, default=runner.WARMUP)
+    parser.add_argument('--quiz-history', type=int,
+                        default=runner.QUIZ_HISTORY,
+                        help='length of previous_questions in quiz requests')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fresh', action='store_true',
+                        help='recreate the tables before loading')
+    parser.add_argument('--question-bands', action='store_true',
+                        help='store the near-duplicate buckets of loaded '
+                             'questions, as imports through the API do')
+    parser.add_argument('--scenario', action='append', dest='only',
+                        help='run only this scenario (repeatable)')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args(argv)
+
+    report = runner.run(
+        args.database, args.dataset, args.questions, args.leaderboard,
+        args.requests, args.warmup, args.quiz_history, args.seed,
+        args.fresh, args.only, bands=args.question_bands)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+    for name, result in report['results'].items():
+        latency = result['latency_ms']
+        print(f"{name:30} {result['throughput_rps']:>9} req/s  "
+              f"p50 {latency['p50']:>8} ms  p95 {latency['p95']:>8} ms  "
+              f"p99 {latency['p99']:>8} ms")
+    print(f'report written to {args.output}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+Synthetic datasets.
+
+Rows are generated from a seeded random source, so the same dataset name
+and seed always produce the same table contents. Questions are written
+through ``BulkImport`` (COPY on Postgres) and leaderboard entries with
+multi-row inserts, a batch per transaction, after which the leaderboard
+rollups are rebuilt. The near-duplicate buckets of the questions are only
+stored when asked for, as hashing them dominates the load time of the
+large datasets.
+"""
+import random
+
+from models import (db, rebuild_rollups, Question, QuestionBand,
+                    QuestionCount, Category, Leaderboard)
+from flaskr.bulk import BulkImport
+
+# dataset name: (questions, leaderboard entries)
+DATASETS = {
+    '10k': (10000, 10000),
+    '1m': (1000000, 100000),
+    '10m': (10000000, 1000000),
+}
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment',
+              'Sports']
+
+# search terms are drawn from the same words the questions are made of
+VOCABULARY = [
+    'ancient', 'river', 'planet', 'painter', 'empire', 'mountain', 'novel',
+    'capital', 'element', 'league', 'island', 'symphony', 'desert', 'treaty',
+    'galaxy', 'sculptor', 'volcano', 'dynasty', 'champion', 'film',
+    'ocean', 'poet', 'molecule', 'kingdom', 'stadium', 'glacier', 'opera',
+    'inventor', 'forest', 'orbit', 'festival', 'bridge',
+]
+
+BATCH_SIZE = 5000
+
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def _questions(rng, count):
+    for number in range(1, count + 1):
+        yield number, {
+            'question': f'Which {_sentence(rng, 6)}?',
+            'answer': _sentence(rng, 2),
+            'difficulty': rng.randint(1, 5),
+            'category': rng.randint(1, len(CATEGORIES)),
+        }
+
+
+def _leaderboard(rng, count):
+    for _ in range(count):
+        yield {'player': f'player{rng.randrange(count)}',
+               'score': rng.randint(0, 100)}
+
+
+def _insert(table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(table.insert().values(batch))
+            db.session.commit()
+            batch = []
+    if batch:
+        db.session.execute(table.insert().values(batch))
+        db.session.commit()
+
+
+def load(questions, leaderboard, seed=0, fresh=False, bands=False):
+    """
+    Fill the bound database with ``questions`` questions and
+    ``leaderboard`` entries, reusing the tables when they already hold
+    that many rows, and with ``bands`` the questions' near-duplicate
+    buckets. Returns the row counts and whether they were reused.
+    """
+    if fresh:
+        db.drop_all()
+        db.create_all()
+
+    if Category.query.count() < len(CATEGORIES):
+        Category.query.delete()
+        _insert(Category.__table__, [
+            {'id': number, 'type': name}
+            for number, name in enumerate(CATEGORIES, 1)])
+
+    rng = random.Random(seed)
+    reused = Question.query.count() == questions and \
+        Leaderboard.query.count() == leaderboard
+    if not reused:
+        Question.query.delete()
+        # ids restart at 1 on SQLite, and the bulk import leaves rows
+        # that already have buckets alone
+        QuestionBand.query.delete()
+        QuestionCount.query.delete()
+        Leaderboard.query.delete()
+        db.session.commit()
+        BulkImport(BATCH_SIZE, bands=bands).run(_questions(rng, questions))
+        _insert(Leaderboard.__table__, _leaderboard(rng, leaderboard))
+        with db.engine.begin() as connection:
+            rebuild_rollups(connection)
+
+    return {'questions': questions, 'leaderboard': leaderboard,
+            'reused': reused}
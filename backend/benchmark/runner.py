@@ -0,0 +1,201 @@
+"""
+Scenario runner.
+
+Each scenario is one kind of request, sent ``requests`` times in a row
+through the Flask test client after ``warmup`` unmeasured requests, so
+the numbers include routing, caching, encoding and the database but not
+the network. SQL statements are counted from the engine events; rows
+fetched come from the driver's row count, which SQLite does not report
+for queries, so it is null there.
+"""
+import math
+import platform
+import random
+import subprocess
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from flaskr import create_app
+from flaskr.pagination import QUESTIONS_PER_PAGE, encode_cursor
+from models import db, Question
+from . import datasets
+
+REQUESTS = 200
+WARMUP = 20
+QUIZ_HISTORY = 500
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of already sorted ``samples``."""
+    if not samples:
+        return None
+    rank = max(math.ceil(p / 100 * len(samples)), 1)
+    return samples[rank - 1]
+
+
+class QueryCounter:
+    """Statements executed and rows fetched since the last reset."""
+
+    def __init__(self):
+        self.reset()
+        event.listen(Engine, 'after_cursor_execute', self._executed)
+
+    def reset(self):
+        self.queries = 0
+        self.rows = 0
+
+    def _executed(self, conn, cursor, statement, parameters, context,
+                  executemany):
+        self.queries += 1
+        if cursor.description is not None:
+            if cursor.rowcount < 0 or self.rows is None:
+                self.rows = None
+            else:
+                self.rows += cursor.rowcount
+
+    def close(self):
+        event.remove(Engine, 'after_cursor_execute', self._executed)
+
+
+def _scenarios(sizes, rng, quiz_history):
+    questions, entries = sizes['questions'], sizes['leaderboard']
+    per_page = QUESTIONS_PER_PAGE
+    deep_page = max(math.ceil(questions / per_page) - 1, 1)
+    deep_board_page = max(math.ceil(entries / per_page) - 1, 1)
+    low, high = db.session.query(
+        db.func.min(Question.id), db.func.max(Question.id)).one()
+    low, high = low or 0, high or 0
+    deep_cursor = encode_cursor([max(high - 2 * per_page, low)])
+    history = rng.sample(range(low, high + 1),
+                         min(quiz_history, high - low + 1))
+    categories = len(datasets.CATEGORIES)
+
+    def category():
+        return rng.randint(1, categories)
+
+    return {
+        'questions_first_page': lambda client: client.get(
+            '/questions?page=1'),
+        'questions_deep_page': lambda client: client.get(
+            f'/questions?page={deep_page}'),
+        'questions_deep_cursor': lambda client: client.get(
+            f'/questions?cursor={deep_cursor}'),
+        'category_questions': lambda client: client.get(
+            f'/categories/{category()}/questions?page=1'),
+        'search': lambda client: client.post('/questions', json={
+            'searchTerm': rng.choice(datasets.VOCABULARY)}),
+        'suggest': lambda client: client.get(
+            '/questions/suggest',
+            query_string={'prefix': rng.choice(datasets.VOCABULARY)[:3]}),
+        'quiz_long_history': lambda client: client.post('/quizzes', json={
+            'previous_questions': history,
+            'quiz_category': {'id': 0}}),
+        'quiz_category_long_history': lambda client: client.post(
+            '/quizzes', json={
+                'previous_questions': history,
+                'quiz_category': {'id': category()}}),
+        'leaderboard_first_page': lambda client: client.get(
+            '/leaderboard?page=1'),
+        'leaderboard_deep_page': lambda client: client.get(
+            f'/leaderboard?page={deep_board_page}'),
+        'leaderboard_week': lambda client: client.get(
+            '/leaderboard?window=week'),
+        'leaderboard_write': lambda client: client.post(
+            '/leaderboard', json={'name': f'bench{rng.randrange(1000)}',
+                                  'score': rng.randint(0, 100)}),
+    }
+
+
+def _measure(client, send, counter, requests, warmup):
+    for _ in range(warmup):
+        send(client)
+
+    latencies, statuses = [], {}
+    queries = rows = size = 0
+    for _ in range(requests):
+        counter.reset()
+        started = time.perf_counter()
+        response = send(client)
+        body = response.get_data()
+        latencies.append(time.perf_counter() - started)
+        status = str(response.status_code)
+        statuses[status] = statuses.get(status, 0) + 1
+        queries += counter.queries
+        rows = None if rows is None or counter.rows is None \
+            else rows + counter.rows
+        size += len(body)
+
+    latencies.sort()
+    elapsed = sum(latencies)
+    result = {
+        'requests': requests,
+        'status_codes': statuses,
+        'throughput_rps': round(requests / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            f'p{p}': round(percentile(latencies, p) * 1000, 3)
+            for p in PERCENTILES},
+        'queries_per_request': round(queries / requests, 2),
+        'rows_fetched_per_request':
+            None if rows is None else round(rows / requests, 1),
+        'response_bytes': round(size / requests),
+    }
+    result['latency_ms']['mean'] = round(elapsed / requests * 1000, 3)
+    return result
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(database, dataset='10k', questions=None, leaderboard=None,
+        requests=REQUESTS, warmup=WARMUP, quiz_history=QUIZ_HISTORY,
+        seed=0, fresh=False, only=None, config=None, bands=False):
+    """
+    Load the dataset into ``database`` and benchmark every scenario, or
+    those named in ``only``. Returns the report as a dict.
+    """
+    default_questions, default_entries = datasets.DATASETS[dataset]
+    app = create_app(dict(config or {}, SQLALCHEMY_DATABASE_URI=database))
+    client = app.test_client()
+    rng = random.Random(seed)
+    counter = QueryCounter()
+    try:
+        with app.app_context():
+            sizes = datasets.load(
+                questions or default_questions,
+                leaderboard or default_entries, seed=seed, fresh=fresh,
+                bands=bands)
+            scenarios = _scenarios(sizes, rng, quiz_history)
+            dialect = db.engine.dialect.name
+
+        results = {}
+        for name, send in scenarios.items():
+            if only and name not in only:
+                continue
+            results[name] = _measure(client, send, counter, requests, warmup)
+    finally:
+        counter.close()
+
+    return {
+        'meta': {
+            'commit': _commit(),
+            'database': dialect,
+            'dataset': dataset,
+            'sizes': sizes,
+            'seed': seed,
+            'requests': requests,
+            'warmup': warmup,
+            'quiz_history': quiz_history,
+            'question_bands': bands,
+            'python': platform.python_version(),
+        },
+        'results': results,
+    }
@@ -1,30 +1,143 @@
+import atexit
 import os
-from flask import Flask, request, abort, jsonify
+from datetime import datetime
+from flask import Flask, Response, request, abort
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import desc
 from flask_cors import CORS
-import random
 
-from models import setup_db, Question, Category, Leaderboard
-
-QUESTIONS_PER_PAGE = 10
-
-
-def paginate_questions(request, selection):
-    page = request.args.get("page", 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
-
-    return current_questions
+from models import (db, setup_db, add_change_listener, read_from_replica,
+                    record_scores, database_path, Question, QuestionCount,
+                    Category, Leaderboard, ROLLUP_SPANS, ROLLUP_TOP_N)
+from .pagination import (QUESTIONS_PER_PAGE, encode_cursor, paginate_query,
+                         request_after)
+from .search import MODES, Search, search_index_command
+from .suggest import (DEPTH as SUGGEST_DEPTH, LIMIT as SUGGEST_LIMIT,
+                      MAX_LIMIT as SUGGEST_MAX_LIMIT, PrefixIndex)
+from .leaderboard import (REFRESH_INTERVAL, RankedLeaderboard,
+                          WindowedBoards, leaderboard_rollups_command)
+from .bulk import BATCH_SIZE as IMPORT_BATCH_SIZE, BulkImport, records
+from .batch import (MAX_IDS as BATCH_MAX_IDS, delete_questions,
+                    update_questions)
+from .encoding import (MIN_COMPRESS_SIZE, COMPRESS_LEVEL, FragmentCache,
+                       compress, jsonify, use_backend)
+from .cache import TableVersions, CategoryCache, conditional
+from .export import FORMATS as EXPORT_FORMATS, stream_export
+from .fields import columns, project, requested_fields, requested_includes
+from .errors import error_payload
+from .migrations import db_command
+from .counts import (category_counts, questions_version,
+                     reconcile_counts_command)
+from .duplicates import (POLICIES as DUPLICATE_POLICIES,
+                         POLICY as DUPLICATE_POLICY,
+                         THRESHOLD as DUPLICATE_THRESHOLD, DuplicateFinder,
+                         find_duplicates_command)
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Metrics
+from .admission import DEFAULT_LIMITS as ADMISSION_LIMITS, AdmissionControl
+from .validation import (parse_ids, parse_previous_questions,
+                         parse_question, parse_question_changes,
+                         parse_quiz_category, parse_score)
+from .writebehind import BATCH_SIZE, FLUSH_INTERVAL, WriteBehindBuffer
+from .quiz import (SESSION_TTL, MAX_SESSIONS, MAX_ROUND_SIZE, QuestionPool,
+                   QuizSessions)
+from .shared import SharedIdStore, SharedQuestionPool, database_directory
+
+# listings are ordered on these (column, descending) keys so that both
+# OFFSET pages and keyset cursors see a stable, total order
+QUESTION_KEYS = [(Question.id, False)]
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    setup_db(app, app.config.get("SQLALCHEMY_DATABASE_URI", database_path))
+
+    # installed first so its hooks time everything registered below
+    metrics = None
+    if app.config.get("METRICS_ENABLED", True):
+        metrics = Metrics(app.config.get("METRICS_SERVER_TIMING", False))
+        metrics.install(app)
+
+    # expensive routes are limited so their queues cannot starve the rest;
+    # installed after the metrics so shed requests are counted as 503s
+    admission = None
+    limits = app.config.get("ADMISSION_LIMITS", ADMISSION_LIMITS)
+    if limits:
+        admission = AdmissionControl(limits)
+        admission.install(app)
+
+    if app.config.get("JSON_BACKEND"):
+        use_backend(app.config["JSON_BACKEND"])
+    fragments = FragmentCache()
+    add_change_listener(app, fragments.on_change)
+    versions = TableVersions(app.config.get("ETAG_WINDOW"))
+    add_change_listener(app, versions.on_change)
+    categories_cache = CategoryCache(versions)
+    # with a shared directory every worker process reads the same id
+    # arrays instead of keeping its own pool
+    shared_dir = app.config.get(
+        "SHARED_POOL_DIR", os.getenv("SHARED_POOL_DIR"))
+    shared = None
+    if shared_dir:
+        pool = shared = SharedQuestionPool(SharedIdStore(database_directory(
+            shared_dir, app.config["SQLALCHEMY_DATABASE_URI"])))
+    else:
+        pool = QuestionPool()
+    add_change_listener(app, pool.on_change)
+    sessions = QuizSessions(
+        pool,
+        ttl=app.config.get("QUIZ_SESSION_TTL", SESSION_TTL),
+        max_sessions=app.config.get("QUIZ_MAX_SESSIONS", MAX_SESSIONS))
+    search = Search(app.config.get("SEARCH_BACKEND"))
+    add_change_listener(app, search.on_change)
+    search_mode = app.config.get("SEARCH_MODE", "substring")
+    suggestions = PrefixIndex(app.config.get("SUGGEST_DEPTH", SUGGEST_DEPTH))
+    add_change_listener(app, suggestions.on_change)
+    app.cli.add_command(search_index_command)
+    app.cli.add_command(db_command)
+    app.cli.add_command(reconcile_counts_command)
+    app.cli.add_command(find_duplicates_command)
+    duplicates = DuplicateFinder(
+        app.config.get("DUPLICATE_THRESHOLD", DUPLICATE_THRESHOLD))
+    board = RankedLeaderboard(
+        app.config.get("LEADERBOARD_REFRESH_INTERVAL", REFRESH_INTERVAL))
+    add_change_listener(app, board.on_change)
+    windows = WindowedBoards(
+        app.config.get("LEADERBOARD_REFRESH_INTERVAL", REFRESH_INTERVAL),
+        app.config.get("LEADERBOARD_TOP_N", ROLLUP_TOP_N))
+    add_change_listener(app, windows.on_change)
+    app.cli.add_command(leaderboard_rollups_command)
+
+    # leaderboard submissions are written synchronously unless the
+    # write-behind buffer is switched on
+    writer = None
+    if app.config.get("LEADERBOARD_WRITE_BEHIND", False):
+        writer = WriteBehindBuffer(
+            app, Leaderboard,
+            batch_size=app.config.get("LEADERBOARD_BATCH_SIZE", BATCH_SIZE),
+            flush_interval=app.config.get(
+                "LEADERBOARD_FLUSH_INTERVAL", FLUSH_INTERVAL),
+            before_commit=record_scores)
+        atexit.register(writer.close)
+
+    # shared with the other entry points (asgi.py) and startup hooks
+    app.extensions["trivia"] = {
+        "versions": versions,
+        "categories": categories_cache,
+        "fragments": fragments,
+        "pool": pool,
+        "shared": shared,
+        "sessions": sessions,
+        "search": search,
+        "suggestions": suggestions,
+        "duplicates": duplicates,
+        "board": board,
+        "windows": windows,
+        "writer": writer,
+        "metrics": metrics,
+        "admission": admission,
+    }
 
     cors = CORS(app, resources={r"/*": {"origin": "*"}})
 
@@ -36,38 +149,97 @@ def create_app(test_config=None):
         response.headers.add(
             "Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS"
         )
+        if app.config.get("COMPRESS_RESPONSES", True):
+            compress(response,
+                     app.config.get("COMPRESS_MIN_SIZE", MIN_COMPRESS_SIZE),
+                     app.config.get("COMPRESS_LEVEL", COMPRESS_LEVEL))
         return response
 
+    def category_tables(request):
+        if request.args.get("with_counts", 0, type=int):
+            return ["categories", "questions"]
+        return ["categories"]
+
+    def questions_validator():
+        # other workers' writes show up in the shared generation, or in
+        # the stored counts, rather than in this process's table versions
+        if shared is not None:
+            return (shared.generation,)
+        return questions_version()
+
+    def category_validator():
+        if request.args.get("with_counts", 0, type=int):
+            return questions_validator()
+        return ()
+
     @app.route('/categories')
+    @conditional(versions, category_tables, extra=category_validator)
     def all_categories():
-        categories = Category.query.all()
+        categories = categories_cache.all()
         if len(categories) < 1:
             abort(404)
 
+        if request.args.get("with_counts", 0, type=int):
+            sizes = category_counts()
+            empty = {"total_questions": 0, "difficulties": {}}
+            categories = [dict(category, **sizes.get(category["id"], empty))
+                          for category in categories]
+
         return jsonify({
             "success": True,
-            "categories": [category.format() for category in categories],
+            "categories": categories,
             "total_categories": len(categories)
         })
 
+    def sparse_fields(table):
+        try:
+            return requested_fields(request.args, table)
+        except ValueError:
+            abort(400)
+
+    def included(payload, default=()):
+        """``payload`` with the related resources the request asks for."""
+        try:
+            includes = requested_includes(request.args, default)
+        except ValueError:
+            abort(400)
+        if "categories" in includes:
+            payload["categories"] = categories_cache.all()
+        return payload
+
+    def shared_page(fields, category_id=None):
+        """A listing page cut out of the shared id arrays."""
+        ids, next_cursor, total = shared.page(request, category_id)
+        rows = db.session.query(*columns(Question, fields)).filter(
+            Question.id.in_(ids)).order_by(Question.id) if ids else []
+        return [row._asdict() for row in rows], next_cursor, total
+
     @app.route("/questions")
+    @conditional(versions, ["questions", "categories"],
+                 extra=questions_validator)
     def get_questions():
-        selection = Question.query.all()
-        categories = Category.query.all()
-        current_questions = paginate_questions(request, selection)
+        fields = sparse_fields("questions")
+        if shared is not None:
+            current_questions, next_cursor, total = shared_page(fields)
+        else:
+            current_questions, next_cursor = paginate_query(
+                request, Question.query, QUESTION_KEYS,
+                columns=columns(Question, fields))
+            total = None
 
         if len(current_questions) < 1:
             abort(404)
 
-        return jsonify(
+        # the categories were always sent here, so they are by default
+        return jsonify(included(
             {
                 "success": True,
-                "questions": current_questions,
-                "total_questions": len(selection),
-                "categories": [category.format() for category in categories],
-                "current_category": None
-            }
-        )
+                "questions": fragments.rows("questions", current_questions),
+                "total_questions": total if total is not None
+                else QuestionCount.total(),
+                "current_category": None,
+                "next_cursor": next_cursor
+            }, default=("categories",)))
 
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
     def delete_question(question_id):
@@ -82,121 +254,398 @@ def create_app(test_config=None):
             "deleted": question_id
         })
 
+    def batch_ids(body):
+        try:
+            return parse_ids(
+                body, app.config.get("BATCH_MAX_IDS", BATCH_MAX_IDS))
+        except ValueError:
+            abort(400)
+
+    @app.route('/questions', methods=['DELETE'])
+    def delete_questions_in_batch():
+        ids = batch_ids(request.get_json(silent=True))
+        deleted = delete_questions(ids)
+        return jsonify({
+            "success": True,
+            "deleted": deleted,
+            "missing": sorted(set(ids) - set(deleted))
+        })
+
+    @app.route('/questions/batch', methods=['POST'])
+    def change_questions_in_batch():
+        body = request.get_json(silent=True)
+        ids = batch_ids(body)
+        if body.get("delete", False):
+            deleted = delete_questions(ids)
+            return jsonify({
+                "success": True,
+                "deleted": deleted,
+                "missing": sorted(set(ids) - set(deleted))
+            })
+
+        try:
+            changes = parse_question_changes(body)
+        except ValueError:
+            abort(400)
+        if "category" in changes and \
+                Category.query.get(changes["category"]) is None:
+            abort(422)
+        updated = update_questions(ids, changes)
+        return jsonify({
+            "success": True,
+            "updated": updated,
+            "missing": sorted(set(ids) - set(updated))
+        })
+
+    def duplicate_policy():
+        policy = request.args.get(
+            "duplicates", app.config.get("DUPLICATE_POLICY", DUPLICATE_POLICY))
+        if policy not in DUPLICATE_POLICIES:
+            abort(400)
+        return policy
+
     @app.route('/questions', methods=['POST'])
     def create_question():
         body = request.get_json()
 
-        if body is None:
+        if not isinstance(body, dict):
             abort(400)
 
         # get the json value if search term is in the json body
         if 'searchTerm' in body.keys():
             searchTerm = body.get('searchTerm', None)
-            if searchTerm:
-                selection = Question.query.filter(
-                    Question.question.ilike(f'%{searchTerm}%')).all()
-                current_questions = paginate_questions(request, selection)
+            mode = body.get('mode', search_mode)
+            if searchTerm and mode in MODES:
+                page = request.args.get("page", 1, type=int)
+                try:
+                    current_questions, total_questions, next_after = \
+                        search.search(str(searchTerm), mode, page,
+                                      QUESTIONS_PER_PAGE,
+                                      request_after(request))
+                except ValueError:
+                    abort(400)
                 if len(current_questions) < 1:
                     abort(404)
                 return jsonify({
                     "success": True,
-                    "questions": current_questions,
-                    "total_questions": len(selection),
-                    "current_category": None
+                    "questions": fragments.rows(
+                        "questions", current_questions),
+                    "total_questions": total_questions,
+                    "current_category": None,
+                    "next_cursor": None if next_after is None
+                    else encode_cursor([next_after])
                 })
             else:
                 abort(400)
         else:
-            for key in ['question', 'answer', 'difficulty', 'category']:
-                if key not in body.keys(
-                ) or body[key] is None or body[key] == '':
-                    abort(422)
-
-            question = Question(
-                question=body['question'],
-                answer=body['answer'],
-                difficulty=body['difficulty'],
-                category=body['category'],
-            )
+            try:
+                values = parse_question(body)
+            except ValueError:
+                abort(422)
+
+            policy = duplicate_policy()
+            similar = []
+            if policy != "allow":
+                similar, = duplicates.match([values['question']])
+                if similar and policy == "reject":
+                    return jsonify({
+                        **error_payload(409),
+                        "duplicates": similar
+                    }), 409
+
+            question = Question(**values)
             question.insert()
 
-            return jsonify({
+            created = {
                 "success": True,
                 "created": question.format()
-            })
+            }
+            if policy == "warn":
+                created["duplicates"] = similar
+            return jsonify(created)
+
+    @app.route('/questions/suggest')
+    def suggest_questions():
+        prefix = request.args.get("prefix", "")
+        limit = request.args.get(
+            "limit", app.config.get("SUGGEST_LIMIT", SUGGEST_LIMIT), type=int)
+        if not prefix.strip() or limit < 1:
+            abort(400)
+
+        return jsonify({
+            "success": True,
+            "suggestions": suggestions.suggest(
+                prefix, min(limit, SUGGEST_MAX_LIMIT))
+        })
+
+    @app.route('/questions/bulk', methods=['POST'])
+    def import_questions():
+        batch_size = request.args.get(
+            "batch_size",
+            app.config.get("IMPORT_BATCH_SIZE", IMPORT_BATCH_SIZE),
+            type=int)
+        if batch_size < 1:
+            abort(400)
+
+        content_type = request.mimetype
+        if request.args.get("format") == "csv":
+            content_type = "text/csv"
+
+        policy = duplicate_policy()
+        bulk_import = BulkImport(
+            batch_size,
+            duplicates=duplicates if policy != "allow" else None,
+            reject=policy == "reject",
+            bands=app.config.get("IMPORT_QUESTION_BANDS", True))
+        bulk_import.run(records(request.stream, content_type))
+
+        return jsonify({
+            "success": True,
+            **bulk_import.report()
+        })
+
+    @app.route('/questions/export')
+    def export_questions():
+        export_format = request.args.get("format", "ndjson")
+        if export_format not in EXPORT_FORMATS:
+            abort(400)
+
+        filters = []
+        category = request.args.get("category", None, type=int)
+        if category is not None:
+            filters.append(Question.category == category)
+        difficulty = request.args.get("difficulty", None, type=int)
+        if difficulty is not None:
+            filters.append(Question.difficulty == difficulty)
+
+        return stream_export(
+            [Question.id, Question.question, Question.answer,
+             Question.category, Question.difficulty],
+            filters, [Question.id], export_format, "questions")
 
     @app.route('/categories/<int:category_id>/questions')
+    @conditional(versions, ["questions", "categories"],
+                 extra=questions_validator)
     def get_questions_for_categoy(category_id):
-        questions = Question.query.filter(
-            Question.category == category_id).all()
-        paginated_questions = paginate_questions(request, questions)
+        fields = sparse_fields("questions")
+        if shared is not None:
+            paginated_questions, next_cursor, total = shared_page(
+                fields, category_id)
+        else:
+            questions = Question.query.filter(
+                Question.category == category_id)
+            paginated_questions, next_cursor = paginate_query(
+                request, questions, QUESTION_KEYS,
+                columns=columns(Question, fields))
+            total = None
 
         if len(paginated_questions) < 1:
             return abort(404)
 
-        return jsonify({
+        return jsonify(included({
             "success": True,
-            "questions": paginated_questions,
-            "total_questions": len(questions),
-            "current_category": category_id
-        })
+            "questions": fragments.rows("questions", paginated_questions),
+            "total_questions": total if total is not None
+            else QuestionCount.total(category_id),
+            "current_category": category_id,
+            "next_cursor": next_cursor
+        }))
 
     @app.route("/quizzes", methods=["POST"])
     def get_question_for_quiz():
+        read_from_replica()
         body = request.get_json()
-        previous_questions = body.get('previous_questions', None)
-        category = body.get('quiz_category', None)
-        if category is None:
+        try:
+            category_id = parse_quiz_category(body)
+            previous_questions = parse_previous_questions(body)
+            count = body.get('count', None)
+            count = None if count is None else int(count)
+            difficulty = body.get('difficulty', None)
+            difficulty = None if difficulty is None else int(difficulty)
+        except (TypeError, ValueError):
             abort(400)
 
-        if category['id'] == 0:
-            questions = Question.query.filter(
-                Question.id.notin_(previous_questions)).all()
-        else:
-            questions = Question.query.filter(
-                Question.category == category['id'],
-                Question.id.notin_(previous_questions)).all()
-        # No more questions return none to end the game
-        if len(questions) < 1:
-            return jsonify({
+        fields = sparse_fields("questions")
+
+        if count is not None:
+            if count < 1:
+                abort(400)
+            # a whole round in one call, drawn without repeats
+            questions = pool.pick_many(
+                category_id, previous_questions,
+                min(count, app.config.get("QUIZ_MAX_ROUND", MAX_ROUND_SIZE)),
+                difficulty, fields)
+            return jsonify(included({
                 "success": True,
-                "question": None
-            })
+                "questions": questions
+            }))
+
+        # No more questions return none to end the game
+        return jsonify(included({
+            "success": True,
+            "question": pool.pick(
+                category_id, previous_questions, difficulty, fields)
+        }))
+
+    @app.route("/quizzes/sessions", methods=["POST"])
+    def create_quiz_session():
+        read_from_replica()
+        try:
+            category_id = parse_quiz_category(request.get_json())
+        except ValueError:
+            abort(400)
+
+        session_id, total = sessions.create(category_id)
+
+        return jsonify({
+            "success": True,
+            "session_id": session_id,
+            "total_questions": total,
+            "expires_in": sessions.ttl
+        })
+
+    @app.route("/quizzes/sessions/<session_id>/next", methods=["POST"])
+    def next_quiz_session_question(session_id):
+        read_from_replica()
+        try:
+            question = sessions.next(session_id)
+        except KeyError:
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "question": question.format() if question is not None else None,
+            "remaining": sessions.remaining(session_id)
+        })
 
-        question = random.choice(questions).format()
+    @app.route("/quizzes/sessions/<session_id>", methods=["DELETE"])
+    def end_quiz_session(session_id):
+        if not sessions.end(session_id):
+            abort(404)
 
         return jsonify({
             "success": True,
-            "question": question
+            "deleted": session_id
         })
 
+    def leaderboard_validator():
+        span = request.args.get("window")
+        if span is None:
+            return board.validator()
+        if span not in ROLLUP_SPANS:
+            return ()
+        return windows.validator(span)
+
     @app.route("/leaderboard")
+    @conditional(versions, ["leaderboard", "categories"],
+                 extra=leaderboard_validator)
     def get_leaderboard_scores():
         ''' Endpoint to get leaderboard scores, the top 10 scores'''
 
-        scores = Leaderboard.query.order_by(desc(Leaderboard.score)).all()
-        paginated_scores = paginate_questions(request, scores)
+        fields = sparse_fields("leaderboard")
+        span = request.args.get("window")
+        if span is not None:
+            if span not in ROLLUP_SPANS:
+                abort(400)
+            period, entries = windows.board(span)
+            return jsonify(included({
+                "results": fragments.rows(
+                    "leaderboard", project(entries, fields, "leaderboard")),
+                "totalResults": len(entries),
+                "window": span,
+                "period": period.isoformat(),
+                "next_cursor": None
+            }))
+
+        paginated_scores, next_cursor = board.page(request)
+        return jsonify(included({
+            "results": fragments.rows(
+                "leaderboard",
+                project(paginated_scores, fields, "leaderboard")),
+            "totalResults": len(board),
+            "next_cursor": next_cursor
+        }))
+
+    @app.route("/leaderboard/export")
+    def export_leaderboard():
+        export_format = request.args.get("format", "ndjson")
+        if export_format not in EXPORT_FORMATS:
+            abort(400)
+
+        return stream_export(
+            [Leaderboard.id, Leaderboard.player, Leaderboard.score],
+            [], [Leaderboard.score.desc(), Leaderboard.id],
+            export_format, "leaderboard")
+
+    @app.route("/leaderboard/rank")
+    def get_rank_of_score():
+        score = request.args.get("score", None, type=int)
+        if score is None:
+            abort(400)
+
         return jsonify({
-            "results": paginated_scores,
-            "totalResults": len(scores)
+            "success": True,
+            "score": score,
+            "rank": board.rank_of_score(score),
+            "totalResults": len(board)
+        })
+
+    @app.route("/leaderboard/<int:entry_id>/rank")
+    def get_rank_of_entry(entry_id):
+        rank, result = board.rank_of_entry(entry_id)
+        if rank is None:
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "result": result,
+            "rank": rank,
+            "totalResults": len(board)
         })
 
     @app.route("/leaderboard", methods=["POST"])
     def post_to_leaderboard():
         try:
-            player = request.get_json()["name"]
-            score = int(request.get_json()["score"])
+            player, score = parse_score(request.get_json())
 
-            player_score_item = Leaderboard(player=player, score=score)
-            player_score_item.insert()
+            if writer is not None:
+                added = writer.submit(player=player, score=score,
+                                      created_at=datetime.utcnow())
+            else:
+                player_score_item = Leaderboard(player=player, score=score)
+                player_score_item.insert()
+                added = player_score_item.id
 
             return jsonify({
-                "added": player_score_item.id,
+                "added": added,
                 "success": True
             })
         except Exception:
             abort(400)
 
+    @app.route("/leaderboard/buffer")
+    def get_leaderboard_buffer():
+        if writer is None:
+            return jsonify({
+                "success": True,
+                "enabled": False
+            })
+
+        return jsonify({
+            "success": True,
+            "enabled": True,
+            **writer.stats()
+        })
+
+    @app.route("/metrics")
+    def get_metrics():
+        if metrics is None:
+            abort(404)
+        body = metrics.render()
+        if admission is not None:
+            body += admission.render()
+        return Response(body, mimetype=METRICS_CONTENT_TYPE)
+
     @app.route("/")
     def serve():
         return "Welcome to Trivia API"
@@ -209,32 +658,22 @@ def create_app(test_config=None):
 
     @app.errorhandler(404)
     def not_found(error):
-        return (jsonify({"success": False, "error": 404,
-                         "message": "resource not found"}), 404, )
+        return jsonify(error_payload(404)), 404
 
     @app.errorhandler(422)
     def unprocessable(error):
-        return (
-            jsonify({
-                "success": False,
-                "error": 422,
-                "message": "unprocessable"}),
-            422,
-        )
+        return jsonify(error_payload(422)), 422
 
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({"success": False, "error": 400,
-                       "message": "bad request"}), 400
+        return jsonify(error_payload(400)), 400
 
     @app.errorhandler(405)
     def not_allowed(error):
-        return (jsonify({"success": False, "error": 405,
-                         "message": "method not allowed"}), 405, )
+        return jsonify(error_payload(405)), 405
 
     @app.errorhandler(500)
     def internal_server_error(error):
-        return (jsonify({"success": False, "error": 500,
-                         "message": "internal server error"}), 500, )
+        return jsonify(error_payload(500)), 500
 
     return app
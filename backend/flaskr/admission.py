@@ -0,0 +1,185 @@
+"""
+Admission control.
+
+Each limited route gets a ``Limiter``: at most ``concurrency`` of its
+requests run at once in a process, up to ``queue`` more wait for a slot,
+and none waits longer than ``budget`` seconds. A request that finds the
+queue full, or whose expected wait - the requests ahead of it drained
+``concurrency`` at a time, at the route's recent average service time -
+is over the budget, is answered straight away with ``503`` and a
+``Retry-After`` header instead of joining the queue only to time out.
+Expensive routes such as search and quiz draws then shed load on their
+own, rather than holding every worker thread while cheap routes like
+``GET /categories`` wait behind them.
+
+Limits are per process and only bite where a process serves requests
+concurrently, e.g. gunicorn's ``gthread`` workers (as the Procfile runs)
+or the ASGI app; a sync worker serves one request at a time anyway. The
+ASGI fast paths cannot wait on the event loop, so they only answer a
+request when ``try_acquire`` finds a free slot and otherwise hand it to
+the Flask app, which queues or sheds it in a worker thread.
+"""
+import math
+import threading
+import time
+
+from flask import g, request
+
+from .encoding import jsonify
+from .errors import error_payload
+
+# "METHOD /rule": {"concurrency": ..., "queue": ..., "budget": ...}
+DEFAULT_LIMITS = {
+    'POST /questions': {'concurrency': 4, 'queue': 16, 'budget': 1.0},
+    'POST /quizzes': {'concurrency': 8, 'queue': 32, 'budget': 0.5},
+    'GET /leaderboard': {'concurrency': 8, 'queue': 32, 'budget': 0.5},
+}
+
+QUEUE = 16
+BUDGET = 1.0
+
+# weight of the latest request in the average service time
+SMOOTHING = 0.2
+
+
+class Limiter:
+    """A concurrency limit with a bounded, deadline-aware wait queue."""
+
+    def __init__(self, concurrency, queue=QUEUE, budget=BUDGET):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.budget = budget
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+        self._running = 0
+        self._waiting = 0
+        self._service = None
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def waiting(self):
+        return self._waiting
+
+    def expected_wait(self, ahead=None):
+        """Seconds a request joining the queue now would expect to wait."""
+        if ahead is None:
+            ahead = self._waiting
+        if self._service is None:
+            return 0.0
+        return (ahead // self.concurrency + 1) * self._service
+
+    def retry_after(self):
+        """Whole seconds a shed client is told to wait before retrying."""
+        return max(1, math.ceil(self.expected_wait()))
+
+    def _take(self):
+        if self._running < self.concurrency and not self._waiting:
+            self._running += 1
+            self.admitted += 1
+            return True
+        return False
+
+    def try_acquire(self):
+        """Take a slot if one is free now, without waiting."""
+        with self._condition:
+            return self._take()
+
+    def acquire(self):
+        """Take a slot, waiting for one if need be; False when shed."""
+        with self._condition:
+            if self._take():
+                return True
+            if self._waiting >= self.queue or \
+                    self.expected_wait() > self.budget:
+                self.shed += 1
+                return False
+
+            self.queued += 1
+            self._waiting += 1
+            deadline = time.monotonic() + self.budget
+            try:
+                while self._running >= self.concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting -= 1
+            self._running += 1
+            self.admitted += 1
+            return True
+
+    def release(self, seconds):
+        """Give back a slot held for ``seconds``."""
+        with self._condition:
+            self._running -= 1
+            self._service = seconds if self._service is None else \
+                self._service + SMOOTHING * (seconds - self._service)
+            self._condition.notify()
+
+
+class AdmissionControl:
+    """Per-route limiters, applied to the Flask request lifecycle."""
+
+    def __init__(self, limits=DEFAULT_LIMITS):
+        self.limiters = {}
+        for key, options in limits.items():
+            method, rule = key.split(' ', 1)
+            self.limiters[(method.upper(), rule)] = Limiter(**options)
+
+    def limiter(self, method, rule):
+        """The limiter of a route, or None when it is not limited."""
+        return self.limiters.get((method, rule))
+
+    def install(self, app):
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _before_request(self):
+        rule = request.url_rule
+        if rule is None:
+            return None
+        limiter = self.limiter(request.method, rule.rule)
+        if limiter is None:
+            return None
+        if not limiter.acquire():
+            response = jsonify(error_payload(503))
+            response.status_code = 503
+            response.headers['Retry-After'] = str(limiter.retry_after())
+            return response
+        g.trivia_admitted = (limiter, time.perf_counter())
+        return None
+
+    def _teardown_request(self, error):
+        admitted = g.pop('trivia_admitted', None)
+        if admitted is not None:
+            limiter, started = admitted
+            limiter.release(time.perf_counter() - started)
+
+    def render(self):
+        """The counters in the Prometheus text exposition format."""
+        lines = []
+        for name, kind, text, value in [
+                ('trivia_admission_admitted_total', 'counter',
+                 'Requests admitted by admission control.', 'admitted'),
+                ('trivia_admission_queued_total', 'counter',
+                 'Requests that waited for a slot.', 'queued'),
+                ('trivia_admission_shed_total', 'counter',
+                 'Requests rejected with 503.', 'shed'),
+                ('trivia_admission_running', 'gauge',
+                 'Requests holding a slot.', 'running'),
+                ('trivia_admission_waiting', 'gauge',
+                 'Requests waiting for a slot.', 'waiting')]:
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (method, rule), limiter in sorted(self.limiters.items()):
+                lines.append(
+                    f'{name}{{route="{rule}",method="{method}"}} '
+                    f'{getattr(limiter, value)}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,514 @@
+"""
+Asynchronous serving.
+
+``create_asgi_app`` wraps the Flask app in an ASGI application for
+servers such as uvicorn. The read-heavy listings, quiz draws and
+leaderboard submissions are answered on the event loop through an
+asyncpg connection pool, using the same in-process caches the Flask app
+keeps (categories, the question pool, the ranked board and the encoded
+fragments), so the two paths never disagree. Everything else -
+and a hot path whose cache is still cold, or that asks for a cursor or
+a conditional response - is handed to the Flask app, which asgiref runs
+in a worker thread. Requests answered here are counted in the metrics
+with their latency and size; their SQL is not.
+
+Without asyncpg or a PostgreSQL database every request is handed over,
+so the ASGI app still works, only without the fast paths. asgiref, like
+asyncpg, is only needed to serve over ASGI and is not installed with the
+Flask app.
+"""
+import asyncio
+import gzip
+import json
+import re
+import time
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import http_date, parse_accept_header
+
+from models import (notify_change, rollup_period, ROLLUP_SPANS,
+                    ROLLUP_TOP_N)
+from .counts import VERSION_QUERIES, version_values
+from .encoding import (MIN_COMPRESS_SIZE, COMPRESS_LEVEL, brotli, encode)
+from .errors import error_payload
+from .fields import project, requested_fields, requested_includes
+from .pagination import QUESTIONS_PER_PAGE, encode_cursor
+from .quiz import MAX_ROUND_SIZE
+from .validation import (parse_previous_questions, parse_quiz_category,
+                         parse_score)
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+POOL_SIZE = 10
+
+HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+    (b'access-control-allow-methods', b'GET,PUT,POST,DELETE,OPTIONS'),
+]
+
+# asyncpg counterparts of models.record_scores; expired periods are left
+# for the next write through the Flask app or `flask leaderboard-rollups`
+ADD_TO_ROLLUP = (
+    'INSERT INTO leaderboard_rollups (span, period, entry_id, player, score) '
+    'VALUES ($1, $2, $3, $4, $5)')
+TRIM_ROLLUP = (
+    'DELETE FROM leaderboard_rollups WHERE span = $1 AND period = $2 '
+    'AND entry_id IN (SELECT entry_id FROM leaderboard_rollups '
+    'WHERE span = $1 AND period = $2 '
+    'ORDER BY score DESC, entry_id OFFSET $3)')
+
+
+def asyncpg_dsn(uri):
+    """The asyncpg DSN for a SQLAlchemy PostgreSQL URI, or None."""
+    scheme, _, rest = uri.partition('://')
+    if scheme.split('+')[0] not in ('postgresql', 'postgres'):
+        return None
+    return 'postgresql://' + rest
+
+
+class _Request:
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.args = MultiDict(parse_qsl(
+            scope['query_string'].decode('latin-1'), keep_blank_values=True))
+        self.headers = {name.decode('latin-1'): value.decode('latin-1')
+                        for name, value in scope['headers']}
+        self.body = None
+
+    @property
+    def full_path(self):
+        # the same key conditional() hashes into ETags
+        return f"{self.scope['path']}?{self.scope['query_string'].decode()}"
+
+    async def read(self):
+        if self.body is None:
+            chunks = []
+            while True:
+                message = await self.receive()
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body', False):
+                    break
+            self.body = b''.join(chunks)
+        return self.body
+
+    async def json(self):
+        try:
+            return json.loads(await self.read())
+        except ValueError:
+            return None
+
+    def replay(self):
+        """A receive callable that hands the body read so far over again."""
+        if self.body is None:
+            return self.receive
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                return await self.receive()
+            sent = True
+            return {'type': 'http.request', 'body': self.body,
+                    'more_body': False}
+        return receive
+
+
+class AsyncTrivia:
+    """ASGI application answering the hot paths itself."""
+
+    def __init__(self, app, dsn=None, pool_size=POOL_SIZE):
+        self.app = app
+        self.engines = app.extensions['trivia']
+        self.wsgi = WsgiToAsgi(app)
+        self.dsn = dsn if asyncpg is not None else None
+        self.pool_size = pool_size
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+        # (method, path pattern, Flask rule it stands in for, handler)
+        self.routes = [
+            ('GET', re.compile(r'/questions$'), '/questions',
+             self.get_questions),
+            ('GET', re.compile(r'/categories/(?P<category_id>\d+)/questions$'),
+             '/categories/<int:category_id>/questions', self.get_questions),
+            ('POST', re.compile(r'/quizzes$'), '/quizzes',
+             self.get_question_for_quiz),
+            ('GET', re.compile(r'/leaderboard$'), '/leaderboard',
+             self.get_leaderboard),
+            ('POST', re.compile(r'/leaderboard$'), '/leaderboard',
+             self.post_to_leaderboard),
+        ]
+
+    async def pool(self):
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        self.dsn, min_size=1, max_size=self.pool_size)
+        return self._pool
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+
+        if scope['type'] == 'http' and self.dsn is not None:
+            admission = self.engines['admission']
+            for method, pattern, rule, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match is None or scope['method'] != method:
+                    continue
+                limiter = admission.limiter(method, rule) \
+                    if admission is not None else None
+                if limiter is not None and not limiter.try_acquire():
+                    # Flask queues or sheds it without blocking the loop
+                    break
+                started = time.perf_counter()
+                request = _Request(scope, receive)
+                try:
+                    response = await handler(request, **match.groupdict())
+                finally:
+                    if limiter is not None:
+                        limiter.release(time.perf_counter() - started)
+                if response is not None:
+                    size = await self._send(request, send, *response)
+                    metrics = self.engines['metrics']
+                    if metrics is not None:
+                        metrics.observe(rule, method, response[0],
+                                        time.perf_counter() - started, size)
+                    return
+                receive = request.replay()
+                break
+
+        await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.dsn is not None:
+                    await self.pool()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _compress(self, request, body):
+        config = self.app.config
+        if not config.get("COMPRESS_RESPONSES", True) or \
+                len(body) < config.get("COMPRESS_MIN_SIZE", MIN_COMPRESS_SIZE):
+            return body, None
+        offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+        encoding = parse_accept_header(
+            request.headers.get('accept-encoding')).best_match(offered)
+        level = config.get("COMPRESS_LEVEL", COMPRESS_LEVEL)
+        if encoding == 'br':
+            return brotli.compress(body, quality=min(level, 11)), encoding
+        if encoding == 'gzip':
+            return gzip.compress(body, compresslevel=level), encoding
+        return body, None
+
+    async def _send(self, request, send, status, payload, tables=None,
+                    extra=()):
+        body = encode(payload)
+        headers = list(HEADERS)
+        headers.append((b'content-type', b'application/json'))
+        if status == 200:
+            headers.append((b'vary', b'Accept-Encoding'))
+            body, encoding = self._compress(request, body)
+            if tables is not None:
+                versions = self.engines['versions']
+                etag = versions.etag(request.full_path, tables, extra)
+                if encoding is not None:
+                    etag = f'{etag}-{encoding}'
+                headers.append((b'etag', f'"{etag}"'.encode()))
+                headers.append((b'last-modified', http_date(
+                    versions.last_modified(tables)).encode()))
+            if encoding is not None:
+                headers.append((b'content-encoding', encoding.encode()))
+        headers.append((b'content-length', str(len(body)).encode()))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+        return len(body)
+
+    @staticmethod
+    def _plain(request):
+        """Whether the request can skip the Flask-side validators."""
+        return not any(name in request.args for name in ('cursor', 'after')) \
+            and 'if-none-match' not in request.headers \
+            and 'if-modified-since' not in request.headers
+
+    def _included(self, request, payload, default=()):
+        """
+        ``payload`` with the related resources the request asks for, or
+        None when one is not cached yet; raises ValueError.
+        """
+        if 'categories' in requested_includes(request.args, default):
+            categories = self.engines['categories'].cached()
+            if categories is None:
+                return None
+            payload['categories'] = categories
+        return payload
+
+    async def get_questions(self, request, category_id=None):
+        page = request.args.get('page', 1, type=int)
+        if not self._plain(request) or page < 1:
+            return None
+        try:
+            fields = requested_fields(request.args, 'questions')
+            payload = self._included(
+                request, {}, ('categories',) if category_id is None else ())
+        except ValueError:
+            return 400, error_payload(400)
+        if payload is None:
+            return None
+
+        if category_id is None:
+            where, params = '', []
+        else:
+            category_id = int(category_id)
+            where, params = 'WHERE category = $1', [category_id]
+
+        shared = self.engines['shared']
+        if shared is not None:
+            if not shared.loaded:
+                return None
+            extra = (shared.generation,)
+            rows, next_cursor, total = await self._shared_page(
+                request, shared, category_id, fields)
+        else:
+            rows, next_cursor, total = await self._database_page(
+                page, where, params, fields)
+            extra = await self._questions_version() if rows else ()
+        if not rows:
+            return 404, error_payload(404)
+
+        payload.update({
+            "success": True,
+            "questions": self.engines['fragments'].rows(
+                'questions', [dict(row) for row in rows]),
+            "total_questions": total,
+            "current_category": category_id,
+            "next_cursor": next_cursor
+        })
+        return 200, payload, ['questions', 'categories'], extra
+
+    async def _questions_version(self):
+        # the validator the Flask app computes, so their ETags agree
+        pool = await self.pool()
+        top_query, rows_query = VERSION_QUERIES
+        return version_values(await pool.fetchval(top_query),
+                              await pool.fetch(rows_query))
+
+    async def _database_page(self, page, where, params, fields):
+        pool = await self.pool()
+        per_page = QUESTIONS_PER_PAGE
+        n = len(params)
+        # fields are checked against the known column names
+        rows = await pool.fetch(
+            f'SELECT {", ".join(fields)} FROM questions {where} '
+            f'ORDER BY id LIMIT ${n + 1} OFFSET ${n + 2}',
+            *params, per_page + 1, (page - 1) * per_page)
+        if not rows:
+            return [], None, 0
+
+        total = await pool.fetchval(
+            'SELECT coalesce(sum(count), 0) FROM question_counts '
+            f'{where}', *params)
+
+        next_cursor = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            next_cursor = encode_cursor([rows[-1]['id']])
+        return rows, next_cursor, total
+
+    async def _shared_page(self, request, shared, category_id, fields):
+        # the page position and total come from the shared id arrays;
+        # only the rows on the page are read, by primary key
+        ids, next_cursor, total = shared.page(request, category_id)
+        if not ids:
+            return [], None, total
+        pool = await self.pool()
+        rows = await pool.fetch(
+            f'SELECT {", ".join(fields)} FROM questions '
+            f'WHERE id = ANY($1::int[]) ORDER BY id', ids)
+        return rows, next_cursor, total
+
+    async def get_question_for_quiz(self, request):
+        quiz_pool = self.engines['pool']
+        body = await request.json()
+        if not quiz_pool.loaded or not isinstance(body, dict):
+            return None
+        try:
+            category_id = parse_quiz_category(body)
+            previous_questions = parse_previous_questions(body)
+            count = body.get('count', None)
+            count = None if count is None else int(count)
+            difficulty = body.get('difficulty', None)
+            difficulty = None if difficulty is None else int(difficulty)
+        except (TypeError, ValueError):
+            return 400, error_payload(400)
+        if count is not None and count < 1:
+            return 400, error_payload(400)
+        try:
+            fields = requested_fields(request.args, 'questions')
+            payload = self._included(request, {"success": True})
+        except ValueError:
+            return 400, error_payload(400)
+        if payload is None:
+            return None
+        wanted = 1 if count is None else min(
+            count, self.app.config.get("QUIZ_MAX_ROUND", MAX_ROUND_SIZE))
+
+        pool = await self.pool()
+        played = previous_questions
+        questions = []
+        while len(questions) < wanted:
+            ids = quiz_pool.sample_ids(category_id, played,
+                                       wanted - len(questions), difficulty)
+            if not ids:
+                break
+            rows = {row['id']: dict(row) for row in await pool.fetch(
+                f'SELECT {", ".join(fields)} FROM questions '
+                f'WHERE id = ANY($1::int[])', ids)}
+            for question_id in ids:
+                if question_id in rows:
+                    questions.append(rows[question_id])
+                else:
+                    # deleted behind our back; forget it and draw again
+                    quiz_pool.forget(question_id)
+            played.extend(ids)
+
+        if count is not None:
+            payload["questions"] = questions
+        else:
+            payload["question"] = questions[0] if questions else None
+        return 200, payload
+
+    async def get_leaderboard(self, request):
+        if 'window' in request.args:
+            return await self.get_windowed_leaderboard(request)
+        board = self.engines['board']
+        if not self._plain(request) or not board.fresh:
+            return None
+        try:
+            fields = requested_fields(request.args, 'leaderboard')
+            payload = self._included(request, {})
+        except ValueError:
+            return 400, error_payload(400)
+        if payload is None:
+            return None
+        # a fresh board answers from memory without touching the database
+        with self.app.app_context():
+            extra = board.validator()
+            results, next_cursor = board.page(request)
+        payload.update({
+            "results": self.engines['fragments'].rows(
+                'leaderboard', project(results, fields, 'leaderboard')),
+            "totalResults": extra[0],
+            "next_cursor": next_cursor
+        })
+        return 200, payload, ['leaderboard', 'categories'], extra
+
+    async def get_windowed_leaderboard(self, request):
+        span = request.args['window']
+        if span not in ROLLUP_SPANS:
+            return 400, error_payload(400)
+        windows = self.engines['windows']
+        cached = windows.cached(span)
+        if cached is None or not self._plain(request):
+            return None
+        try:
+            fields = requested_fields(request.args, 'leaderboard')
+            payload = self._included(request, {})
+        except ValueError:
+            return 400, error_payload(400)
+        if payload is None:
+            return None
+        period, entries = cached
+        payload.update({
+            "results": self.engines['fragments'].rows(
+                'leaderboard', project(entries, fields, 'leaderboard')),
+            "totalResults": len(entries),
+            "window": span,
+            "period": period.isoformat(),
+            "next_cursor": None
+        })
+        return 200, payload, ['leaderboard', 'categories'], \
+            windows.validator(span, cached)
+
+    async def _insert_score(self, pool, player, score, created_at):
+        top = self.app.config.get("LEADERBOARD_TOP_N", ROLLUP_TOP_N)
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                added = await connection.fetchval(
+                    'INSERT INTO leaderboard (player, score, created_at) '
+                    'VALUES ($1, $2, $3) RETURNING id',
+                    player, score, created_at)
+                for span in ROLLUP_SPANS:
+                    period = rollup_period(span, created_at)
+                    await connection.execute(
+                        ADD_TO_ROLLUP, span, period, added, player, score)
+                    await connection.execute(TRIM_ROLLUP, span, period, top)
+        return added
+
+    def _submit(self, writer, player, score, created_at):
+        with self.app.app_context():
+            return writer.submit(player=player, score=score,
+                                 created_at=created_at)
+
+    async def post_to_leaderboard(self, request):
+        try:
+            player, score = parse_score(await request.json())
+        except ValueError:
+            return 400, error_payload(400)
+
+        writer = self.engines['writer']
+        created_at = datetime.utcnow()
+        if writer is not None:
+            # reserving ids and a full buffer's flush both block on the
+            # database, so they run in a worker thread
+            added = await asyncio.get_running_loop().run_in_executor(
+                None, self._submit, writer, player, score, created_at)
+        else:
+            pool = await self.pool()
+            try:
+                added = await self._insert_score(
+                    pool, player, score, created_at)
+            except (asyncpg.PostgresError, ValueError):
+                # asyncpg rejects arguments it cannot encode with a
+                # ValueError before anything is sent
+                return 400, error_payload(400)
+            with self.app.app_context():
+                notify_change('leaderboard', 'insert', [
+                    {'id': added, 'player': player, 'score': score}])
+        return 200, {"added": added, "success": True}
+
+
+def create_asgi_app(app):
+    """Serve ``app`` over ASGI, with the async fast paths when possible."""
+    if WsgiToAsgi is None:
+        raise RuntimeError('serving over ASGI needs asgiref: '
+                           'pip install asgiref')
+    config = app.config
+    dsn = config.get("ASYNC_DATABASE_URI") or \
+        asyncpg_dsn(config["SQLALCHEMY_DATABASE_URI"])
+    return AsyncTrivia(app, dsn, config.get("ASYNC_POOL_SIZE", POOL_SIZE))
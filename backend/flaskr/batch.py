@@ -0,0 +1,68 @@
+"""
+Batch changes to questions.
+
+A batch deletes, or sets the category and difficulty of, a list of
+questions with one ``DELETE`` or ``UPDATE ... WHERE id IN (...)`` in a
+single transaction, instead of a request and a commit per question. The
+rows are locked and read first, in id order so two overlapping batches
+cannot deadlock, which gives the ids that were actually affected, the
+per-(category, difficulty) count adjustments and the rows handed to the
+change listeners once the transaction has committed.
+"""
+from collections import Counter
+
+from sqlalchemy import select
+
+from models import (db, bump_question_counts, notify_change,
+                    remove_question_bands, Question)
+
+MAX_IDS = 1000
+
+
+def _lock_rows(ids):
+    table = Question.__table__
+    return [dict(row) for row in db.session.execute(
+        select([table]).where(table.c.id.in_(ids))
+        .order_by(table.c.id).with_for_update())]
+
+
+def _keys(rows):
+    return Counter((row['category'], row['difficulty']) for row in rows)
+
+
+def delete_questions(ids):
+    """Delete the questions with these ids; returns the ids deleted."""
+    table = Question.__table__
+    rows = _lock_rows(ids)
+    if rows:
+        db.session.execute(table.delete().where(
+            table.c.id.in_([row['id'] for row in rows])))
+        bump_question_counts(
+            {key: -count for key, count in _keys(rows).items()})
+        remove_question_bands([row['id'] for row in rows])
+    db.session.commit()
+
+    if rows:
+        notify_change(Question.__tablename__, 'delete', rows)
+    return [row['id'] for row in rows]
+
+
+def update_questions(ids, changes):
+    """
+    Set ``changes`` (category and/or difficulty) on the questions with
+    these ids; returns the ids updated.
+    """
+    table = Question.__table__
+    rows = _lock_rows(ids)
+    updated = [{**row, **changes} for row in rows]
+    if rows:
+        db.session.execute(table.update().where(
+            table.c.id.in_([row['id'] for row in rows])).values(changes))
+        deltas = _keys(updated)
+        deltas.subtract(_keys(rows))
+        bump_question_counts(deltas)
+    db.session.commit()
+
+    if rows:
+        notify_change(Question.__tablename__, 'update', updated)
+    return [row['id'] for row in rows]
@@ -0,0 +1,239 @@
+"""
+Bulk question import.
+
+The request body is read line by line, as NDJSON (one question object per
+line) or CSV with a header row, and valid rows are written in batches of
+``batch_size``, each in its own transaction: with COPY on Postgres and a
+multi-row INSERT elsewhere. Only one batch is held in memory at a time,
+so memory use does not depend on the size of the upload. Invalid rows
+are reported with their line number and skipped; a batch the database
+rejects is retried row by row so one bad row does not sink its batch.
+
+With a ``DuplicateFinder``, each batch is first checked against the
+stored questions and its own earlier rows: near-duplicates are reported,
+or skipped as failed rows when ``reject`` is set. The near-duplicate
+buckets of the rows written are stored in the same transaction, which
+costs a millisecond or two of hashing per row; with ``bands`` unset they
+are left for ``flask find-duplicates --rebuild`` to fill.
+"""
+import csv
+import io
+import json
+from collections import Counter
+
+from sqlalchemy import exists, func, select
+
+from models import (db, add_question_bands, bump_question_counts,
+                    notify_change, question_signature, similarity, Question,
+                    QuestionBand, Category)
+from .validation import QUESTION_FIELDS, parse_question
+
+BATCH_SIZE = 1000
+
+# only the first errors are echoed back so a bad upload cannot make the
+# response as large as the upload itself
+MAX_REPORTED_ERRORS = 100
+
+CSV_TYPES = ('text/csv', 'application/csv')
+
+
+def _ndjson_records(stream):
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as error:
+            yield number, ValueError(f'invalid JSON: {error}')
+
+
+def _is_utf8(record):
+    texts = [text for pair in record.items() for text in pair
+             if isinstance(text, str)]
+    try:
+        ''.join(texts).encode('utf-8')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _csv_records(stream):
+    # undecodable bytes are kept as lone surrogates so that only the rows
+    # they are in are rejected, not the whole upload
+    lines = (line.decode('utf-8', 'surrogateescape') for line in stream)
+    reader = csv.DictReader(lines)
+    for record in reader:
+        if _is_utf8(record):
+            yield reader.line_num, record
+        else:
+            yield reader.line_num, ValueError('invalid UTF-8')
+
+
+def records(stream, content_type):
+    """(line number, record) pairs from an NDJSON or CSV byte stream."""
+    if content_type in CSV_TYPES:
+        return _csv_records(stream)
+    return _ndjson_records(stream)
+
+
+def _describe(error):
+    message = str(getattr(error, 'orig', error)).strip()
+    return message.splitlines()[0] if message else type(error).__name__
+
+
+class BulkImport:
+    """Validates and writes one uploaded stream of questions."""
+
+    def __init__(self, batch_size=BATCH_SIZE, duplicates=None,
+                 reject=False, bands=True):
+        self.batch_size = batch_size
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+        self.duplicates = []
+        self._finder = duplicates
+        self._reject = reject
+        self._bands = bands
+        self._categories = {
+            category_id for category_id, in db.session.query(Category.id)}
+        self._copy = db.engine.dialect.name == 'postgresql'
+        # rows above this id without buckets were written by this import
+        self._after = db.session.query(
+            func.coalesce(func.max(Question.id), 0)).scalar()
+
+    def _error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def _copy_rows(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for _, values in rows:
+            writer.writerow([values[key] for key in QUESTION_FIELDS])
+        buffer.seek(0)
+
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                    Question.__tablename__, ', '.join(QUESTION_FIELDS)),
+                buffer)
+        finally:
+            cursor.close()
+
+    def _insert_rows(self, rows):
+        if self._copy:
+            self._copy_rows(rows)
+        else:
+            db.session.execute(Question.__table__.insert().values(
+                [values for _, values in rows]))
+        if not self._bands:
+            return self._after
+
+        # copied rows have no ids to hand, so find them; rows other
+        # writers added meanwhile have their buckets already
+        questions, bands = Question.__table__, QuestionBand.__table__
+        written = db.session.execute(
+            select([questions.c.id, questions.c.question])
+            .where(questions.c.id > self._after)
+            .where(~exists().where(bands.c.question_id == questions.c.id))
+        ).fetchall()
+        add_question_bands(written)
+        return max((question_id for question_id, _ in written),
+                   default=self._after)
+
+    def _duplicate(self, line, duplicate_of):
+        if self._reject:
+            self._error(line, f'duplicate of {duplicate_of}')
+            return True
+        if len(self.duplicates) < MAX_REPORTED_ERRORS:
+            self.duplicates.append({'line': line,
+                                    'duplicate_of': duplicate_of})
+        return False
+
+    def _screen(self, rows):
+        """The rows of a batch to write, near-duplicates reported."""
+        if self._finder is None:
+            return rows
+        texts = [values['question'] for _, values in rows]
+        matches = self._finder.match(texts)
+        kept, earlier = [], {}
+        for (line, values), found in zip(rows, matches):
+            shingles, buckets = question_signature(values['question'])
+            if found:
+                if self._duplicate(line, f"question {found[0]['id']}"):
+                    continue
+            else:
+                previous = {other for bucket in buckets
+                            for other in earlier.get(bucket, ())}
+                twin = min((other for other, other_shingles in previous
+                            if similarity(shingles, other_shingles) >=
+                            self._finder.threshold), default=None)
+                if twin is not None and self._duplicate(
+                        line, f'line {twin}'):
+                    continue
+            for bucket in buckets:
+                earlier.setdefault(bucket, []).append((line, shingles))
+            kept.append((line, values))
+        return kept
+
+    def _flush(self, rows):
+        if not rows:
+            return
+        try:
+            after = self._insert_rows(rows)
+            bump_question_counts(Counter(
+                (values['category'], values['difficulty'])
+                for _, values in rows))
+            db.session.commit()
+            self.inserted += len(rows)
+            self._after = after
+        except Exception as error:
+            db.session.rollback()
+            if len(rows) == 1:
+                self._error(rows[0][0], _describe(error))
+            else:
+                for row in rows:
+                    self._flush([row])
+
+    def run(self, records):
+        try:
+            self._run(records)
+        finally:
+            if self.inserted:
+                # ids of copied rows are not known, so in-process indexes
+                # over the questions table rebuild themselves on next use;
+                # told once per import, as rebuilding the shared pool reads
+                # the whole table
+                notify_change(Question.__tablename__, 'invalidate', [])
+
+    def _run(self, records):
+        batch = []
+        for line, record in records:
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                values = parse_question(record)
+                if values['category'] not in self._categories:
+                    raise ValueError('unknown category')
+            except ValueError as error:
+                self._error(line, str(error))
+                continue
+
+            batch.append((line, values))
+            if len(batch) >= self.batch_size:
+                self._flush(self._screen(batch))
+                batch = []
+        self._flush(self._screen(batch))
+
+    def report(self):
+        report = {
+            'inserted': self.inserted,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
+        if self._finder is not None and not self._reject:
+            report['duplicates'] = self.duplicates
+        return report
@@ -0,0 +1,159 @@
+"""
+Versioned caching and conditional GET.
+
+``TableVersions`` keeps a counter per table that the model change
+listeners bump on every write. Cached data is stored together with the
+versions it was built from, and the validators attached by
+``conditional`` are derived from the versions, so a request carrying a
+matching ``If-None-Match`` (or a recent enough ``If-Modified-Since``) is
+answered with 304 before the view, and the database, is reached.
+Last-Modified only reflects this process's own writes, so
+``If-Modified-Since`` is not trusted where the ETag also depends on
+something else - an expiry ``window`` or ``extra`` values that follow
+writes made by other workers - and such requests run the view.
+
+Versions live in the process: ETags include a per-process epoch so a
+validator issued by one worker is never mistaken for another's. Views
+whose data other workers write pass ``extra`` values read from shared
+state, such as the stored question counts or the leaderboard, so those
+writes change the ETag too; ``window`` seconds, when set, also expire
+validators, bounding how long any other change goes unseen.
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+import weakref
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import Response, make_response, request
+
+from models import Category
+
+
+_instances = weakref.WeakSet()
+
+
+def _after_fork():
+    # workers forked from one preloaded app would otherwise share an epoch
+    # while counting their writes separately
+    for versions in list(_instances):
+        versions.epoch = uuid.uuid4().hex[:8]
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class TableVersions:
+    """Per-table write counters and last-modified times."""
+
+    def __init__(self, window=None):
+        self.window = window
+        self.epoch = uuid.uuid4().hex[:8]
+        _instances.add(self)
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._modified = {}
+
+    def on_change(self, table, action, rows):
+        with self._lock:
+            self._versions[table] = self._versions.get(table, 0) + 1
+            self._modified[table] = time.time()
+
+    def get(self, table):
+        return self._versions.get(table, 0)
+
+    def last_modified(self, tables):
+        modified = max(
+            [self._modified.get(table, self._started) for table in tables])
+        # HTTP dates have one second resolution
+        return datetime.fromtimestamp(int(modified), timezone.utc)
+
+    def etag(self, key, tables, extra=()):
+        parts = [self.epoch, key]
+        parts.extend(f'{table}:{self.get(table)}' for table in tables)
+        parts.extend(str(value) for value in extra)
+        if self.window:
+            parts.append(str(int(time.time() // self.window)))
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+
+class CategoryCache:
+    """Formatted category list, rebuilt when the categories table changes."""
+
+    def __init__(self, versions):
+        self.versions = versions
+        self._cached = (None, None)
+
+    def cached(self):
+        """The category list if it is current, without loading it."""
+        cached_version, categories = self._cached
+        if cached_version != self.versions.get(Category.__tablename__):
+            return None
+        return categories
+
+    def all(self):
+        version = self.versions.get(Category.__tablename__)
+        cached_version, categories = self._cached
+        if cached_version != version:
+            categories = [category.format()
+                          for category in Category.query.order_by(Category.id)]
+            self._cached = (version, categories)
+        return categories
+
+
+# compressed representations carry the base ETag with this suffix
+ENCODING_SUFFIXES = ['', '-gzip', '-br']
+
+
+def not_modified(etag, last_modified, dated=True):
+    """
+    The validator the client already holds, or None if it is stale;
+    ``If-Modified-Since`` is only considered when ``dated``.
+    """
+    if request.if_none_match:
+        for suffix in ENCODING_SUFFIXES:
+            if request.if_none_match.contains(etag + suffix):
+                return etag + suffix
+        return None
+    since = request.if_modified_since
+    if dated and since is not None and last_modified <= since:
+        return etag
+    return None
+
+
+def conditional(versions, tables, extra=None):
+    """
+    Attach ETag and Last-Modified to successful responses of the view and
+    answer matching conditional requests with 304 without running it.
+    ``tables`` may be a function of the request returning the tables, and
+    ``extra`` may return more values the response depends on.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.full_path
+            names = tables(request) if callable(tables) else tables
+            values = tuple(extra()) if extra else ()
+            etag = versions.etag(key, names, values)
+            last_modified = versions.last_modified(names)
+
+            # the date cannot tell what the window or extra values do
+            current = not_modified(etag, last_modified,
+                                   dated=not values and not versions.window)
+            if current is not None:
+                response = Response(status=304)
+                etag = current
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,78 @@
+"""
+Question counts.
+
+Totals come from the ``question_counts`` table the models keep in step
+with every write to ``questions``, so counting a listing reads a handful
+of rows whatever the size of the table. ``flask reconcile-counts``
+recounts from ``questions`` and repairs any drift, e.g. after rows were
+changed with plain SQL.
+
+The same rows, with the highest question id, make a validator every
+worker computes alike: it changes whenever a question is added, deleted
+or moved to another category or difficulty, whichever process wrote it.
+"""
+import sys
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from models import db, reconcile_question_counts, QuestionCount
+
+# shared with the asyncpg paths, which must produce the same validator
+VERSION_QUERIES = (
+    'SELECT max(id) FROM questions',
+    'SELECT category, difficulty, count FROM question_counts '
+    'ORDER BY category, difficulty',
+)
+
+
+def category_counts():
+    """
+    {category id: {"total_questions": n, "difficulties": {difficulty: n}}}
+    from the stored counts; difficulties are strings, as JSON keys are.
+    """
+    counts = {}
+    for row in QuestionCount.query.filter(QuestionCount.count > 0):
+        entry = counts.setdefault(
+            row.category, {"total_questions": 0, "difficulties": {}})
+        entry["total_questions"] += row.count
+        entry["difficulties"][str(row.difficulty)] = row.count
+    return counts
+
+
+def version_values(top, rows):
+    return [top] + ['{}:{}:{}'.format(*row) for row in rows]
+
+
+def questions_version():
+    """Values that change with the questions' ids, categories and levels."""
+    top_query, rows_query = VERSION_QUERIES
+    return version_values(db.session.execute(text(top_query)).scalar(),
+                          db.session.execute(text(rows_query)).fetchall())
+
+
+@click.command('reconcile-counts')
+@click.option('--check', is_flag=True,
+              help='only report drift, and exit with status 1 if any')
+@with_appcontext
+def reconcile_counts_command(check):
+    """Recount questions per category and difficulty and fix drift."""
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    try:
+        drift = reconcile_question_counts(connection)
+        if check:
+            transaction.rollback()
+        else:
+            transaction.commit()
+    finally:
+        connection.close()
+
+    for (category, difficulty), (stored, actual) in sorted(drift.items()):
+        click.echo(f'category {category} difficulty {difficulty}: '
+                   f'{stored} -> {actual}')
+    if not drift:
+        click.echo('counts are correct')
+    elif check:
+        sys.exit(1)
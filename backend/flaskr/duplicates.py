@@ -0,0 +1,189 @@
+"""
+Near-duplicate questions.
+
+Every question has its MinHash buckets stored in ``question_bands`` (see
+``models``): questions whose shingle sets are similar share a bucket with
+high probability, so the candidates for a new question are the rows
+sharing one of its buckets, found through the bucket index, and only
+those are compared with it. ``DuplicateFinder`` does this for the texts
+about to be inserted by ``POST /questions`` and the bulk import, and
+``flask find-duplicates`` clusters the whole bank the same way: rows of
+``question_bands`` are read in bucket order, members of a bucket become
+candidate pairs and the pairs whose similarity reaches the threshold are
+joined into clusters, without comparing every question with every other.
+"""
+import json
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from models import (db, question_shingles, question_signature,
+                    rebuild_question_bands, similarity, Question, QuestionBand)
+
+POLICIES = ('warn', 'reject', 'allow')
+POLICY = 'warn'
+THRESHOLD = 0.8
+
+# duplicates reported per question
+MAX_MATCHES = 5
+
+# bucket keys or question ids per IN list
+CHUNK_SIZE = 500
+
+# members of a bucket compared pairwise; in a larger bucket, e.g. one
+# filled with boilerplate questions, each is only compared with the first
+MAX_PAIRWISE = 100
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _texts(ids):
+    texts = {}
+    for chunk in _chunks(ids):
+        texts.update(db.session.query(Question.id, Question.question)
+                     .filter(Question.id.in_(chunk)))
+    return texts
+
+
+class DuplicateFinder:
+    """Looks up the stored questions similar to new question texts."""
+
+    def __init__(self, threshold=THRESHOLD):
+        self.threshold = threshold
+
+    def match(self, texts):
+        """
+        For each of the question ``texts``, in order, the stored questions
+        at least ``threshold`` similar to it, as {id, question, similarity}
+        dicts, most similar first.
+        """
+        signatures = [question_signature(value) for value in texts]
+        wanted = {bucket for _, buckets in signatures for bucket in buckets}
+        members = {}
+        for chunk in _chunks(wanted):
+            for bucket, question_id in db.session.query(
+                    QuestionBand.bucket, QuestionBand.question_id).filter(
+                    QuestionBand.bucket.in_(chunk)):
+                members.setdefault(bucket, set()).add(question_id)
+        stored = _texts(set().union(*members.values()) if members else ())
+
+        matches = []
+        for shingles, buckets in signatures:
+            found = []
+            for question_id in set().union(
+                    *(members.get(bucket, ()) for bucket in buckets)):
+                if question_id not in stored:
+                    # left behind by a question deleted with plain SQL
+                    continue
+                score = similarity(shingles, question_signature(
+                    stored[question_id])[0])
+                if score >= self.threshold:
+                    found.append({'id': question_id,
+                                  'question': stored[question_id],
+                                  'similarity': round(score, 3)})
+            found.sort(key=lambda match: (-match['similarity'], match['id']))
+            matches.append(found[:MAX_MATCHES])
+        return matches
+
+
+class _Clusters:
+    """Union-find over question ids."""
+
+    def __init__(self):
+        self._parent = {}
+
+    def find(self, question_id):
+        root = self._parent.setdefault(question_id, question_id)
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while question_id != root:
+            parent = self._parent[question_id]
+            self._parent[question_id] = root
+            question_id = parent
+        return root
+
+    def join(self, one, other):
+        one, other = self.find(one), self.find(other)
+        if one != other:
+            self._parent[max(one, other)] = min(one, other)
+
+    def groups(self):
+        groups = {}
+        for question_id in self._parent:
+            groups.setdefault(self.find(question_id), []).append(question_id)
+        return sorted(sorted(ids) for ids in groups.values() if len(ids) > 1)
+
+
+def _candidate_pairs(connection):
+    bands = QuestionBand.__table__
+    rows = connection.execution_options(stream_results=True).execute(
+        select([bands.c.bucket, bands.c.question_id])
+        .order_by(bands.c.bucket, bands.c.question_id))
+    pairs, bucket, members = set(), None, []
+
+    def close(members):
+        if len(members) > MAX_PAIRWISE:
+            pairs.update((members[0], other) for other in members[1:])
+            return
+        for i, one in enumerate(members):
+            pairs.update((one, other) for other in members[i + 1:])
+
+    for key, question_id in rows:
+        if key != bucket:
+            close(members)
+            bucket, members = key, []
+        members.append(question_id)
+    close(members)
+    return pairs
+
+
+def find_clusters(connection, threshold=THRESHOLD):
+    """
+    Clusters of near-duplicate question ids, each sorted, as a sorted list;
+    questions with no near-duplicate are left out.
+    """
+    pairs = _candidate_pairs(connection)
+    shingles = {question_id: question_shingles(value)
+                for question_id, value in _texts(
+                    {question_id for pair in pairs for question_id in pair}
+                ).items()}
+    clusters = _Clusters()
+    for one, other in pairs:
+        if one in shingles and other in shingles and similarity(
+                shingles[one], shingles[other]) >= threshold:
+            clusters.join(one, other)
+    return clusters.groups()
+
+
+@click.command('find-duplicates')
+@click.option('--threshold', type=float, default=THRESHOLD,
+              show_default=True, help='similarity of near-duplicates')
+@click.option('--rebuild', is_flag=True,
+              help='recompute the stored buckets of every question first')
+@click.option('--json', 'as_json', is_flag=True,
+              help='print the clusters as one JSON list of id lists')
+@with_appcontext
+def find_duplicates_command(threshold, rebuild, as_json):
+    """List clusters of near-duplicate questions."""
+    if rebuild:
+        with db.engine.begin() as connection:
+            total = rebuild_question_bands(connection)
+        click.echo(f'buckets rebuilt for {total} questions', err=True)
+
+    with db.engine.connect() as connection:
+        clusters = find_clusters(connection, threshold)
+
+    if as_json:
+        click.echo(json.dumps(clusters))
+        return
+    texts = _texts(ids[0] for ids in clusters)
+    for ids in clusters:
+        click.echo('{}: {}'.format(
+            ', '.join(map(str, ids)), texts.get(ids[0], '')))
+    click.echo(f'{len(clusters)} clusters, '
+               f'{sum(map(len, clusters))} questions', err=True)
@@ -0,0 +1,176 @@
+"""
+Response encoding.
+
+``jsonify`` builds JSON responses with the fastest available encoder
+(orjson when it is installed, the standard library otherwise) and lets
+payloads embed ``RawJSON`` fragments that are copied into the output as
+they are. ``FragmentCache`` keeps the encoded form of rows so list pages
+are assembled by concatenating cached bytes, and ``compress`` gzips (or
+brotli-compresses) large enough responses for clients that accept it.
+Keys are sorted as Flask's own ``jsonify`` does, so responses decode to
+the same documents as before.
+"""
+import gzip
+import json
+import threading
+
+from flask import current_app, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024
+COMPRESS_LEVEL = 6
+MAX_FRAGMENTS = 100000
+
+_stdlib_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+
+def _stdlib_dumps(value):
+    return _stdlib_encoder.encode(value).encode()
+
+
+def _orjson_dumps(value):
+    return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+
+
+BACKENDS = {'json': _stdlib_dumps}
+if orjson is not None:
+    BACKENDS['orjson'] = _orjson_dumps
+
+DEFAULT_BACKEND = 'orjson' if orjson is not None else 'json'
+dumps = BACKENDS[DEFAULT_BACKEND]
+
+
+def use_backend(name):
+    """Select the JSON encoder by name, e.g. from the JSON_BACKEND option."""
+    global dumps
+    if name not in BACKENDS:
+        raise ValueError(f'JSON backend {name!r} is not available')
+    dumps = BACKENDS[name]
+
+
+class RawJSON(bytes):
+    """Already encoded JSON, embedded into a payload without re-encoding."""
+
+
+def _encode_list(values):
+    return b'[' + b','.join(
+        value if isinstance(value, RawJSON) else dumps(value)
+        for value in values) + b']'
+
+
+def encode(payload):
+    """
+    Encode a payload whose top-level values may be RawJSON or lists
+    holding RawJSON; anything deeper is left to the encoder.
+    """
+    if isinstance(payload, RawJSON):
+        return payload
+    if not isinstance(payload, dict):
+        return dumps(payload)
+
+    parts = []
+    for key in sorted(payload):
+        value = payload[key]
+        if isinstance(value, RawJSON):
+            encoded = value
+        elif isinstance(value, list) and \
+                any(isinstance(item, RawJSON) for item in value):
+            encoded = _encode_list(value)
+        else:
+            encoded = dumps(value)
+        parts.append(dumps(key) + b':' + encoded)
+    return b'{' + b','.join(parts) + b'}'
+
+
+def jsonify(payload):
+    return current_app.response_class(
+        encode(payload), mimetype='application/json')
+
+
+class FragmentCache:
+    """
+    Encoded rows keyed by table and content. Rows that are updated or
+    deleted through the models are dropped, and the cache is emptied when
+    it reaches ``max_entries``.
+    """
+
+    def __init__(self, max_entries=MAX_FRAGMENTS):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._fragments = {}
+        self._keys = {}
+
+    def rows(self, table, rows):
+        """Replace formatted rows by their cached encoded fragments."""
+        fragments = []
+        for row in rows:
+            # a row cut down to some fields is cached apart from the whole
+            key = (table,) + tuple(row.items())
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                fragment = RawJSON(dumps(row))
+                with self._lock:
+                    if len(self._fragments) >= self.max_entries:
+                        self._fragments.clear()
+                        self._keys.clear()
+                    self._fragments[key] = fragment
+                    self._keys.setdefault((table, row['id']), set()).add(key)
+            fragments.append(fragment)
+        return fragments
+
+    def _drop(self, row_key):
+        for key in self._keys.pop(row_key, ()):
+            self._fragments.pop(key, None)
+
+    def on_change(self, table, action, rows):
+        if action == 'insert':
+            return
+        with self._lock:
+            if action == 'invalidate':
+                for key in [key for key in self._keys if key[0] == table]:
+                    self._drop(key)
+                return
+            for row in rows:
+                self._drop((table, row['id']))
+
+
+def _choose_encoding():
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def compress(response, min_size=MIN_COMPRESS_SIZE, level=COMPRESS_LEVEL):
+    """Compress a buffered JSON response if the client accepts it."""
+    if response.direct_passthrough or response.is_streamed or \
+            response.status_code != 200 or \
+            response.mimetype != 'application/json' or \
+            'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = _choose_encoding()
+    data = response.get_data()
+    if encoding is None or len(data) < min_size:
+        return response
+
+    if encoding == 'br':
+        data = brotli.compress(data, quality=min(level, 11))
+    else:
+        data = gzip.compress(data, compresslevel=level)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+
+    # a strong validator names one exact representation
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
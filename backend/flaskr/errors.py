@@ -0,0 +1,17 @@
+"""
+Error response bodies shared by every entry point of the API.
+"""
+
+ERROR_MESSAGES = {
+    400: "bad request",
+    404: "resource not found",
+    405: "method not allowed",
+    409: "conflict",
+    422: "unprocessable",
+    500: "internal server error",
+    503: "service unavailable",
+}
+
+
+def error_payload(code):
+    return {"success": False, "error": code, "message": ERROR_MESSAGES[code]}
@@ -0,0 +1,64 @@
+"""
+Sparse fieldsets.
+
+``fields=id,question`` limits the rows of a listing to the named fields
+and ``include=categories`` adds the category list to a response. Rows
+read from the database select only the requested columns, so the others
+are neither loaded nor encoded, and rows served from memory are cut down
+before they are encoded. ``id`` is always sent, as cursors, caches and
+clients key on it. Without ``fields`` rows are sent whole, and
+``GET /questions`` keeps sending the categories unless ``include`` is
+given.
+"""
+FIELDS = {
+    'questions': ('id', 'question', 'answer', 'category', 'difficulty'),
+    'leaderboard': ('id', 'player', 'score'),
+}
+
+INCLUDES = ('categories',)
+
+
+def _names(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def requested_fields(args, table):
+    """
+    The fields of ``table`` rows asked for in the query ``args``, in table
+    order, or all of them; raises ValueError for an unknown field.
+    """
+    value = args.get('fields')
+    if value is None:
+        return FIELDS[table]
+    names = _names(value)
+    unknown = names - set(FIELDS[table])
+    if unknown:
+        raise ValueError('unknown fields: ' + ', '.join(sorted(unknown)))
+    names.add('id')
+    return tuple(name for name in FIELDS[table] if name in names)
+
+
+def requested_includes(args, default=()):
+    """
+    The related resources asked for in the query ``args``, ``default``
+    when there is no ``include``; raises ValueError for an unknown one.
+    """
+    value = args.get('include')
+    if value is None:
+        return set(default)
+    names = _names(value)
+    if names - set(INCLUDES):
+        raise ValueError('unknown include')
+    return names
+
+
+def columns(model, fields):
+    """The model's columns for ``fields``, to select only those."""
+    return [getattr(model, name) for name in fields]
+
+
+def project(rows, fields, table):
+    """Formatted ``rows`` cut down to ``fields``; whole rows pass as is."""
+    if fields == FIELDS[table]:
+        return rows
+    return [{name: row[name] for name in fields} for row in rows]
@@ -0,0 +1,252 @@
+"""
+Ranked leaderboard.
+
+``RankedLeaderboard`` mirrors the ``leaderboard`` table as an array of
+(-score, id) keys kept in sorted order, so the highest scores come first
+and ties go to the earlier submission. A page of the board is a slice of
+that array and the rank of a score or an entry is a binary search; the
+database stays the source of truth: the board is loaded from it on first
+use, follows inserts made by this process through the model change
+listeners and, every ``refresh_interval`` seconds, picks up rows other
+processes have added since.
+
+``WindowedBoards`` serves the best entries of the current day, week and
+of all time from the ``leaderboard_rollups`` table the models keep up to
+date on every submission, so those boards never read the leaderboard
+table; ``flask leaderboard-rollups`` compacts or rebuilds the rollups.
+"""
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+
+import click
+from flask import abort, current_app
+from flask.cli import with_appcontext
+
+from models import (db, compact_rollups, rebuild_rollups, rollup_period,
+                    Leaderboard, LeaderboardRollup, ROLLUP_KEEP_DAYS,
+                    ROLLUP_KEEP_WEEKS, ROLLUP_TOP_N)
+from .pagination import QUESTIONS_PER_PAGE, encode_cursor, decode_cursor
+
+REFRESH_INTERVAL = 5
+
+# ids handed out by concurrent transactions can commit out of order, so
+# catching up re-reads this many ids below the highest one already seen
+CATCH_UP_WINDOW = 100
+
+
+class RankedLeaderboard:
+    """Sorted in-memory view of the leaderboard table."""
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._keys = None
+        self._entries = {}
+        self._max_id = 0
+        self._checked_at = 0
+
+    def _add(self, entry_id, player, score):
+        if entry_id in self._entries:
+            return
+        insort(self._keys, (-score, entry_id))
+        self._entries[entry_id] = (player, score)
+        self._max_id = max(self._max_id, entry_id)
+
+    def _load(self, since=None):
+        rows = db.session.query(
+            Leaderboard.id, Leaderboard.player, Leaderboard.score)
+        if since is not None:
+            rows = rows.filter(Leaderboard.id > since)
+        return rows.order_by(Leaderboard.id).yield_per(10000)
+
+    def _sync(self):
+        """Load the board, or catch up with other writers once stale."""
+        now = time.monotonic()
+        with self._lock:
+            if self._keys is None:
+                self._keys, self._entries, self._max_id = [], {}, 0
+                since = None
+            elif now - self._checked_at >= self.refresh_interval:
+                since = self._max_id - CATCH_UP_WINDOW
+            else:
+                return
+            self._checked_at = now
+            for entry_id, player, score in self._load(since):
+                self._add(entry_id, player, score or 0)
+
+    def on_change(self, table, action, rows):
+        if table != Leaderboard.__tablename__:
+            return
+        with self._lock:
+            if action == 'invalidate':
+                self._keys = None
+            if self._keys is None or action != 'insert':
+                return
+            for row in rows:
+                self._add(row['id'], row['player'], row['score'] or 0)
+
+    def _format(self, key):
+        entry_id = key[1]
+        player, score = self._entries[entry_id]
+        return {
+            'id': entry_id,
+            'player': player,
+            'score': score,
+        }
+
+    @property
+    def fresh(self):
+        """Whether reads can be served without going to the database."""
+        return self._keys is not None and \
+            time.monotonic() - self._checked_at < self.refresh_interval
+
+    def warm(self):
+        """Load the board now rather than on the first request."""
+        return len(self)
+
+    def validator(self):
+        """Values that change whenever the board does."""
+        self._sync()
+        return len(self._keys), self._max_id
+
+    def __len__(self):
+        self._sync()
+        return len(self._keys)
+
+    def page(self, request, per_page=QUESTIONS_PER_PAGE):
+        """
+        The entries on the page the request asks for, taking the same
+        ``page``, ``after`` and ``cursor`` arguments as the database
+        paginated listings, and the cursor of the next page.
+        """
+        self._sync()
+        token = request.args.get('cursor')
+        after = request.args.get('after', None, type=int)
+
+        with self._lock:
+            if token:
+                try:
+                    values = decode_cursor(token, [int, int])
+                    start = bisect_right(
+                        self._keys, (-values[0], values[1]))
+                except ValueError:
+                    abort(400)
+            elif after is not None:
+                if after not in self._entries:
+                    abort(400)
+                score = self._entries[after][1]
+                start = bisect_right(self._keys, (-score, after))
+            else:
+                page = request.args.get('page', 1, type=int)
+                if page < 1:
+                    return [], None
+                start = (page - 1) * per_page
+
+            keys = self._keys[start:start + per_page + 1]
+            results = [self._format(key) for key in keys[:per_page]]
+
+        next_cursor = None
+        if len(keys) > per_page:
+            last = results[-1]
+            next_cursor = encode_cursor([last['score'], last['id']])
+        return results, next_cursor
+
+    def rank_of_score(self, score):
+        """1-based rank a submission with ``score`` would place at."""
+        self._sync()
+        with self._lock:
+            return bisect_left(self._keys, (-score,)) + 1
+
+    def rank_of_entry(self, entry_id):
+        """1-based position of the entry on the board and the entry."""
+        self._sync()
+        with self._lock:
+            if entry_id not in self._entries:
+                return None, None
+            score = self._entries[entry_id][1]
+            key = (-score, entry_id)
+            return bisect_left(self._keys, key) + 1, self._format(key)
+
+
+class WindowedBoards:
+    """
+    The top entries of each span's current period, read from the rollups
+    and kept for ``refresh_interval`` seconds or until this process adds
+    an entry.
+    """
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL, top=ROLLUP_TOP_N):
+        self.refresh_interval = refresh_interval
+        self.top = top
+        self._lock = threading.Lock()
+        # span: (period, loaded at, entries)
+        self._boards = {}
+
+    def on_change(self, table, action, rows):
+        if table == Leaderboard.__tablename__:
+            with self._lock:
+                self._boards.clear()
+
+    def cached(self, span):
+        """The (period, entries) of a span if they are fresh, else None."""
+        board = self._boards.get(span)
+        if board is None:
+            return None
+        period, loaded_at, entries = board
+        if period != rollup_period(span, datetime.utcnow()) or \
+                time.monotonic() - loaded_at >= self.refresh_interval:
+            return None
+        return period, entries
+
+    def board(self, span):
+        """The current period of ``span`` and its entries, best first."""
+        cached = self.cached(span)
+        if cached is not None:
+            return cached
+        period = rollup_period(span, datetime.utcnow())
+        loaded_at = time.monotonic()
+        entries = [
+            {'id': entry_id, 'player': player, 'score': score}
+            for entry_id, player, score in db.session.query(
+                LeaderboardRollup.entry_id, LeaderboardRollup.player,
+                LeaderboardRollup.score).filter(
+                    LeaderboardRollup.span == span,
+                    LeaderboardRollup.period == period).order_by(
+                        LeaderboardRollup.score.desc(),
+                        LeaderboardRollup.entry_id).limit(self.top)]
+        with self._lock:
+            self._boards[span] = (period, loaded_at, entries)
+        return period, entries
+
+    def validator(self, span, board=None):
+        """
+        Values that change whenever the span's board does; ``board`` is
+        the (period, entries) if they have been read already.
+        """
+        period, entries = board or self.board(span)
+        return [period.isoformat()] + [entry['id'] for entry in entries]
+
+
+@click.command('leaderboard-rollups')
+@click.option('--rebuild', is_flag=True,
+              help='recompute every rollup from the leaderboard table')
+@with_appcontext
+def leaderboard_rollups_command(rebuild):
+    """Compact expired leaderboard rollups, or rebuild them all."""
+    config = current_app.config
+    keep_days = config.get('LEADERBOARD_KEEP_DAYS', ROLLUP_KEEP_DAYS)
+    keep_weeks = config.get('LEADERBOARD_KEEP_WEEKS', ROLLUP_KEEP_WEEKS)
+    today = datetime.utcnow().date()
+    with db.engine.begin() as connection:
+        if rebuild:
+            written = rebuild_rollups(
+                connection, today,
+                config.get('LEADERBOARD_TOP_N', ROLLUP_TOP_N),
+                keep_days, keep_weeks)
+            click.echo(f'{written} rollup entries written')
+        else:
+            deleted = compact_rollups(
+                connection, today, keep_days, keep_weeks)
+            click.echo(f'{deleted} expired rollup entries deleted')
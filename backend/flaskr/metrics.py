@@ -0,0 +1,204 @@
+"""
+Request and SQL instrumentation.
+
+``Metrics`` hooks the Flask request lifecycle and the SQLAlchemy engine
+events to record, per route and method, a latency histogram, response
+status counts, SQL statements issued, time spent in the database, rows
+returned and response bytes. ``render`` writes them out in the
+Prometheus text format, and with ``server_timing`` each response also
+carries a ``Server-Timing`` header with its own database and total time.
+
+Per-request figures are kept on ``g`` and folded into the totals under a
+lock once per request, so the cost per statement is a couple of clock
+reads. Rows returned are counted from the driver's row count, which
+SQLite does not report for queries.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+# requests that matched no route share one label, so scanning for random
+# URLs cannot grow the number of series without bound
+UNMATCHED = '<unmatched>'
+
+
+class _RequestStats:
+
+    __slots__ = ('started', 'queries', 'db_seconds', 'rows')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+
+
+class _RouteStats:
+
+    __slots__ = ('buckets', 'count', 'seconds', 'statuses', 'queries',
+                 'db_seconds', 'rows', 'bytes')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.statuses = {}
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if has_request_context() and 'trivia_request' in g:
+        conn.info['trivia_query_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info.pop('trivia_query_started', None)
+    if started is None or not has_request_context():
+        return
+    stats = g.get('trivia_request')
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.db_seconds += time.perf_counter() - started
+    if cursor.description is not None and cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+
+
+_listening = False
+
+
+def _listen():
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in labels.items()) + '}'
+
+
+class Metrics:
+    """Per-route request, latency and SQL totals."""
+
+    def __init__(self, server_timing=False):
+        self.server_timing = server_timing
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def install(self, app):
+        """
+        Hook the app's request lifecycle. Hooks registered on ``app`` before
+        this run inside the measurement; those registered after, outside.
+        """
+        _listen()
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        g.trivia_request = _RequestStats()
+
+    def _after_request(self, response):
+        stats = g.pop('trivia_request', None)
+        if stats is None:
+            return response
+        rule = request.url_rule
+        elapsed = time.perf_counter() - stats.started
+        self.observe(rule.rule if rule is not None else UNMATCHED,
+                     request.method, response.status_code, elapsed,
+                     response.content_length or 0, stats.queries,
+                     stats.db_seconds, stats.rows)
+        if self.server_timing:
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={stats.db_seconds * 1000:.2f};'
+                f'desc="{stats.queries} queries", '
+                f'app;dur={elapsed * 1000:.2f}')
+        return response
+
+    def observe(self, route, method, status, seconds, size=0, queries=0,
+                db_seconds=0.0, rows=0):
+        """Record one finished request."""
+        key = (route, method)
+        with self._lock:
+            stats = self._routes.get(key)
+            if stats is None:
+                stats = self._routes[key] = _RouteStats()
+            stats.buckets[bisect_left(BUCKETS, seconds)] += 1
+            stats.count += 1
+            stats.seconds += seconds
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.queries += queries
+            stats.db_seconds += db_seconds
+            stats.rows += rows
+            stats.bytes += size
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted(
+                (route, method, dict(stats.statuses), list(stats.buckets),
+                 stats.count, stats.seconds, stats.queries, stats.db_seconds,
+                 stats.rows, stats.bytes)
+                for (route, method), stats in self._routes.items())
+
+    def render(self):
+        """The totals in the Prometheus text exposition format."""
+        routes = self._snapshot()
+        lines = [
+            '# HELP trivia_http_requests_total Requests handled.',
+            '# TYPE trivia_http_requests_total counter',
+        ]
+        for route, method, statuses, *_ in routes:
+            for status, count in sorted(statuses.items()):
+                lines.append('trivia_http_requests_total' + _labels(
+                    route=route, method=method, status=status) + f' {count}')
+
+        name = 'trivia_http_request_duration_seconds'
+        lines += [
+            f'# HELP {name} Request latency.',
+            f'# TYPE {name} histogram',
+        ]
+        for route, method, _, buckets, count, seconds, *_ in routes:
+            cumulative = 0
+            for bound, observed in zip(BUCKETS + ('+Inf',), buckets):
+                cumulative += observed
+                lines.append(f'{name}_bucket' + _labels(
+                    route=route, method=method, le=bound) + f' {cumulative}')
+            labels = _labels(route=route, method=method)
+            lines.append(f'{name}_sum{labels} {seconds}')
+            lines.append(f'{name}_count{labels} {count}')
+
+        for index, name, text in [
+                (6, 'trivia_db_queries_total', 'SQL statements issued.'),
+                (7, 'trivia_db_seconds_total', 'Time spent executing SQL.'),
+                (8, 'trivia_db_rows_total', 'Rows returned by SQL queries.'),
+                (9, 'trivia_http_response_bytes_total',
+                 'Response body bytes sent.')]:
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} counter')
+            for row in routes:
+                lines.append(name + _labels(route=row[0], method=row[1]) +
+                             f' {row[index]}')
+        return '\n'.join(lines) + '\n'
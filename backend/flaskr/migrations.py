@@ -0,0 +1,223 @@
+"""
+Schema migrations.
+
+``db.create_all()`` only creates missing tables, so changes to existing
+tables are made by the numbered revisions below. ``flask db upgrade``
+applies the ones not yet recorded in the ``schema_migrations`` table, in
+order, and ``flask db status`` lists them.
+
+Revisions are written to run against a live database: indexes are built
+with ``CREATE INDEX CONCURRENTLY`` on Postgres, foreign keys are added
+``NOT VALID`` and validated afterwards so existing rows are checked
+without blocking writes, and every statement gives up after
+``LOCK_TIMEOUT`` instead of queueing traffic behind it. A revision that
+is interrupted can simply be run again; each one checks what already
+exists, so they also pass over databases created from the current models.
+The one exception is a ``questions.category`` column created as text by
+older versions of the models: converting it rewrites the table.
+"""
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table,
+                        inspect, text)
+
+from models import (db, rebuild_question_bands, rebuild_rollups,
+                    reconcile_question_counts, LeaderboardRollup,
+                    QuestionBand, QuestionCount, QuizSession)
+
+LOCK_TIMEOUT = '5s'
+
+_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _metadata,
+    Column('version', String(32), primary_key=True),
+    Column('description', String),
+    Column('applied_at', DateTime),
+)
+
+
+def _postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def _create_index(connection, name, table, columns):
+    if _postgres(connection):
+        valid = connection.execute(text(
+            'SELECT i.indisvalid FROM pg_class c '
+            'JOIN pg_index i ON i.indexrelid = c.oid '
+            'WHERE c.relname = :name AND pg_table_is_visible(c.oid)'),
+            name=name).scalar()
+        if valid:
+            return
+        if valid is not None:
+            # left behind by an interrupted concurrent build
+            connection.execute(text(f'DROP INDEX CONCURRENTLY {name}'))
+        connection.execute(text(
+            f'CREATE INDEX CONCURRENTLY {name} ON {table} ({columns})'))
+    else:
+        connection.execute(text(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})'))
+
+
+def _category_foreign_key(connection):
+    """questions.category as an integer foreign key to categories"""
+    if not _postgres(connection):
+        # SQLite compares the column by value whatever its declared type
+        return
+    inspector = inspect(connection)
+    column = next(column for column in inspector.get_columns('questions')
+                  if column['name'] == 'category')
+    if not isinstance(column['type'], Integer):
+        connection.execute(text(
+            'ALTER TABLE questions ALTER COLUMN category TYPE integer '
+            "USING NULLIF(trim(category), '')::integer"))
+
+    if any(key['constrained_columns'] == ['category']
+           for key in inspector.get_foreign_keys('questions')):
+        return
+    # same rule as ON DELETE SET NULL for rows whose category is gone
+    connection.execute(text(
+        'UPDATE questions SET category = NULL WHERE category IS NOT NULL '
+        'AND category NOT IN (SELECT id FROM categories)'))
+    connection.execute(text(
+        'ALTER TABLE questions ADD CONSTRAINT questions_category_fkey '
+        'FOREIGN KEY (category) REFERENCES categories (id) '
+        'ON UPDATE CASCADE ON DELETE SET NULL NOT VALID'))
+    connection.execute(text(
+        'ALTER TABLE questions VALIDATE CONSTRAINT questions_category_fkey'))
+
+
+def _question_indexes(connection):
+    """indexes on questions.category and (category, difficulty)"""
+    _create_index(connection, 'ix_questions_category', 'questions',
+                  'category, id')
+    _create_index(connection, 'ix_questions_category_difficulty',
+                  'questions', 'category, difficulty')
+
+
+def _leaderboard_score_index(connection):
+    """descending index on leaderboard.score"""
+    _create_index(connection, 'ix_leaderboard_score', 'leaderboard',
+                  'score DESC, id')
+
+
+def _question_counts(connection):
+    """question_counts table, filled from questions"""
+    QuestionCount.__table__.create(connection, checkfirst=True)
+    with connection.engine.begin() as transaction:
+        if _postgres(transaction):
+            transaction.execute(text(
+                f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        reconcile_question_counts(transaction)
+
+
+def _leaderboard_rollups(connection):
+    """leaderboard.created_at and the leaderboard_rollups table"""
+    inspector = inspect(connection)
+    if not any(column['name'] == 'created_at'
+               for column in inspector.get_columns('leaderboard')):
+        # nullable without a default, so adding it does not rewrite the
+        # table; earlier entries only count towards the all-time board
+        column_type = 'timestamp' if _postgres(connection) else 'datetime'
+        connection.execute(text(
+            f'ALTER TABLE leaderboard ADD COLUMN created_at {column_type}'))
+    LeaderboardRollup.__table__.create(connection, checkfirst=True)
+    with connection.engine.begin() as transaction:
+        if _postgres(transaction):
+            transaction.execute(text(
+                f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        rebuild_rollups(transaction)
+
+
+def _question_bands(connection):
+    """question_bands table, filled from questions"""
+    QuestionBand.__table__.create(connection, checkfirst=True)
+    with connection.engine.begin() as transaction:
+        rebuild_question_bands(transaction)
+
+
+def _quiz_sessions(connection):
+    """quiz_sessions table"""
+    QuizSession.__table__.create(connection, checkfirst=True)
+
+
+REVISIONS = [
+    ('0001', _category_foreign_key),
+    ('0002', _question_indexes),
+    ('0003', _leaderboard_score_index),
+    ('0004', _question_counts),
+    ('0005', _leaderboard_rollups),
+    ('0006', _question_bands),
+    ('0007', _quiz_sessions),
+]
+
+
+def _describe(revision):
+    return revision[1].__doc__.strip()
+
+
+def applied(engine):
+    """Versions recorded as applied."""
+    with engine.connect() as connection:
+        if not engine.dialect.has_table(connection, 'schema_migrations'):
+            return set()
+        return {version for version, in connection.execute(
+            schema_migrations.select().with_only_columns(
+                [schema_migrations.c.version]))}
+
+
+def pending(engine):
+    """Revisions not applied yet, in the order they will run."""
+    done = applied(engine)
+    return [revision for revision in REVISIONS if revision[0] not in done]
+
+
+def upgrade(engine, echo=None):
+    """Apply pending revisions; returns their versions."""
+    _metadata.create_all(engine)
+    versions = []
+    for revision in pending(engine):
+        version, migrate = revision
+        if echo is not None:
+            echo(f'{version} {_describe(revision)}')
+        with engine.connect() as connection:
+            connection = connection.execution_options(
+                isolation_level='AUTOCOMMIT')
+            if _postgres(connection):
+                connection.execute(text(
+                    f"SET lock_timeout = '{LOCK_TIMEOUT}'"))
+            try:
+                migrate(connection)
+            finally:
+                if _postgres(connection):
+                    connection.execute(text('RESET lock_timeout'))
+            connection.execute(schema_migrations.insert().values(
+                version=version, description=_describe(revision),
+                applied_at=datetime.utcnow()))
+        versions.append(version)
+    return versions
+
+
+@click.group('db')
+def db_command():
+    """Schema migrations."""
+
+
+@db_command.command('upgrade')
+@with_appcontext
+def upgrade_command():
+    """Apply pending schema migrations."""
+    if not upgrade(db.engine, echo=click.echo):
+        click.echo('already up to date')
+
+
+@db_command.command('status')
+@with_appcontext
+def status_command():
+    """List applied and pending schema migrations."""
+    done = applied(db.engine)
+    for revision in REVISIONS:
+        state = 'applied' if revision[0] in done else 'pending'
+        click.echo(f'{revision[0]} {state:8} {_describe(revision)}')
@@ -0,0 +1,178 @@
+"""
+Query-level pagination.
+
+Pages are cut out by the database with LIMIT/OFFSET, or with a keyset
+predicate when the client passes ``after=<id>`` or an opaque ``cursor``,
+so a request only loads and formats the rows it actually returns.
+Listings ordered by id can instead be cut out of a sorted array of ids
+with ``paginate_ids``, taking the same arguments. ``ordering`` and
+``keyset_after`` build the ORDER BY and keyset predicate for other
+queries that page the same way, such as search.
+"""
+import base64
+import binascii
+import json
+from bisect import bisect_right
+
+from flask import abort
+from sqlalchemy import and_, or_
+
+QUESTIONS_PER_PAGE = 10
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, types=None):
+    """
+    The values in a cursor from ``encode_cursor``. With ``types``, one
+    type (or tuple of types) per value, the cursor must hold exactly that
+    many values of those types. Raises ValueError.
+    """
+    padded = token + '=' * (-len(token) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError):
+        raise ValueError('malformed cursor')
+    if not isinstance(values, list):
+        raise ValueError('malformed cursor')
+    if types is not None and (len(values) != len(types) or not all(
+            isinstance(value, allowed) and not isinstance(value, bool)
+            for value, allowed in zip(values, types))):
+        raise ValueError('malformed cursor')
+    return values
+
+
+def _key_types(keys):
+    """The types a cursor may hold for each of the ordering ``keys``."""
+    types = []
+    for column, _ in keys:
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = None
+        if python_type is int:
+            types.append(int)
+        elif python_type is str:
+            types.append((str, int))
+        else:
+            types.append((int, float, str))
+    return types
+
+
+def ordering(keys):
+    """ORDER BY clauses for the (column, descending) pairs in ``keys``."""
+    return [column.desc() if descending else column.asc()
+            for column, descending in keys]
+
+
+def keyset_after(keys, values):
+    """
+    Predicate selecting the rows that sort after ``values`` - one per key -
+    in the order ``ordering(keys)`` gives.
+    """
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        equal = [keys[j][0] == values[j] for j in range(i)]
+        beyond = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal, beyond))
+    return or_(*clauses)
+
+
+def _request_cursor(request, query, keys):
+    token = request.args.get('cursor')
+    if token:
+        try:
+            return decode_cursor(token, _key_types(keys))
+        except ValueError:
+            abort(400)
+
+    after = request.args.get('after', None, type=int)
+    if after is None:
+        return None
+    if len(keys) == 1:
+        return [after]
+
+    # listings not ordered by id alone resume from wherever that row sorts
+    columns = [column for column, _ in keys]
+    row = query.session.query(*columns).filter(columns[-1] == after).first()
+    if row is None:
+        abort(400)
+    return list(row)
+
+
+def paginate_query(request, query, keys, per_page=QUESTIONS_PER_PAGE,
+                   columns=None):
+    """
+    Fetch the page of ``query`` the request asks for.
+
+    ``keys`` lists the (column, descending) pairs the listing is ordered by;
+    the last one must be the primary key so the order is total. With
+    ``columns``, which must include the keys, only those are selected and
+    rows are formatted as {column: value}. Returns the formatted rows on
+    the page and a cursor for the next page, or None when there is nothing
+    after it.
+    """
+    values = _request_cursor(request, query, keys)
+    query = query.order_by(*ordering(keys))
+    if columns is not None:
+        query = query.with_entities(*columns)
+
+    if values is None:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return [], None
+        query = query.offset((page - 1) * per_page)
+    else:
+        query = query.filter(keyset_after(keys, values))
+
+    # one extra row tells us whether a next page exists without a COUNT
+    rows = query.limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(
+            getattr(last, column.key) for column, _ in keys)
+
+    if columns is not None:
+        return [row._asdict() for row in rows], next_cursor
+    return [row.format() for row in rows], next_cursor
+
+
+def request_after(request):
+    """
+    The id the request resumes after, from ``after`` or a one-value
+    ``cursor``, or None.
+    """
+    token = request.args.get('cursor')
+    if token:
+        try:
+            [after] = decode_cursor(token, [int])
+            return after
+        except ValueError:
+            abort(400)
+    return request.args.get('after', None, type=int)
+
+
+def paginate_ids(request, ids, per_page=QUESTIONS_PER_PAGE):
+    """
+    The ids on the page the request asks for out of ``ids``, a sorted
+    sequence of primary keys, and the cursor of the next page.
+    """
+    after = request_after(request)
+    if after is not None:
+        start = bisect_right(ids, after)
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return [], None
+        start = (page - 1) * per_page
+
+    page_ids = list(ids[start:start + per_page])
+    next_cursor = None
+    if start + per_page < len(ids) and page_ids:
+        next_cursor = encode_cursor([page_ids[-1]])
+    return page_ids, next_cursor
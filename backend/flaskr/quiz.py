@@ -0,0 +1,365 @@
+"""
+Random question selection for quizzes.
+
+Instead of loading every unplayed question in a category and picking one
+in Python, ``QuestionPool`` keeps the ids of each category (and of the
+whole bank, under category 0), alone and per difficulty, in compact
+arrays. A pick samples ids at random, rejects those already played and
+then loads just the rows drawn by their primary keys. The pool is filled
+on first use and kept in sync by the model change listeners.
+
+``QuizSessions`` goes one step further for clients that opt in: a session
+holds a pre-shuffled deck of question ids on the server, in the database
+where every worker can reach it, so each turn just deals the next id
+instead of re-sending and re-filtering the list of questions already
+played.
+"""
+import random
+import secrets
+import sys
+import threading
+from array import array
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+from models import db, Question, QuizSession
+from .fields import FIELDS, columns
+
+ALL_CATEGORIES = 0
+
+# rejection sampling is only worth it while most of the pool is unplayed;
+# past this fraction we fall back to an exact set difference
+EXACT_THRESHOLD = 0.5
+MAX_ATTEMPTS = 32
+
+# question ids are 32-bit integer primary keys
+ID_TYPECODE = 'i'
+ID_SIZE = array(ID_TYPECODE).itemsize
+
+# most questions one POST /quizzes may ask for
+MAX_ROUND_SIZE = 50
+
+SESSION_TTL = 30 * 60
+MAX_SESSIONS = 10000
+
+
+def category_key(value):
+    """Normalise a category id sent by a client, possibly as a string."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def bucket_keys(category, difficulty):
+    """The pool keys a question of this category and difficulty is in."""
+    category = category_key(category)
+    return [(ALL_CATEGORIES, None), (category, None),
+            (ALL_CATEGORIES, difficulty), (category, difficulty)]
+
+
+def pool_rows():
+    """(id, category, difficulty) of every question, streamed."""
+    return db.session.query(
+        Question.id, Question.category, Question.difficulty).yield_per(10000)
+
+
+class _Bucket:
+    """Ids of one category with O(1) add, remove and random access."""
+
+    __slots__ = ('ids', 'positions')
+
+    def __init__(self):
+        self.ids = array(ID_TYPECODE)
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, question_id):
+        if question_id in self.positions:
+            return
+        self.positions[question_id] = len(self.ids)
+        self.ids.append(question_id)
+
+    def remove(self, question_id):
+        position = self.positions.pop(question_id, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if last != question_id:
+            self.ids[position] = last
+            self.positions[last] = position
+
+
+class QuestionPool:
+    """
+    Question id arrays used to draw quiz questions, one per category and
+    one per (category, difficulty), keyed (category, None) and
+    (category, difficulty) respectively.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = None
+
+    @property
+    def loaded(self):
+        return self._buckets is not None
+
+    def fill(self, rows):
+        """
+        Build the pool from (id, category, difficulty) rows unless it is
+        already built.
+        """
+        buckets = {(ALL_CATEGORIES, None): _Bucket()}
+        for question_id, category, difficulty in rows:
+            self._add(buckets, question_id, category, difficulty)
+        with self._lock:
+            if self._buckets is None:
+                self._buckets = buckets
+        return self._buckets
+
+    def _ensure_loaded(self):
+        if self._buckets is None:
+            self.fill(pool_rows())
+        return self._buckets
+
+    def warm(self):
+        """Load the pool now rather than on the first quiz request."""
+        return len(self._ensure_loaded()[(ALL_CATEGORIES, None)])
+
+    @staticmethod
+    def _add(buckets, question_id, category, difficulty):
+        for key in bucket_keys(category, difficulty):
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = _Bucket()
+            bucket.add(question_id)
+
+    @staticmethod
+    def _remove(buckets, question_id):
+        for bucket in buckets.values():
+            bucket.remove(question_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._buckets = None
+
+    def on_change(self, table, action, rows):
+        if table != Question.__tablename__:
+            return
+        with self._lock:
+            if action == 'invalidate':
+                self._buckets = None
+            if self._buckets is None:
+                return
+            for row in rows:
+                self._remove(self._buckets, row['id'])
+                if action != 'delete':
+                    self._add(self._buckets, row['id'], row['category'],
+                              row['difficulty'])
+
+    def _bucket(self, buckets, category_id, difficulty):
+        return buckets.get((category_key(category_id), difficulty))
+
+    def ids(self, category_id, difficulty=None):
+        """Copy of the ids in a category as a compact array."""
+        buckets = self._ensure_loaded()
+        with self._lock:
+            bucket = self._bucket(buckets, category_id, difficulty)
+            if bucket is None:
+                return array(ID_TYPECODE)
+            return array(ID_TYPECODE, bucket.ids)
+
+    def sample_ids(self, category_id, previous_questions, count,
+                   difficulty=None):
+        """
+        Up to ``count`` distinct ids drawn uniformly from the category (and
+        difficulty) among those that have not been played. Played ids sent
+        as strings count too; one that is not an integer raises ValueError.
+        """
+        try:
+            played = {int(value) for value in previous_questions}
+        except (TypeError, ValueError):
+            raise ValueError('previous questions must be integers')
+        buckets = self._ensure_loaded()
+
+        with self._lock:
+            bucket = self._bucket(buckets, category_id, difficulty)
+            if bucket is None or len(bucket) == 0 or count < 1:
+                return []
+
+            size = len(bucket)
+            chosen = []
+            if len(played) + count < size * EXACT_THRESHOLD:
+                # each accepted draw is uniform over the ids neither played
+                # nor drawn yet, so the result is a uniform sample
+                seen = set(played)
+                for _ in range(MAX_ATTEMPTS * count):
+                    candidate = bucket.ids[random.randrange(size)]
+                    if candidate not in seen:
+                        seen.add(candidate)
+                        chosen.append(candidate)
+                        if len(chosen) == count:
+                            return chosen
+                played = seen
+
+            remaining = [i for i in bucket.ids if i not in played]
+        return chosen + random.sample(
+            remaining, min(count - len(chosen), len(remaining)))
+
+    def sample_id(self, category_id, previous_questions, difficulty=None):
+        """Return a random id from the category that has not been played."""
+        ids = self.sample_ids(category_id, previous_questions, 1, difficulty)
+        return ids[0] if ids else None
+
+    def forget(self, question_id):
+        """Drop an id whose row turned out to be gone."""
+        with self._lock:
+            if self._buckets is not None:
+                self._remove(self._buckets, question_id)
+
+    def pick_many(self, category_id, previous_questions, count,
+                  difficulty=None, fields=FIELDS['questions']):
+        """
+        Load up to ``count`` random unplayed questions with one query per
+        draw, in the order they were drawn, formatted with only ``fields``.
+        """
+        played = list(previous_questions)
+        questions = []
+        while len(questions) < count:
+            ids = self.sample_ids(category_id, played,
+                                  count - len(questions), difficulty)
+            if not ids:
+                break
+            rows = {row.id: row._asdict() for row in db.session.query(
+                *columns(Question, fields)).filter(Question.id.in_(ids))}
+            for question_id in ids:
+                if question_id in rows:
+                    questions.append(rows[question_id])
+                else:
+                    # deleted behind our back; forget it and draw again
+                    self.forget(question_id)
+            played.extend(ids)
+        return questions
+
+    def pick(self, category_id, previous_questions, difficulty=None,
+             fields=FIELDS['questions']):
+        """Load a random unplayed question, or None when there are none."""
+        questions = self.pick_many(
+            category_id, previous_questions, 1, difficulty, fields)
+        return questions[0] if questions else None
+
+
+def _pack(ids):
+    """Ids as stored in a session deck: 32-bit little endian integers."""
+    if sys.byteorder != 'little':
+        ids = array(ID_TYPECODE, ids)
+        ids.byteswap()
+    return ids.tobytes()
+
+
+def _unpack(data):
+    ids = array(ID_TYPECODE, bytes(data))
+    if sys.byteorder != 'little':
+        ids.byteswap()
+    return ids
+
+
+class QuizSessions:
+    """
+    Server-held quiz decks with a time-to-live.
+
+    Decks are kept in the ``quiz_sessions`` table rather than in the
+    process, so a session started by one worker can be dealt from by any
+    other. Dealing bumps the session's ``dealt`` counter and reads just
+    that slot of its deck, in one short transaction whose update
+    serializes concurrent deals of the same session. Expired sessions are
+    deleted as new ones are created, as are those closest to expiry once
+    more than ``max_sessions`` are live.
+    """
+
+    def __init__(self, pool, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.pool = pool
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+
+    def __len__(self):
+        return QuizSession.query.filter(
+            QuizSession.expires_at > datetime.utcnow()).count()
+
+    def _evict(self, now):
+        sessions = QuizSession.__table__
+        db.session.execute(sessions.delete().where(
+            sessions.c.expires_at <= now))
+        excess = QuizSession.query.count() - self.max_sessions
+        if excess > 0:
+            oldest = select([sessions.c.id]).order_by(
+                sessions.c.expires_at).limit(excess)
+            db.session.execute(sessions.delete().where(
+                sessions.c.id.in_(oldest.alias('oldest').select())))
+
+    def create(self, category_id):
+        """Start a session over the category and return its id and size."""
+        deck = self.pool.ids(category_id)
+        # Fisher-Yates in place keeps the deck a flat int array
+        for i in range(len(deck) - 1, 0, -1):
+            j = random.randint(0, i)
+            deck[i], deck[j] = deck[j], deck[i]
+
+        session_id = secrets.token_urlsafe(16)
+        now = datetime.utcnow()
+        db.session.add(QuizSession(
+            id=session_id, deck=_pack(deck), dealt=0,
+            expires_at=now + timedelta(seconds=self.ttl)))
+        db.session.flush()
+        self._evict(now)
+        db.session.commit()
+        return session_id, len(deck)
+
+    def _next_id(self, session_id):
+        now = datetime.utcnow()
+        sessions = QuizSession.__table__
+        dealt = db.session.execute(sessions.update().where(
+            sessions.c.id == session_id).where(
+            sessions.c.expires_at > now).values(
+            dealt=sessions.c.dealt + 1,
+            expires_at=now + timedelta(seconds=self.ttl)))
+        if not dealt.rowcount:
+            db.session.rollback()
+            raise KeyError(session_id)
+        # only the dealt slot of the deck is read
+        slot = db.session.execute(select([func.substr(
+            sessions.c.deck, (sessions.c.dealt - 1) * ID_SIZE + 1, ID_SIZE)
+        ]).where(sessions.c.id == session_id)).scalar()
+        db.session.commit()
+        if slot is None or len(slot) < ID_SIZE:
+            return None
+        return _unpack(slot)[0]
+
+    def next(self, session_id):
+        """
+        Load the next question of the session, or None once the deck is
+        empty. Raises KeyError for unknown or expired sessions.
+        """
+        while True:
+            question_id = self._next_id(session_id)
+            if question_id is None:
+                return None
+            question = Question.query.get(question_id)
+            if question is not None:
+                return question
+
+    def remaining(self, session_id):
+        row = db.session.query(
+            func.length(QuizSession.deck), QuizSession.dealt).filter(
+            QuizSession.id == session_id).first()
+        return max(0, row[0] // ID_SIZE - row[1]) if row is not None else 0
+
+    def end(self, session_id):
+        deleted = db.session.execute(QuizSession.__table__.delete().where(
+            QuizSession.id == session_id))
+        db.session.commit()
+        return deleted.rowcount > 0
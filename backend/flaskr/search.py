@@ -0,0 +1,285 @@
+"""
+Question search.
+
+Two matching modes are supported:
+
+``substring``
+    case-insensitive substring match, the behaviour of the original
+    ``ILIKE '%term%'`` search, kept for compatibility
+``fulltext``
+    every word of the term must appear in the question; results are
+    ranked by how often they do
+
+On Postgres both modes run in the database and are served by the
+``tsvector`` and trigram indexes that ``flask search-index`` creates.
+Elsewhere (e.g. SQLite) an in-process inverted index over question text,
+kept in sync by the model change listeners, answers the query and only
+the rows on the requested page are loaded.
+"""
+import re
+import threading
+from bisect import bisect_right
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, text
+
+from models import db, Question
+from .pagination import keyset_after, ordering
+
+MODES = ('substring', 'fulltext')
+
+# the text search configuration must be the same in the index definition
+# and in the queries for Postgres to use the index
+TS_CONFIG = 'simple'
+
+POSTGRES_INDEXES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    "CREATE INDEX IF NOT EXISTS questions_question_tsv_idx ON questions "
+    "USING gin (to_tsvector('simple', coalesce(question, '')))",
+    'CREATE INDEX IF NOT EXISTS questions_question_trgm_idx ON questions '
+    'USING gin (question gin_trgm_ops)',
+]
+
+_TOKEN = re.compile(r'\w+')
+
+
+def as_text(value):
+    """``value`` as a string; clients may send a number for a text."""
+    return '' if value is None else str(value)
+
+
+def tokenize(value):
+    return _TOKEN.findall(as_text(value).lower())
+
+
+def trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def _like_pattern(term):
+    escaped = as_text(term).replace('\\', '\\\\').replace('%', '\\%')
+    return '%' + escaped.replace('_', '\\_') + '%'
+
+
+class PostgresSearch:
+    """Runs searches in Postgres so its text indexes do the matching."""
+
+    def _document(self):
+        value = func.coalesce(Question.question, '')
+        return func.to_tsvector(TS_CONFIG, value)
+
+    def search(self, term, mode, page, per_page, after=None):
+        if mode == 'fulltext':
+            query = func.plainto_tsquery(TS_CONFIG, term)
+            selection = Question.query.filter(
+                self._document().op('@@')(query))
+            keys = [(func.ts_rank(self._document(), query), True),
+                    (Question.id, False)]
+        else:
+            selection = Question.query.filter(
+                Question.question.ilike(_like_pattern(term), escape='\\'))
+            keys = [(Question.id, False)]
+
+        total = selection.order_by(None).count()
+        rows = selection.order_by(*ordering(keys))
+        if after is None:
+            rows = rows.offset((page - 1) * per_page)
+        else:
+            values = [after]
+            if len(keys) > 1:
+                # ranked results resume from wherever that row ranks
+                values = selection.with_entities(
+                    *[column for column, _ in keys]).filter(
+                    Question.id == after).first()
+                if values is None:
+                    raise ValueError('the cursor row no longer matches')
+            rows = rows.filter(keyset_after(keys, list(values)))
+
+        # one extra row tells whether a next page exists
+        rows = rows.limit(per_page + 1).all()
+        next_after = rows[per_page - 1].id if len(rows) > per_page else None
+        return [row.format() for row in rows[:per_page]], total, next_after
+
+    def on_change(self, table, action, rows):
+        pass
+
+
+class InvertedIndex:
+    """
+    In-process index over question text.
+
+    ``postings`` maps each word to {question id: occurrences} for full-text
+    queries and ``grams`` maps each trigram to the ids containing it, so a
+    substring query only verifies the questions sharing all its trigrams.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._documents = None
+        self._postings = {}
+        self._grams = {}
+
+    def _index(self, question_id, value):
+        document = as_text(value).lower()
+        self._documents[question_id] = document
+        for token in tokenize(document):
+            counts = self._postings.setdefault(token, {})
+            counts[question_id] = counts.get(question_id, 0) + 1
+        for gram in trigrams(document):
+            self._grams.setdefault(gram, set()).add(question_id)
+
+    def _unindex(self, question_id):
+        document = self._documents.pop(question_id, None)
+        if document is None:
+            return
+        for token in set(tokenize(document)):
+            counts = self._postings.get(token)
+            if counts is not None:
+                counts.pop(question_id, None)
+                if not counts:
+                    del self._postings[token]
+        for gram in trigrams(document):
+            ids = self._grams.get(gram)
+            if ids is not None:
+                ids.discard(question_id)
+                if not ids:
+                    del self._grams[gram]
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._documents is not None:
+                return
+            self._documents = {}
+            rows = db.session.query(Question.id, Question.question)
+            for question_id, value in rows.yield_per(10000):
+                self._index(question_id, value)
+
+    def on_change(self, table, action, rows):
+        if table != Question.__tablename__:
+            return
+        with self._lock:
+            if action == 'invalidate':
+                self._documents, self._postings, self._grams = None, {}, {}
+            if self._documents is None:
+                return
+            for row in rows:
+                self._unindex(row['id'])
+                if action != 'delete':
+                    self._index(row['id'], row['question'])
+
+    def _fulltext(self, term):
+        tokens = tokenize(term)
+        if not tokens:
+            return []
+        postings = [self._postings.get(token, {}) for token in set(tokens)]
+        postings.sort(key=len)
+        scores = {}
+        for question_id in postings[0]:
+            if all(question_id in counts for counts in postings[1:]):
+                scores[question_id] = sum(
+                    counts[question_id] for counts in postings)
+        return sorted(scores, key=lambda i: (-scores[i], i))
+
+    def _substring(self, term):
+        term = as_text(term).lower()
+        grams = trigrams(term)
+        if grams:
+            candidates = sorted(
+                (self._grams.get(gram, set()) for gram in grams), key=len)
+            ids = set.intersection(*candidates)
+        else:
+            # too short to have trigrams; check every document
+            ids = self._documents.keys()
+        return sorted(i for i in ids if term in self._documents[i])
+
+    def match(self, term, mode):
+        """Ids of the matching questions, best first."""
+        self._ensure_loaded()
+        with self._lock:
+            if mode == 'fulltext':
+                return self._fulltext(term)
+            return self._substring(term)
+
+    def search(self, term, mode, page, per_page, after=None):
+        ids = self.match(term, mode)
+        if after is None:
+            start = (page - 1) * per_page
+        elif mode == 'fulltext':
+            # ranked results resume from wherever that row ranks
+            if after not in ids:
+                raise ValueError('the cursor row no longer matches')
+            start = ids.index(after) + 1
+        else:
+            start = bisect_right(ids, after)
+        page_ids = ids[start:start + per_page]
+        if not page_ids:
+            return [], len(ids), None
+
+        next_after = page_ids[-1] if start + per_page < len(ids) else None
+        rows = {row.id: row for row in
+                Question.query.filter(Question.id.in_(page_ids)).all()}
+        return ([rows[i].format() for i in page_ids if i in rows], len(ids),
+                next_after)
+
+
+class Search:
+    """
+    Picks the search backend for the bound database on first use:
+    ``SEARCH_BACKEND`` may force ``postgres`` or ``memory``.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._postgres = PostgresSearch()
+        self._memory = InvertedIndex()
+
+    def _impl(self):
+        backend = self.backend
+        if backend is None:
+            dialect = db.engine.dialect.name
+            backend = 'postgres' if dialect == 'postgresql' else 'memory'
+        return self._postgres if backend == 'postgres' else self._memory
+
+    def search(self, term, mode, page, per_page, after=None):
+        """
+        Return the formatted questions on the page, the match count and
+        the id the next page resumes after, or None on the last page. With
+        ``after`` the page starts after that question instead of at
+        ``page``; raises ValueError if a ranked search no longer matches it.
+        """
+        if after is None and page < 1:
+            return [], 0, None
+        return self._impl().search(term, mode, page, per_page, after)
+
+    def warm(self):
+        """Build the in-process index now if it is the one in use."""
+        if self._impl() is self._memory:
+            self._memory._ensure_loaded()
+
+    def on_change(self, table, action, rows):
+        self._memory.on_change(table, action, rows)
+
+
+def create_postgres_indexes(engine):
+    """Create the search indexes, skipping any the server cannot build."""
+    created = []
+    for statement in POSTGRES_INDEXES:
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(statement))
+            created.append(statement)
+        except Exception as error:
+            click.echo(f'skipped: {statement}\n  {error}', err=True)
+    return created
+
+
+@click.command('search-index')
+@with_appcontext
+def search_index_command():
+    """Create the Postgres full-text and trigram search indexes."""
+    if db.engine.dialect.name != 'postgresql':
+        click.echo('not a Postgres database; the in-process index is used')
+        return
+    for statement in create_postgres_indexes(db.engine):
+        click.echo(statement)
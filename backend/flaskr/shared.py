@@ -0,0 +1,287 @@
+"""
+Question id arrays shared between worker processes.
+
+``SharedIdStore`` keeps the ids of every category, alone and per
+difficulty, as sorted 32-bit arrays in one snapshot file that each worker
+maps read-only and reads in place, so N workers hold one copy of the pool
+between them instead of N copies that go stale independently. A change
+made by any worker rewrites the snapshot to a temporary file and renames
+it over the current one under an exclusive file lock, then bumps the
+generation counter kept in a second, tiny mapped file. Readers compare
+that counter with the generation of the snapshot they have mapped and
+remap when it has moved on; the rename leaves mappings of the previous
+snapshot intact, so a reader is never left with a half-written file.
+Every change rewrites the whole snapshot, which suits a question bank
+that is read far more often than it is written.
+
+``SharedQuestionPool`` is the quiz ``QuestionPool`` backed by the store,
+and its ``page`` cuts question listings out of the same arrays, so
+neither a quiz draw nor the position and total of a listing page need
+the database. The store is built from the database by whichever process
+gets to it first, normally the master under ``gunicorn --preload`` while
+it warms up, and rebuilt whenever questions change in bulk.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from models import Question
+from .pagination import paginate_ids
+from .quiz import (ALL_CATEGORIES, ID_TYPECODE, QuestionPool, bucket_keys,
+                   category_key, pool_rows)
+
+MAGIC = b'TRIVIDS1'
+# magic, generation, number of arrays
+HEADER = struct.Struct('=8sQI4x')
+# category, difficulty, byte offset and length of one array
+ENTRY = struct.Struct('=iiQQ')
+GENERATION = struct.Struct('=Q')
+
+# stands for a NULL category or for "any difficulty"
+NONE = -2 ** 31
+
+SNAPSHOT = 'question-ids'
+COUNTER = 'generation'
+LOCK = 'lock'
+
+
+def _encode(value):
+    return NONE if value is None else value
+
+
+def _decode(value):
+    return None if value == NONE else value
+
+
+def database_directory(base, database_uri):
+    """
+    The directory under ``base`` for one database, so apps pointed at
+    different databases never share a snapshot.
+    """
+    return os.path.join(
+        base, hashlib.sha1(database_uri.encode()).hexdigest()[:16])
+
+
+class _View:
+    """One array of a snapshot, in the shape ``QuestionPool`` samples."""
+
+    __slots__ = ('ids',)
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class _Snapshot:
+    """A mapped snapshot file: (category, difficulty) -> sorted ids."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot:
+            self._map = mmap.mmap(
+                snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, count = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a question id snapshot')
+        data = memoryview(self._map)
+        self._views = {}
+        for i in range(count):
+            category, difficulty, offset, size = ENTRY.unpack_from(
+                self._map, HEADER.size + i * ENTRY.size)
+            self._views[(_decode(category), _decode(difficulty))] = _View(
+                data[offset:offset + size].cast(ID_TYPECODE))
+
+    def get(self, key, default=None):
+        return self._views.get(key, default)
+
+    def arrays(self):
+        """Writable copies of every array, keyed like the views."""
+        return {key: array(ID_TYPECODE, view.ids.tobytes())
+                for key, view in self._views.items()}
+
+
+class SharedIdStore:
+    """The snapshot, generation counter and lock files in ``directory``."""
+
+    def __init__(self, directory):
+        if fcntl is None:
+            raise RuntimeError('the shared question pool needs fcntl')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, SNAPSHOT)
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+        descriptor = os.open(os.path.join(directory, COUNTER),
+                             os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(descriptor).st_size < GENERATION.size:
+                os.ftruncate(descriptor, GENERATION.size)
+            self._counter = mmap.mmap(descriptor, GENERATION.size)
+        finally:
+            os.close(descriptor)
+
+    @property
+    def generation(self):
+        return GENERATION.unpack_from(self._counter)[0]
+
+    @contextmanager
+    def _exclusive(self):
+        with open(os.path.join(self.directory, LOCK), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def snapshot(self):
+        """The current snapshot, remapped if it moved on; None if unbuilt."""
+        current = self._snapshot
+        if current is not None and current.generation == self.generation:
+            return current
+        with self._lock:
+            try:
+                self._snapshot = _Snapshot(self.path)
+            except FileNotFoundError:
+                return None
+            return self._snapshot
+
+    def _write(self, arrays):
+        generation = self.generation + 1
+        keys = sorted(arrays, key=lambda key: tuple(map(_encode, key)))
+        descriptor, temporary = tempfile.mkstemp(
+            dir=self.directory, prefix=f'.{SNAPSHOT}-')
+        try:
+            with os.fdopen(descriptor, 'wb') as snapshot:
+                snapshot.write(HEADER.pack(MAGIC, generation, len(keys)))
+                offset = HEADER.size + ENTRY.size * len(keys)
+                for category, difficulty in keys:
+                    size = len(arrays[(category, difficulty)]) * \
+                        arrays[(category, difficulty)].itemsize
+                    snapshot.write(ENTRY.pack(
+                        _encode(category), _encode(difficulty), offset, size))
+                    offset += size
+                for key in keys:
+                    snapshot.write(arrays[key].tobytes())
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(temporary, self.path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            raise
+        GENERATION.pack_into(self._counter, 0, generation)
+        return generation
+
+    def build(self, rows, only_if_missing=False):
+        """
+        Write a snapshot of (id, category, difficulty) ``rows``, a callable
+        returning them; with ``only_if_missing`` keep an existing one.
+        """
+        with self._exclusive():
+            if only_if_missing and os.path.exists(self.path):
+                return
+            arrays = {(ALL_CATEGORIES, None): array(ID_TYPECODE)}
+            for question_id, category, difficulty in rows():
+                for key in set(bucket_keys(category, difficulty)):
+                    arrays.setdefault(key, array(ID_TYPECODE)).append(
+                        question_id)
+            self._write({key: array(ID_TYPECODE, sorted(ids))
+                         for key, ids in arrays.items()})
+
+    def apply(self, action, rows):
+        """Write a snapshot with formatted question ``rows`` changed."""
+        with self._exclusive():
+            try:
+                arrays = _Snapshot(self.path).arrays()
+            except FileNotFoundError:
+                # whoever builds it reads the rows from the database
+                return
+            for row in rows:
+                for ids in arrays.values():
+                    position = bisect_left(ids, row['id'])
+                    if position < len(ids) and ids[position] == row['id']:
+                        del ids[position]
+                if action == 'delete':
+                    continue
+                for key in set(bucket_keys(row['category'],
+                                           row['difficulty'])):
+                    ids = arrays.setdefault(key, array(ID_TYPECODE))
+                    ids.insert(bisect_left(ids, row['id']), row['id'])
+            self._write(arrays)
+
+
+class SharedQuestionPool(QuestionPool):
+    """``QuestionPool`` reading its id arrays from a ``SharedIdStore``."""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    @property
+    def loaded(self):
+        return self.store.snapshot() is not None
+
+    @property
+    def generation(self):
+        return self.store.generation
+
+    def fill(self, rows):
+        self.store.build(lambda: rows)
+        return self.store.snapshot()
+
+    def _ensure_loaded(self):
+        snapshot = self.store.snapshot()
+        if snapshot is None:
+            self.store.build(pool_rows, only_if_missing=True)
+            snapshot = self.store.snapshot()
+        return snapshot
+
+    def warm(self):
+        """
+        Rebuild the snapshot from the database, so one left behind by an
+        earlier run cannot be served.
+        """
+        self.store.build(pool_rows)
+        return len(self._ensure_loaded().get((ALL_CATEGORIES, None)))
+
+    def invalidate(self):
+        self.store.build(pool_rows)
+
+    def on_change(self, table, action, rows):
+        if table != Question.__tablename__:
+            return
+        if action == 'invalidate':
+            self.store.build(pool_rows)
+        else:
+            self.store.apply(action, rows)
+
+    def forget(self, question_id):
+        self.store.apply('delete', [{'id': question_id}])
+
+    def page(self, request, category_id=None):
+        """
+        The ids on the requested page of a listing ordered by id, all
+        questions or a category's, the next cursor and the total.
+        """
+        key = ALL_CATEGORIES if category_id is None \
+            else category_key(category_id)
+        view = None
+        # category 0 stands for every question in quizzes only
+        if category_id is None or key != ALL_CATEGORIES:
+            view = self._ensure_loaded().get((key, None))
+        ids = view.ids if view is not None else ()
+        page_ids, next_cursor = paginate_ids(request, ids)
+        return page_ids, next_cursor, len(ids)
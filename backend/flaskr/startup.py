@@ -0,0 +1,54 @@
+"""
+Production startup.
+
+``prepare`` gets an app created by ``create_app`` ready to take traffic:
+it reports schema migrations that have not been applied, loads the
+in-memory caches (categories, the quiz question pool, the leaderboard,
+the suggestion index and, where it is used, the search index) so the
+first requests do not pay for them, and then closes the pooled database
+connections. Under ``gunicorn --preload`` this runs once in the master,
+the workers inherit the warm caches, and every worker opens its own
+connections; connections that do cross a fork are discarded by the pool
+rather than shared (see ``models``).
+"""
+import time
+
+import click
+
+from models import db, dispose_engines, QuestionCount
+from .migrations import pending
+
+
+def prepare(app, warm=True, started=None):
+    """
+    Warm ``app`` and release its connections; returns the boot report.
+    ``started`` is the ``time.perf_counter()`` reading taken when the
+    process began loading the app, so the report covers imports too.
+    """
+    warm_started = time.perf_counter()
+    report = {}
+    with app.app_context():
+        waiting = [version for version, _ in pending(db.engine)]
+        if waiting:
+            click.echo('schema migrations pending: ' + ', '.join(waiting) +
+                       '; run `flask db upgrade`', err=True)
+        report['pending_migrations'] = waiting
+
+        if warm:
+            engines = app.extensions['trivia']
+            report['categories'] = len(engines['categories'].all())
+            report['questions'] = engines['pool'].warm()
+            report['total_questions'] = QuestionCount.total()
+            report['leaderboard'] = engines['board'].warm()
+            engines['search'].warm()
+            report['suggestion_words'] = engines['suggestions'].warm()
+        db.session.remove()
+    dispose_engines(app)
+
+    now = time.perf_counter()
+    report['warm_seconds'] = round(now - warm_started, 3)
+    report['boot_seconds'] = round(now - (started or warm_started), 3)
+    app.extensions['trivia']['boot'] = report
+    click.echo('ready in {boot_seconds}s (warm-up {warm_seconds}s)'.format(
+        **report), err=True)
+    return report
@@ -0,0 +1,143 @@
+"""
+Search box suggestions.
+
+``PrefixIndex`` keeps every word of the question texts and answers in a
+sorted array, so the words starting with a prefix are a contiguous run
+found by bisection, and lists under each word the ids of the newest
+questions using it. A suggestion walks that run, shortest completion
+first, until it has collected ``limit`` questions, so its cost depends on
+``limit`` rather than on the size of the question bank.
+
+Memory is bounded by ``depth``: a word lists at most that many ids, older
+ones giving way to newer questions, and a question keeps its snippet only
+while some word still lists it. A word that drops below ``depth`` because
+its questions were deleted is not refilled until the index is rebuilt, by
+a bulk change or a restart.
+"""
+import threading
+from array import array
+from bisect import bisect_left, insort
+
+from models import db, Question
+from .quiz import ID_TYPECODE
+from .search import tokenize
+
+LIMIT = 10
+MAX_LIMIT = 50
+DEPTH = 32
+SNIPPET_LENGTH = 120
+
+
+class PrefixIndex:
+    """In-process prefix index over question words and answers."""
+
+    def __init__(self, depth=DEPTH):
+        self.depth = depth
+        self._lock = threading.Lock()
+        self._terms = None
+        self._postings = {}
+        # question id -> [snippet, words listing the question]
+        self._entries = {}
+
+    def _post(self, term, question_id):
+        ids = self._postings.get(term)
+        if ids is None:
+            ids = self._postings[term] = array(ID_TYPECODE)
+            insort(self._terms, term)
+        position = bisect_left(ids, question_id)
+        if position < len(ids) and ids[position] == question_id:
+            return False
+        ids.insert(position, question_id)
+        if len(ids) > self.depth:
+            evicted = ids.pop(0)
+            if evicted == question_id:
+                return False
+            self._unlist(evicted, term)
+        return True
+
+    def _unlist(self, question_id, term):
+        entry = self._entries.get(question_id)
+        if entry is None:
+            return
+        entry[1].discard(term)
+        if not entry[1]:
+            del self._entries[question_id]
+
+    def _index(self, question_id, question, answer):
+        terms = set(tokenize(question)) | set(tokenize(answer))
+        listed = {term for term in terms if self._post(term, question_id)}
+        if listed:
+            self._entries[question_id] = [
+                (question or '')[:SNIPPET_LENGTH], listed]
+
+    def _unindex(self, question_id):
+        entry = self._entries.pop(question_id, None)
+        if entry is None:
+            return
+        for term in entry[1]:
+            ids = self._postings[term]
+            del ids[bisect_left(ids, question_id)]
+            if not ids:
+                del self._postings[term]
+                del self._terms[bisect_left(self._terms, term)]
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._terms is not None:
+                return
+            self._terms, self._postings, self._entries = [], {}, {}
+            rows = db.session.query(
+                Question.id, Question.question, Question.answer
+            ).order_by(Question.id)
+            for question_id, question, answer in rows.yield_per(10000):
+                self._index(question_id, question, answer)
+
+    def warm(self):
+        """Build the index now; returns the number of words."""
+        self._ensure_loaded()
+        return len(self._terms)
+
+    def on_change(self, table, action, rows):
+        if table != Question.__tablename__:
+            return
+        with self._lock:
+            if action == 'invalidate':
+                self._terms, self._postings, self._entries = None, {}, {}
+            if self._terms is None:
+                return
+            for row in rows:
+                self._unindex(row['id'])
+                if action != 'delete':
+                    self._index(row['id'], row['question'], row['answer'])
+
+    def suggest(self, prefix, limit=LIMIT):
+        """
+        Up to ``limit`` questions with a word starting with the last word
+        of ``prefix`` and, in their snippet, the words before it, as
+        {id, question} dicts.
+        """
+        words = tokenize(prefix)
+        if not words or limit < 1:
+            return []
+        *before, last = words
+        self._ensure_loaded()
+        with self._lock:
+            results, seen = [], set()
+            position = bisect_left(self._terms, last)
+            while position < len(self._terms) and len(results) < limit:
+                term = self._terms[position]
+                if not term.startswith(last):
+                    break
+                position += 1
+                # newest first
+                for question_id in reversed(self._postings[term]):
+                    if question_id in seen:
+                        continue
+                    seen.add(question_id)
+                    snippet = self._entries[question_id][0]
+                    if before and not set(before) <= set(tokenize(snippet)):
+                        continue
+                    results.append({'id': question_id, 'question': snippet})
+                    if len(results) == limit:
+                        break
+            return results
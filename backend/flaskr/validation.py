@@ -0,0 +1,112 @@
+"""
+Request body validation shared by the endpoints that create questions.
+"""
+
+QUESTION_FIELDS = ['question', 'answer', 'difficulty', 'category']
+
+# leaderboard.score is a 32-bit integer column
+MIN_SCORE = -2 ** 31
+MAX_SCORE = 2 ** 31 - 1
+
+
+def missing_question_fields(body):
+    """The required question fields that are absent or empty in ``body``."""
+    return [key for key in QUESTION_FIELDS
+            if key not in body.keys() or body[key] is None or body[key] == '']
+
+
+def parse_question(body):
+    """
+    Validate a question record and coerce its numeric fields, raising
+    ValueError with a message suitable for reporting back to the client.
+    """
+    if not isinstance(body, dict):
+        raise ValueError('expected an object')
+    missing = missing_question_fields(body)
+    if missing:
+        raise ValueError('missing ' + ', '.join(missing))
+
+    values = {key: body[key] for key in QUESTION_FIELDS}
+    for key in ('question', 'answer'):
+        # a number is stored as its text, as the column always did
+        if isinstance(values[key], (int, float)) and \
+                not isinstance(values[key], bool):
+            values[key] = str(values[key])
+        if not isinstance(values[key], str):
+            raise ValueError(f'{key} must be a string')
+    for key in ('difficulty', 'category'):
+        try:
+            values[key] = int(values[key])
+        except (TypeError, ValueError):
+            raise ValueError(f'{key} must be an integer')
+    return values
+
+
+def parse_score(body):
+    """The (player, score) of a leaderboard submission; raises ValueError."""
+    try:
+        player, score = body["name"], int(body["score"])
+    except (KeyError, TypeError) as error:
+        raise ValueError(f'invalid submission: {error}')
+    # a number is stored as its text, as the column always did
+    if isinstance(player, (int, float)) and not isinstance(player, bool):
+        player = str(player)
+    if not isinstance(player, str):
+        raise ValueError('name must be a string')
+    if not MIN_SCORE <= score <= MAX_SCORE:
+        raise ValueError('score out of range')
+    return player, score
+
+
+def parse_quiz_category(body):
+    """The category id of a quiz request's ``quiz_category``; raises
+    ValueError."""
+    category = body.get('quiz_category') if isinstance(body, dict) else None
+    if not isinstance(category, dict):
+        raise ValueError('quiz_category must be an object')
+    try:
+        return int(category['id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('quiz_category needs an integer id')
+
+
+def parse_previous_questions(body):
+    """The question ids under ``previous_questions``; raises ValueError."""
+    previous = body.get('previous_questions') or []
+    if not isinstance(previous, list):
+        raise ValueError('previous_questions must be a list')
+    try:
+        return [int(value) for value in previous]
+    except (TypeError, ValueError):
+        raise ValueError('previous_questions must be integers')
+
+
+def parse_ids(body, limit):
+    """
+    The distinct question ids listed under ``ids`` in ``body``, at most
+    ``limit`` of them; raises ValueError.
+    """
+    ids = body.get('ids') if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not ids:
+        raise ValueError('ids must be a non-empty list')
+    try:
+        ids = sorted({int(value) for value in ids})
+    except (TypeError, ValueError):
+        raise ValueError('ids must be integers')
+    if len(ids) > limit:
+        raise ValueError(f'at most {limit} ids per request')
+    return ids
+
+
+def parse_question_changes(body):
+    """The category and difficulty to set on a batch of questions."""
+    changes = {}
+    for key in ('category', 'difficulty'):
+        if body.get(key) is not None:
+            try:
+                changes[key] = int(body[key])
+            except (TypeError, ValueError):
+                raise ValueError(f'{key} must be an integer')
+    if not changes:
+        raise ValueError('nothing to change')
+    return changes
@@ -0,0 +1,241 @@
+"""
+Write-behind buffering for append-only tables.
+
+``WriteBehindBuffer`` accepts rows immediately, gives each one its primary
+key up front and writes them from a background thread as multi-row
+INSERTs, one transaction per flush, whenever ``batch_size`` rows are
+waiting or ``flush_interval`` seconds have passed. Ids come from the
+table's sequence on Postgres, reserved a block at a time; on other
+databases they continue from ``max(id)`` in-process, which is only safe
+with a single writing process. ``before_commit`` is called with each
+flushed batch inside its transaction, to keep derived tables in step.
+
+A batch the database rejects for its data is retried row by row, and the
+rows it still rejects are dropped - logged and kept in ``dead_letters``
+- so one bad row cannot jam the queue. Any other failure, such as a lost
+connection, puts the batch back at the front of the queue for the next
+flush.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import has_app_context
+from sqlalchemy import exc, func, text
+
+from models import db, notify_change
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.05
+MAX_PENDING = 10000
+
+# rows dropped are kept for inspection, the most recent ones only
+MAX_DEAD_LETTERS = 100
+
+# errors that are about the rows themselves rather than the database
+ROW_ERRORS = (exc.DataError, exc.IntegrityError)
+
+
+class IdAllocator:
+    """Hands out primary keys for rows that are not inserted yet."""
+
+    def __init__(self, model, block_size):
+        self.model = model
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._ids = deque()
+        self._next = None
+
+    def _reserve(self):
+        table = self.model.__table__
+        if db.engine.dialect.name == 'postgresql':
+            with db.engine.connect() as connection:
+                rows = connection.execute(
+                    text('SELECT nextval(:sequence) '
+                         'FROM generate_series(1, :count)'),
+                    {'sequence': f'{table.name}_id_seq',
+                     'count': self.block_size})
+                return [row[0] for row in rows]
+
+        if self._next is None:
+            highest = db.session.query(func.max(table.c.id)).scalar()
+            self._next = (highest or 0) + 1
+        start, self._next = self._next, self._next + self.block_size
+        return range(start, self._next)
+
+    def allocate(self):
+        with self._lock:
+            if not self._ids:
+                self._ids.extend(self._reserve())
+            return self._ids.popleft()
+
+
+class WriteBehindBuffer:
+    """Buffers inserts into ``model``'s table and writes them in batches."""
+
+    def __init__(self, app, model, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING,
+                 before_commit=None):
+        self.app = app
+        self.table = model.__table__
+        self.before_commit = before_commit
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._allocator = IdAllocator(model, batch_size)
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._thread = None
+        self._closed = False
+
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.failures = 0
+        self.rows_dropped = 0
+        self.dead_letters = deque(maxlen=MAX_DEAD_LETTERS)
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _start(self):
+        # started on first use rather than at creation so that a process
+        # forked after create_app gets its own thread
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def submit(self, **values):
+        """Queue a row and return the primary key it will be stored with."""
+        values['id'] = self._allocator.allocate()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('write-behind buffer is closed')
+            self._pending.append(values)
+            depth = len(self._pending)
+            self._start()
+            if depth >= self.batch_size:
+                self._condition.notify()
+
+        # the database is falling behind; make the caller wait for it
+        if depth >= self.max_pending:
+            self.flush()
+        return values['id']
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._closed and len(self._pending) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('write-behind flush failed')
+                time.sleep(self.flush_interval)
+            if closed:
+                return
+
+    @contextmanager
+    def _app_context(self):
+        if has_app_context():
+            yield
+        else:
+            with self.app.app_context():
+                yield
+
+    def flush(self):
+        """Write every pending row now; returns the number written."""
+        with self._flush_lock:
+            with self._condition:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+
+            started = time.perf_counter()
+            with self._app_context():
+                try:
+                    self._write(rows)
+                    written = rows
+                except ROW_ERRORS:
+                    db.session.rollback()
+                    self.failures += 1
+                    written = self._write_each(rows)
+                except Exception:
+                    self._requeue(rows)
+                    raise
+                if written:
+                    notify_change(self.table.name, 'insert', written)
+
+            elapsed = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.rows_flushed += len(written)
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            self._total_flush_ms += elapsed
+            return len(written)
+
+    def _write(self, rows):
+        for i in range(0, len(rows), self.batch_size):
+            db.session.execute(self.table.insert().values(
+                rows[i:i + self.batch_size]))
+        if self.before_commit is not None:
+            self.before_commit(rows)
+        db.session.commit()
+
+    def _write_each(self, rows):
+        """Write ``rows`` one per transaction, dropping those rejected."""
+        written = []
+        for position, row in enumerate(rows):
+            try:
+                self._write([row])
+            except ROW_ERRORS as error:
+                db.session.rollback()
+                self.rows_dropped += 1
+                self.dead_letters.append(row)
+                logger.error('write-behind dropped %r: %s', row,
+                             getattr(error, 'orig', error))
+            except Exception:
+                self._requeue(rows[position:])
+                raise
+            else:
+                written.append(row)
+        return written
+
+    def _requeue(self, rows):
+        db.session.rollback()
+        with self._condition:
+            self._pending[:0] = rows
+            self.failures += 1
+
+    def close(self):
+        """Stop the flusher thread after writing whatever is pending."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush()
+
+    def stats(self):
+        return {
+            'depth': len(self._pending),
+            'batch_size': self.batch_size,
+            'flush_interval': self.flush_interval,
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed,
+            'failures': self.failures,
+            'rows_dropped': self.rows_dropped,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'max_flush_ms': round(self.max_flush_ms, 3),
+            'mean_flush_ms': round(
+                self._total_flush_ms / self.flushes, 3) if self.flushes else 0,
+        }
@@ -1,7 +1,22 @@
+import functools
+import hashlib
+import heapq
+import itertools
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from sqlalchemy import (BigInteger, Column, Date, DateTime, String, Integer,
+                        ForeignKey, Index, LargeBinary, create_engine, event,
+                        exc, func, inspect, orm, select, text)
+from sqlalchemy.pool import Pool
+from sqlalchemy.sql.expression import UpdateBase
 from dotenv import load_dotenv
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 load_dotenv()
@@ -17,20 +32,232 @@ database_path = "postgresql://{}:{}@{}/{}".format(
     DB_USER, DB_PASSWORD, DB_HOST, DB_NAME
 )
 
-db = SQLAlchemy()
+# set to false where the schema is managed with `flask db upgrade`, so
+# starting a worker does not inspect every table
+DB_CREATE_ALL = os.getenv('DB_CREATE_ALL', 'true').lower() in (
+    '1', 'true', 'yes')
+
+# comma separated URLs of read replicas of the database above
+DB_REPLICA_URLS = os.getenv('DB_REPLICA_URLS', '')
+
+# engine and pool options read from the environment, as
+# (environment variable, create_engine argument, type)
+POOL_OPTIONS = [
+    ('DB_POOL_SIZE', 'pool_size', int),
+    ('DB_MAX_OVERFLOW', 'max_overflow', int),
+    ('DB_POOL_TIMEOUT', 'pool_timeout', int),
+    ('DB_POOL_RECYCLE', 'pool_recycle', int),
+    ('DB_POOL_PRE_PING', 'pool_pre_ping',
+     lambda value: value.lower() in ('1', 'true', 'yes')),
+]
+
+# options only queue-based pools accept, which SQLite does not use
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+# seconds a replica that failed is skipped, and between health checks
+REPLICA_RETRY_AFTER = 30
+REPLICA_CHECK_INTERVAL = 5
+
+# leaderboard rollups: entries kept per period, and how many past days
+# and weeks are kept before they are compacted away
+ROLLUP_TOP_N = 100
+ROLLUP_KEEP_DAYS = 14
+ROLLUP_KEEP_WEEKS = 8
+
+# near-duplicate questions: MinHash signatures of MINHASH_BANDS bands of
+# MINHASH_ROWS values over the character shingles of the question text
+SHINGLE_SIZE = 4
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4
+
+
+def engine_options(app, url):
+    """create_engine arguments from the environment and app config."""
+    options = {}
+    for variable, option, convert in POOL_OPTIONS:
+        value = os.getenv(variable)
+        if value:
+            options[option] = convert(value)
+    options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    if url.startswith('sqlite'):
+        for option in QUEUE_POOL_OPTIONS:
+            options.pop(option, None)
+    return options
+
+
+@event.listens_for(Pool, 'connect')
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    # a connection inherited across fork (e.g. gunicorn --preload) still
+    # belongs to the parent: drop it without closing the parent's socket
+    # and let the pool open a new one
+    if connection_record.info.get('pid') != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'connection was opened by another process')
+
+
+def dispose_engines(app):
+    """Close the pooled connections of the app's primary and replicas."""
+    db.get_engine(app).dispose()
+    router = app.extensions.get('trivia_replicas')
+    if router is not None:
+        router.dispose()
+
+
+class ReplicaRouter:
+    """
+    Round-robin over read replicas. A replica whose connection fails is
+    skipped for ``retry_after`` seconds; when none is usable reads go to
+    the primary.
+    """
+
+    def __init__(self, urls, options, retry_after=REPLICA_RETRY_AFTER,
+                 check_interval=REPLICA_CHECK_INTERVAL):
+        self.engines = [create_engine(url, **options) for url in urls]
+        self.retry_after = retry_after
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._order = itertools.cycle(self.engines)
+        self._down_until = {}
+        self._checked_at = {}
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._on_error)
+
+    def _on_error(self, context):
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine):
+        self._down_until[engine] = time.monotonic() + self.retry_after
+
+    def _healthy(self, engine, now):
+        if self._down_until.get(engine, 0) > now:
+            return False
+        if now - self._checked_at.get(engine, 0) < self.check_interval:
+            return True
+        try:
+            with engine.connect():
+                pass
+        except Exception:
+            self.mark_down(engine)
+            return False
+        self._checked_at[engine] = now
+        return True
+
+    def choose(self):
+        now = time.monotonic()
+        for _ in range(len(self.engines)):
+            with self._lock:
+                engine = next(self._order)
+            if self._healthy(engine, now):
+                return engine
+        return None
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def read_from_replica():
+    """Let the rest of this request read from a replica if there is one."""
+    g.read_replica = True
+
+
+def _route_reads():
+    g.read_replica = request.method in ('GET', 'HEAD')
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends reads of requests marked with read_from_replica to a replica.
+    Writes, and everything after the first write of a session, go to the
+    primary so a request always reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase) or self._flushing:
+            self.info['wrote'] = True
+        router = self.app.extensions.get('trivia_replicas')
+        if router is not None and not self.info.get('wrote') and \
+                has_request_context() and g.get('read_replica', False):
+            replica = self.info.get('replica') or router.choose()
+            if replica is not None:
+                self.info['replica'] = replica
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service; pool options come
+    from the DB_POOL_* environment variables or SQLALCHEMY_ENGINE_OPTIONS
+    and read replicas from DB_REPLICA_URLS or SQLALCHEMY_REPLICA_URIS;
+    tables are created unless DB_CREATE_ALL is off
 """
 
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    options = engine_options(app, database_path)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    replicas = app.config.get("SQLALCHEMY_REPLICA_URIS") or \
+        [url for url in DB_REPLICA_URLS.split(',') if url]
+    previous = app.extensions.pop('trivia_replicas', None)
+    if previous is not None:
+        previous.dispose()
+    if replicas:
+        app.extensions['trivia_replicas'] = ReplicaRouter(
+            replicas, engine_options(app, replicas[0]))
+    if not app.extensions.get('trivia_routes_reads'):
+        app.before_request(_route_reads)
+        app.extensions['trivia_routes_reads'] = True
+
     db.app = app
     db.init_app(app)
-    db.create_all()
+    if app.config.get("DB_CREATE_ALL", DB_CREATE_ALL):
+        counted = db.engine.has_table(QuestionCount.__tablename__)
+        db.create_all()
+        # the counts of an existing database start out right; its
+        # question_bands are left empty, as hashing every question takes
+        # far too long for startup, until `flask db upgrade` or
+        # `flask find-duplicates --rebuild` fills them
+        if not counted:
+            with db.engine.begin() as connection:
+                reconcile_question_counts(connection)
+
+
+"""
+add_change_listener(app, listener)
+    registers a callable told about rows written through the model
+    helpers below, as listener(table, action, rows) with rows formatted;
+    action 'invalidate' (with no rows) means rows changed in bulk and
+    anything derived from the table must be rebuilt
+"""
+
+
+def add_change_listener(app, listener):
+    app.extensions.setdefault('trivia_listeners', []).append(listener)
+
+
+def notify_change(table, action, rows):
+    app = db.get_app()
+    for listener in app.extensions.get('trivia_listeners', []):
+        listener(table, action, rows)
 
 
 """
@@ -41,11 +268,17 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    # existing databases get these through `flask db upgrade`
+    __table_args__ = (
+        Index('ix_questions_category', 'category', 'id'),
+        Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey(
+        'categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -54,16 +287,39 @@ class Question(db.Model):
         self.category = category
         self.difficulty = difficulty
 
+    def _committed(self, name):
+        history = inspect(self).attrs[name].history
+        return history.deleted[0] if history.deleted else getattr(self, name)
+
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        bump_question_counts({(self.category, self.difficulty): 1})
+        add_question_bands([(self.id, self.question)])
         db.session.commit()
+        notify_change(self.__tablename__, 'insert', [self.format()])
 
     def update(self):
+        before = (self._committed('category'), self._committed('difficulty'))
+        after = (self.category, self.difficulty)
+        reworded = self._committed('question') != self.question
+        db.session.flush()
+        if before != after:
+            bump_question_counts({before: -1, after: 1})
+        if reworded:
+            remove_question_bands([self.id])
+            add_question_bands([(self.id, self.question)])
         db.session.commit()
+        notify_change(self.__tablename__, 'update', [self.format()])
 
     def delete(self):
+        row = self.format()
         db.session.delete(self)
+        db.session.flush()
+        bump_question_counts({(self.category, self.difficulty): -1})
+        remove_question_bands([self.id])
         db.session.commit()
+        notify_change(self.__tablename__, 'delete', [row])
 
     def format(self):
         return {
@@ -75,6 +331,205 @@ class Question(db.Model):
         }
 
 
+"""
+QuestionCount
+    questions per (category, difficulty), kept up to date in the same
+    transaction as every write to questions; 0 stands for NULL
+"""
+
+
+class QuestionCount(db.Model):
+    __tablename__ = 'question_counts'
+
+    category = Column(Integer, primary_key=True, autoincrement=False)
+    difficulty = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def total(cls, category=None, difficulty=None):
+        query = db.session.query(func.coalesce(func.sum(cls.count), 0))
+        if category is not None:
+            query = query.filter(cls.category == category)
+        if difficulty is not None:
+            query = query.filter(cls.difficulty == difficulty)
+        return int(query.scalar())
+
+
+_BUMP_COUNT = text(
+    'INSERT INTO question_counts (category, difficulty, count) '
+    'VALUES (:category, :difficulty, :delta) '
+    'ON CONFLICT (category, difficulty) '
+    'DO UPDATE SET count = question_counts.count + excluded.count')
+
+
+def bump_question_counts(changes):
+    """
+    Add {(category, difficulty): delta} to the counts in the current
+    transaction; call it after flushing the question rows themselves.
+    """
+    params = [{'category': category or 0, 'difficulty': difficulty or 0,
+               'delta': delta}
+              for (category, difficulty), delta in changes.items() if delta]
+    if params:
+        db.session.execute(_BUMP_COUNT, params)
+
+
+def reconcile_question_counts(connection):
+    """
+    Recount questions per (category, difficulty) and correct the stored
+    counts in the connection's transaction. Returns the keys that had
+    drifted as {(category, difficulty): (stored, actual)}.
+    """
+    counts = QuestionCount.__table__
+    if connection.dialect.name == 'postgresql':
+        # writers wait for the recount instead of slipping in between
+        connection.execute(text(
+            'LOCK TABLE question_counts IN EXCLUSIVE MODE'))
+
+    actual = Counter()
+    for category, difficulty, count in connection.execute(
+            select([Question.category, Question.difficulty, func.count()])
+            .group_by(Question.category, Question.difficulty)):
+        actual[(category or 0, difficulty or 0)] += count
+    stored = {(category, difficulty): count
+              for category, difficulty, count in connection.execute(
+                  select([counts.c.category, counts.c.difficulty,
+                          counts.c.count]))}
+
+    drift = {key: (stored.get(key, 0), actual[key])
+             for key in set(stored) | set(actual)
+             if stored.get(key, 0) != actual[key]}
+    for (category, difficulty), (_, count) in drift.items():
+        if (category, difficulty) in stored:
+            connection.execute(counts.update().where(
+                (counts.c.category == category) &
+                (counts.c.difficulty == difficulty)).values(count=count))
+        else:
+            connection.execute(counts.insert().values(
+                category=category, difficulty=difficulty, count=count))
+    return drift
+
+
+"""
+QuestionBand
+    the locality-sensitive hashing buckets of every question: one row per
+    band of its MinHash signature, kept up to date in the same transaction
+    as every write to questions. Questions sharing a bucket are candidate
+    near-duplicates, so finding them is an indexed lookup of a question's
+    MINHASH_BANDS buckets instead of a comparison with every row.
+"""
+
+
+class QuestionBand(db.Model):
+    __tablename__ = 'question_bands'
+    __table_args__ = (
+        Index('ix_question_bands_bucket', 'bucket'),
+    )
+
+    question_id = Column(Integer, primary_key=True, autoincrement=False)
+    band = Column(Integer, primary_key=True, autoincrement=False)
+    bucket = Column(BigInteger, nullable=False)
+
+
+_NOT_WORD = re.compile(r'[\W_]+')
+_PRIME = (1 << 61) - 1
+# fixed so signatures stored by one process match those of every other
+_seeds = random.Random(MINHASH_BANDS * MINHASH_ROWS)
+_PERMUTATIONS = [
+    (_seeds.randrange(1, _PRIME), _seeds.randrange(_PRIME))
+    for _ in range(MINHASH_BANDS * MINHASH_ROWS)]
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(
+        value.encode(), digest_size=8).digest(), 'big', signed=True)
+
+
+def normalize_question(value):
+    """Lower case words separated by single spaces, punctuation dropped."""
+    value = '' if value is None else str(value)
+    return _NOT_WORD.sub(' ', value.lower()).strip()
+
+
+def question_shingles(value):
+    """The set of SHINGLE_SIZE character runs of the normalized text."""
+    value = normalize_question(value)
+    if len(value) <= SHINGLE_SIZE:
+        return {value} if value else set()
+    return {value[i:i + SHINGLE_SIZE]
+            for i in range(len(value) - SHINGLE_SIZE + 1)}
+
+
+def similarity(shingles, other):
+    """Jaccard similarity of two shingle sets."""
+    if not shingles or not other:
+        return 0.0
+    return len(shingles & other) / len(shingles | other)
+
+
+def question_buckets(shingles):
+    """The MINHASH_BANDS bucket keys of a shingle set, [] if it is empty."""
+    if not shingles:
+        return []
+    values = [_hash64(shingle) % _PRIME for shingle in shingles]
+    signature = [min((a * value + b) % _PRIME for value in values)
+                 for a, b in _PERMUTATIONS]
+    return [_hash64('{}:{}'.format(band, signature[
+                band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]))
+            for band in range(MINHASH_BANDS)]
+
+
+@functools.lru_cache(maxsize=4096)
+def question_signature(value):
+    """
+    (shingles, buckets) of a question text; cached, as texts are checked
+    for duplicates just before their buckets are stored.
+    """
+    shingles = frozenset(question_shingles(value))
+    return shingles, tuple(question_buckets(shingles))
+
+
+def _band_rows(rows):
+    return [{'question_id': question_id, 'band': band, 'bucket': bucket}
+            for question_id, value in rows
+            for band, bucket in enumerate(question_signature(value)[1])]
+
+
+def add_question_bands(rows, connection=None):
+    """
+    Store the buckets of (id, question text) ``rows`` in the current
+    transaction, or that of ``connection``.
+    """
+    params = _band_rows(rows)
+    if params:
+        (connection or db.session).execute(
+            QuestionBand.__table__.insert(), params)
+
+
+def remove_question_bands(ids):
+    """Drop the buckets of these question ids in the current transaction."""
+    if ids:
+        db.session.execute(QuestionBand.__table__.delete().where(
+            QuestionBand.question_id.in_(ids)))
+
+
+def rebuild_question_bands(connection, batch_size=1000):
+    """
+    Recompute the buckets of every question in the connection's
+    transaction; returns the number of questions.
+    """
+    connection.execute(QuestionBand.__table__.delete())
+    rows = connection.execution_options(stream_results=True).execute(
+        select([Question.id, Question.question]))
+    total = 0
+    while True:
+        batch = rows.fetchmany(batch_size)
+        if not batch:
+            return total
+        add_question_bands(batch, connection)
+        total += len(batch)
+
+
 """
 Category
 
@@ -90,6 +545,21 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        notify_change(self.__tablename__, 'insert', [self.format()])
+
+    def update(self):
+        db.session.commit()
+        notify_change(self.__tablename__, 'update', [self.format()])
+
+    def delete(self):
+        row = self.format()
+        db.session.delete(self)
+        db.session.commit()
+        notify_change(self.__tablename__, 'delete', [row])
+
     def format(self):
         return {
             'id': self.id,
@@ -97,20 +567,46 @@ class Category(db.Model):
         }
 
 
+"""
+QuizSession
+    a server-side quiz: its shuffled question ids, packed as 32-bit little
+    endian integers, how many of them were dealt and when it expires (UTC).
+    Kept in the database so any worker can deal a session's next question.
+"""
+
+
+class QuizSession(db.Model):
+    __tablename__ = 'quiz_sessions'
+    __table_args__ = (
+        Index('ix_quiz_sessions_expires_at', 'expires_at'),
+    )
+
+    id = Column(String(32), primary_key=True)
+    deck = Column(LargeBinary, nullable=False)
+    dealt = Column(Integer, nullable=False, default=0)
+    expires_at = Column(DateTime, nullable=False)
+
+
 class Leaderboard(db.Model):
     __tablename__ = 'leaderboard'
 
     id = Column(Integer, primary_key=True)
     player = Column(String)
     score = Column(Integer)
+    # UTC; NULL for entries submitted before the column existed
+    created_at = Column(DateTime, default=datetime.utcnow)
 
-    def __init__(self, player, score):
+    def __init__(self, player, score, created_at=None):
         self.player = player
         self.score = score
+        self.created_at = created_at or datetime.utcnow()
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        record_scores([{**self.format(), 'created_at': self.created_at}])
         db.session.commit()
+        notify_change(self.__tablename__, 'insert', [self.format()])
 
     def format(self):
         return {
@@ -118,3 +614,162 @@ class Leaderboard(db.Model):
             'player': self.player,
             'score': self.score,
         }
+
+
+# the board is read highest score first, ties in order of submission
+Index('ix_leaderboard_score', Leaderboard.score.desc(), Leaderboard.id)
+
+
+"""
+LeaderboardRollup
+    the best ROLLUP_TOP_N entries of each UTC day, of each week (starting
+    on Monday) and of all time, kept up to date in the same transaction
+    as every leaderboard insert, so the windowed boards are read without
+    touching the leaderboard table
+"""
+
+
+class LeaderboardRollup(db.Model):
+    __tablename__ = 'leaderboard_rollups'
+
+    span = Column(String(8), primary_key=True)
+    period = Column(Date, primary_key=True)
+    entry_id = Column(Integer, primary_key=True, autoincrement=False)
+    player = Column(String)
+    score = Column(Integer, nullable=False)
+
+
+Index('ix_leaderboard_rollups_rank', LeaderboardRollup.span,
+      LeaderboardRollup.period, LeaderboardRollup.score.desc(),
+      LeaderboardRollup.entry_id)
+
+ROLLUP_SPANS = ('day', 'week', 'all')
+
+# the single period of the all-time rollup
+ALL_TIME = date(1970, 1, 1)
+
+
+def rollup_period(span, moment):
+    """The first day of the ``span`` period ``moment`` falls in."""
+    if span == 'all':
+        return ALL_TIME
+    day = moment.date() if isinstance(moment, datetime) else moment
+    if span == 'week':
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def _trim_rollup(span, period, top):
+    table = LeaderboardRollup.__table__
+    in_period = (table.c.span == span) & (table.c.period == period)
+    beyond = select([table.c.entry_id]).where(in_period).order_by(
+        table.c.score.desc(), table.c.entry_id).offset(top)
+    db.session.execute(table.delete().where(
+        in_period & table.c.entry_id.in_(beyond)))
+
+
+_compacted_on = None
+
+
+def _expired_before(today, keep_days, keep_weeks):
+    """{span: first period still kept} for the spans that expire."""
+    return {
+        'day': today - timedelta(days=keep_days),
+        'week': rollup_period('week', today) - timedelta(weeks=keep_weeks),
+    }
+
+
+def record_scores(rows):
+    """
+    Add new leaderboard rows, with their ``created_at``, to the rollups
+    of their day, week and of all time in the current transaction and
+    trim each of those back to its best entries. Once a day each process
+    also compacts away the periods that have expired.
+    """
+    global _compacted_on
+    config = db.get_app().config
+    top = config.get('LEADERBOARD_TOP_N', ROLLUP_TOP_N)
+    periods = {}
+    for row in rows:
+        for span in ROLLUP_SPANS:
+            if span != 'all' and row['created_at'] is None:
+                continue
+            periods.setdefault(
+                (span, rollup_period(span, row['created_at'])), []).append(
+                    row)
+    for (span, period), entries in periods.items():
+        best = heapq.nsmallest(
+            top, entries, key=lambda row: (-(row['score'] or 0), row['id']))
+        db.session.execute(LeaderboardRollup.__table__.insert(), [
+            {'span': span, 'period': period, 'entry_id': row['id'],
+             'player': row['player'], 'score': row['score'] or 0}
+            for row in best])
+        _trim_rollup(span, period, top)
+
+    today = datetime.utcnow().date()
+    if _compacted_on != today:
+        compact_rollups(
+            db.session, today,
+            config.get('LEADERBOARD_KEEP_DAYS', ROLLUP_KEEP_DAYS),
+            config.get('LEADERBOARD_KEEP_WEEKS', ROLLUP_KEEP_WEEKS))
+        _compacted_on = today
+
+
+def compact_rollups(connection, today, keep_days=ROLLUP_KEEP_DAYS,
+                    keep_weeks=ROLLUP_KEEP_WEEKS):
+    """
+    Delete the day and week rollups older than ``keep_days`` days and
+    ``keep_weeks`` weeks; returns the number of rows deleted.
+    """
+    table = LeaderboardRollup.__table__
+    deleted = 0
+    for span, oldest in _expired_before(
+            today, keep_days, keep_weeks).items():
+        deleted += connection.execute(table.delete().where(
+            (table.c.span == span) & (table.c.period < oldest))).rowcount
+    return deleted
+
+
+def rebuild_rollups(connection, today=None, top=ROLLUP_TOP_N,
+                    keep_days=ROLLUP_KEEP_DAYS, keep_weeks=ROLLUP_KEEP_WEEKS):
+    """
+    Recompute every rollup from the leaderboard table in the connection's
+    transaction, e.g. after rows were written with plain SQL. Returns the
+    number of rollup rows written.
+    """
+    table = LeaderboardRollup.__table__
+    board = Leaderboard.__table__
+    if connection.dialect.name == 'postgresql':
+        # writers wait for the rebuild instead of slipping in between
+        connection.execute(text(
+            'LOCK TABLE leaderboard_rollups IN EXCLUSIVE MODE'))
+    connection.execute(table.delete())
+
+    columns = [board.c.id, board.c.player, board.c.score]
+    entries = {('all', ALL_TIME): [tuple(row) for row in connection.execute(
+        select(columns).order_by(board.c.score.desc(), board.c.id)
+        .limit(top))]}
+
+    kept = _expired_before(today or datetime.utcnow().date(), keep_days,
+                           keep_weeks)
+    since = datetime.combine(min(kept.values()), datetime.min.time())
+    recent = {}
+    for entry_id, player, score, created_at in connection.execute(
+            select(columns + [board.c.created_at]).where(
+                board.c.created_at >= since)):
+        for span, oldest in kept.items():
+            period = rollup_period(span, created_at)
+            if period >= oldest:
+                recent.setdefault((span, period), []).append(
+                    (entry_id, player, score))
+    for key, rows in recent.items():
+        entries[key] = heapq.nsmallest(
+            top, rows, key=lambda row: (-(row[2] or 0), row[0]))
+
+    values = [{'span': span, 'period': period, 'entry_id': entry_id,
+               'player': player, 'score': score or 0}
+              for (span, period), rows in entries.items()
+              for entry_id, player, score in rows]
+    if values:
+        connection.execute(table.insert(), values)
+    return len(values)
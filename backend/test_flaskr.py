@@ -1,15 +1,37 @@
+import asyncio
+import gzip
 import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 import json
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from flask import request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, inspect, text
 
 from flaskr import create_app
-from models import setup_db, Question, Category, Leaderboard
+from flaskr.aio import WsgiToAsgi, asyncpg, create_asgi_app
+from benchmark import datasets, runner
+from flaskr.pagination import encode_cursor
+from flaskr.encoding import BACKENDS, DEFAULT_BACKEND, use_backend
+from flaskr import migrations
+from flaskr.admission import Limiter
+from flaskr.startup import prepare
+from flaskr.shared import SharedIdStore
+from flaskr.suggest import PrefixIndex
+from models import (setup_db, rollup_period, question_signature, Question,
+                    QuestionBand, QuestionCount, Category, Leaderboard,
+                    LeaderboardRollup)
 
 load_dotenv()
 
+requires_asgi = unittest.skipIf(asyncpg is None or WsgiToAsgi is None,
+                                'asyncpg or asgiref is not installed')
+
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
@@ -52,6 +74,50 @@ class TriviaTestCase(unittest.TestCase):
         """Executed after reach test"""
         pass
 
+    def replicated_app(self, replica_path):
+        directory = tempfile.mkdtemp()
+        primary = os.path.join(directory, 'primary.db')
+        app = create_app({"SQLALCHEMY_REPLICA_URIS": [replica_path]})
+        setup_db(app, f'sqlite:///{primary}')
+        return app, primary
+
+    def test_reads_go_to_replica_and_writes_to_primary(self):
+        replica = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        app, primary = self.replicated_app(f'sqlite:///{replica}')
+        Question.metadata.create_all(create_engine(f'sqlite:///{replica}'))
+        for path, name in [(primary, 'Primary'), (replica, 'Replica')]:
+            with sqlite3.connect(path) as connection:
+                connection.execute(
+                    "INSERT INTO categories (id, type) VALUES (1, ?)", (name,))
+        client = app.test_client()
+
+        categories = json.loads(client.get('/categories').data)['categories']
+        created = json.loads(client.post(
+            '/questions', json=self.new_question).data)['created']
+
+        self.assertEqual(categories[0]['type'], 'Replica')
+        with sqlite3.connect(primary) as connection:
+            stored = connection.execute(
+                "SELECT question FROM questions WHERE id = ?",
+                (created['id'],)).fetchone()
+        self.assertEqual(stored[0], self.new_question['question'])
+        with sqlite3.connect(replica) as connection:
+            self.assertEqual(connection.execute(
+                "SELECT count(*) FROM questions").fetchone()[0], 0)
+
+    def test_reads_fail_over_to_primary(self):
+        app, primary = self.replicated_app(
+            'sqlite:////nonexistent/directory/replica.db')
+        with sqlite3.connect(primary) as connection:
+            connection.execute(
+                "INSERT INTO categories (id, type) VALUES (1, 'Primary')")
+
+        res = app.test_client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['categories'][0]['type'], 'Primary')
+
     def test_get_paginated_questions_success(self):
         res = self.client().get("/questions")
         data = json.loads(res.data)
@@ -63,6 +129,32 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categories'])
         self.assertIsNone(data['current_category'])
 
+    def test_get_questions_gzip(self):
+        plain = self.client().get('/questions')
+        res = self.client().get(
+            '/questions', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(res.data)),
+                         json.loads(plain.data))
+        self.assertEqual(self.client().get('/questions', headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': res.headers['ETag']
+        }).status_code, 304)
+
+    def test_get_questions_json_backends_agree(self):
+        documents = []
+        for backend in BACKENDS:
+            app = create_app({"JSON_BACKEND": backend})
+            setup_db(app, self.database_path)
+            documents.append(json.loads(app.test_client().get(
+                '/questions').data))
+        use_backend(DEFAULT_BACKEND)
+
+        for document in documents[1:]:
+            self.assertEqual(document, documents[0])
+
     def test_get_paginated_questions_error_beyond_valid_page(self):
         res = self.client().get("/questions?page=1000")
         data = json.loads(res.data)
@@ -71,6 +163,108 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_get_questions_pages_do_not_overlap(self):
+        first = json.loads(self.client().get("/questions?page=1").data)
+        second = json.loads(self.client().get("/questions?page=2").data)
+
+        first_ids = [question['id'] for question in first['questions']]
+        second_ids = [question['id'] for question in second['questions']]
+        self.assertEqual(len(first_ids), 10)
+        self.assertFalse(set(first_ids) & set(second_ids))
+        self.assertEqual(first['total_questions'], second['total_questions'])
+
+    def test_get_questions_with_cursor(self):
+        first = json.loads(self.client().get("/questions").data)
+        self.assertTrue(first['next_cursor'])
+
+        res = self.client().get(f"/questions?cursor={first['next_cursor']}")
+        data = json.loads(res.data)
+        page_two = json.loads(self.client().get("/questions?page=2").data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'], page_two['questions'])
+
+    def test_get_questions_after_id(self):
+        last_id = json.loads(
+            self.client().get("/questions").data)['questions'][-1]['id']
+        res = self.client().get(f"/questions?after={last_id}")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(
+            all(question['id'] > last_id for question in data['questions']))
+
+    def test_get_questions_malformed_cursor_error(self):
+        res = self.client().get("/questions?cursor=not-a-cursor")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_get_questions_cursor_of_wrong_shape_error(self):
+        shared, = self.shared_apps(1)
+        for values in ([{"a": 1}], ["5"], [True], [1, 2], []):
+            cursor = encode_cursor(values)
+            for client, path in ((self.client(), '/questions'),
+                                 (self.client(), '/categories/1/questions'),
+                                 (shared.test_client(), '/questions')):
+                res = client.get(f"{path}?cursor={cursor}")
+
+                self.assertEqual(res.status_code, 400)
+                self.assertEqual(json.loads(res.data)['message'],
+                                 'bad request')
+
+        for values in ([{"a": 1}, 1], ["5", 1], [1]):
+            res = self.client().get(
+                f"/leaderboard?cursor={encode_cursor(values)}")
+            self.assertEqual(res.status_code, 400)
+
+    def test_get_questions_sparse_fields(self):
+        statements = []
+
+        def executed(connection, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self.db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', executed)
+        try:
+            response = self.client().get(
+                '/questions?fields=question,difficulty')
+        finally:
+            event.remove(engine, 'before_cursor_execute', executed)
+        data = json.loads(response.data)
+        full = json.loads(self.client().get('/questions').data)
+
+        self.assertEqual(response.status_code, 200)
+        for question in data['questions']:
+            self.assertEqual(set(question), {'id', 'question', 'difficulty'})
+        self.assertEqual(data['categories'], full['categories'])
+        self.assertEqual(set(full['questions'][0]),
+                         {'id', 'question', 'answer', 'category',
+                          'difficulty'})
+        self.assertTrue(any('questions.question' in statement
+                            for statement in statements))
+        self.assertFalse(any('questions.answer' in statement
+                             for statement in statements))
+
+    def test_get_questions_include(self):
+        slim = json.loads(self.client().get('/questions?include=').data)
+        category = json.loads(self.client().get(
+            '/categories/1/questions?include=categories&fields=answer').data)
+        plain = json.loads(self.client().get('/categories/1/questions').data)
+
+        self.assertNotIn('categories', slim)
+        self.assertIn('categories', category)
+        self.assertEqual(set(category['questions'][0]), {'id', 'answer'})
+        self.assertNotIn('categories', plain)
+
+    def test_sparse_fields_bad_request(self):
+        for path in ('/questions?fields=id,secret',
+                     '/questions?include=answers',
+                     '/leaderboard?fields=question'):
+            response = self.client().get(path)
+            self.assertEqual(response.status_code, 400)
+
     def test_get_all_categories(self):
         res = self.client().get('/categories')
         data = json.loads(res.data)
@@ -80,6 +274,37 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['categories']))
         self.assertTrue(data['total_categories'])
 
+    def test_get_categories_not_modified(self):
+        first = self.client().get('/categories')
+        etag = first.headers['ETag']
+
+        res = self.client().get(
+            '/categories', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertTrue(first.headers['Last-Modified'])
+
+    def test_get_questions_etag_changes_after_insert(self):
+        etag = self.client().get('/questions').headers['ETag']
+        self.assertEqual(self.client().get(
+            '/questions', headers={'If-None-Match': etag}).status_code, 304)
+
+        created = json.loads(self.client().post(
+            '/questions', json=self.new_question).data)['created']['id']
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+        self.client().delete(f'/questions/{created}')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_questions_etag_depends_on_page(self):
+        first = self.client().get('/questions?page=1').headers['ETag']
+        res = self.client().get(
+            '/questions?page=2', headers={'If-None-Match': first})
+
+        self.assertEqual(res.status_code, 200)
+
     def test_get_questions_based_on_category_success(self):
         category_id = 1
         res = self.client().get(f'/categories/{category_id}/questions')
@@ -134,6 +359,69 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def create_questions(self, count, **values):
+        question = {**self.new_question, **values}
+        return [json.loads(self.client().post(
+            '/questions', json=question).data)['created']['id']
+            for _ in range(count)]
+
+    def test_delete_questions_in_batch(self):
+        ids = self.create_questions(3, category=6)
+        before = json.loads(self.client().get(
+            '/categories/6/questions').data)['total_questions']
+
+        response = self.client().delete(
+            '/questions', json={"ids": ids + [100000000]})
+        data = json.loads(response.data)
+        after = json.loads(self.client().get(
+            '/categories/6/questions').data)['total_questions']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], ids)
+        self.assertEqual(data['missing'], [100000000])
+        self.assertEqual(after, before - 3)
+        self.assertEqual(
+            Question.query.filter(Question.id.in_(ids)).count(), 0)
+        self.assertFalse(
+            set(ids) & set(self.app.extensions['trivia']['pool'].ids(6)))
+
+    def test_update_questions_in_batch(self):
+        ids = self.create_questions(2, category=6, difficulty=1)
+        with self.app.app_context():
+            before = QuestionCount.total(5, 4)
+
+        response = self.client().post('/questions/batch', json={
+            "ids": ids, "category": 5, "difficulty": 4})
+        data = json.loads(response.data)
+        with self.app.app_context():
+            after = QuestionCount.total(5, 4)
+        pool = self.app.extensions['trivia']['pool']
+        moved = set(pool.ids(5, 4))
+        self.client().post('/questions/batch', json={
+            "ids": ids, "delete": True})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['updated'], ids)
+        self.assertEqual(after, before + 2)
+        self.assertTrue(set(ids) <= moved)
+        self.assertEqual(Question.query.filter(
+            Question.id.in_(ids)).count(), 0)
+
+    def test_batch_bad_request_error(self):
+        for method, body in [
+                ('delete', {"ids": []}),
+                ('delete', {"ids": ["one"]}),
+                ('post', {"ids": [1]}),
+                ('post', {"ids": [1], "difficulty": "hard"})]:
+            url = '/questions' if method == 'delete' else '/questions/batch'
+            response = getattr(self.client(), method)(url, json=body)
+
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client().post('/questions/batch', json={
+            "ids": [1], "category": 1000})
+        self.assertEqual(response.status_code, 422)
+
     def test_created_question_success(self):
         response = self.client().post('/questions', json=self.new_question)
         data = json.loads(response.data)
@@ -160,6 +448,19 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'bad request')
 
+    def test_create_question_wrong_types_error(self):
+        before = Question.query.count()
+        for key, value in (("question", ["x"]), ("answer", {"a": 1}),
+                           ("question", True), ("category", "History"),
+                           ("difficulty", [1])):
+            response = self.client().post(
+                '/questions', json={**self.new_question, key: value})
+
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(json.loads(response.data)['message'],
+                             'unprocessable')
+        self.assertEqual(Question.query.count(), before)
+
     def test_create_question_question_is_missing_error(self):
         request = self.new_question.copy()
         del request["question"]
@@ -226,6 +527,217 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unprocessable')
 
+    def test_bulk_import_ndjson(self):
+        lines = [
+            {"question": "Bulk one?", "answer": "1", "difficulty": 1,
+             "category": 1},
+            {"question": "Bulk two?", "answer": "2", "difficulty": 2,
+             "category": 1},
+            {"question": "Bulk missing answer?", "difficulty": 2,
+             "category": 1},
+            {"question": "Bulk three?", "answer": "3", "difficulty": 3,
+             "category": 1000},
+        ]
+        body = "\n".join(json.dumps(line) for line in lines) + "\n{oops\n"
+
+        response = self.client().post(
+            '/questions/bulk?batch_size=1', data=body,
+            content_type='application/x-ndjson')
+        data = json.loads(response.data)
+        imported = Question.query.filter(Question.question.like('Bulk%'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['failed'], 3)
+        self.assertEqual([error['line'] for error in data['errors']],
+                         [3, 4, 5])
+        self.assertEqual(imported.count(), 2)
+        for question in imported.all():
+            question.delete()
+
+    def test_bulk_import_csv(self):
+        body = ("question,answer,difficulty,category\n"
+                "\"Bulk, with a comma?\",Yes,1,2\n"
+                "Bulk bad difficulty?,No,hard,2\n")
+        questions = json.loads(
+            self.client().get('/categories/2/questions').data)
+
+        response = self.client().post(
+            '/questions/bulk', data=body, content_type='text/csv')
+        data = json.loads(response.data)
+        after = json.loads(self.client().get('/categories/2/questions').data)
+        imported = Question.query.filter(Question.question.like('Bulk%'))
+
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['errors'], [
+            {"line": 3, "error": "difficulty must be an integer"}])
+        self.assertEqual(after['total_questions'],
+                         questions['total_questions'] + 1)
+        self.assertEqual(imported.first().question, 'Bulk, with a comma?')
+        for question in imported.all():
+            question.delete()
+
+    def test_bulk_import_csv_invalid_utf8(self):
+        body = ("question,answer,difficulty,category\n"
+                "Bulk in \xe9 Latin-1?,Oui,1,2\n").encode('latin-1') + \
+            "Bulk caf\u00e9?,Yes,1,2\n".encode('utf-8')
+
+        response = self.client().post(
+            '/questions/bulk', data=body, content_type='text/csv')
+        data = json.loads(response.data)
+        imported = Question.query.filter(Question.question.like('Bulk%'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['errors'], [
+            {"line": 2, "error": "invalid UTF-8"}])
+        self.assertEqual(imported.one().question, 'Bulk caf\u00e9?')
+        for question in imported.all():
+            question.delete()
+
+    def test_create_question_warns_about_near_duplicates(self):
+        question = {**self.new_question,
+                    "question": "Which planet is nicknamed the Red Planet?"}
+        first = json.loads(self.client().post(
+            '/questions', json=question).data)['created']['id']
+        question["question"] = "Which planet is nick-named 'the red planet'"
+        response = self.client().post('/questions', json=question)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['duplicates'][0]['id'], first)
+        self.assertGreaterEqual(data['duplicates'][0]['similarity'], 0.8)
+
+        self.client().delete(f"/questions/{data['created']['id']}")
+        self.client().delete(f'/questions/{first}')
+        data = json.loads(self.client().post(
+            '/questions?duplicates=allow', json=question).data)
+        self.assertNotIn('duplicates', data)
+        self.client().delete(f"/questions/{data['created']['id']}")
+
+    def test_create_question_rejects_near_duplicates(self):
+        question = {**self.new_question,
+                    "question": "What is the largest ocean on Earth?"}
+        first = json.loads(self.client().post(
+            '/questions', json=question).data)['created']['id']
+        question["question"] = "What is the largest ocean on the Earth?"
+        total = Question.query.count()
+
+        response = self.client().post(
+            '/questions?duplicates=reject', json=question)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(data['message'], 'conflict')
+        self.assertEqual([match['id'] for match in data['duplicates']],
+                         [first])
+        self.assertEqual(Question.query.count(), total)
+        self.assertEqual(self.client().post(
+            '/questions?duplicates=maybe', json=question).status_code, 400)
+        self.client().delete(f'/questions/{first}')
+
+    def test_bulk_import_rejects_near_duplicates(self):
+        existing = self.create_questions(
+            1, question="Dupe: who painted the Mona Lisa?")[0]
+        lines = [
+            {"question": "Dupe: who painted the Mona Lisa", "answer": "1",
+             "difficulty": 1, "category": 1},
+            {"question": "Dupe: how many strings has a violin?",
+             "answer": "4", "difficulty": 1, "category": 1},
+            {"question": "Dupe: how many strings has a violin?!",
+             "answer": "4", "difficulty": 1, "category": 1},
+        ]
+        body = "\n".join(json.dumps(line) for line in lines)
+
+        response = self.client().post(
+            '/questions/bulk?duplicates=reject', data=body,
+            content_type='application/x-ndjson')
+        data = json.loads(response.data)
+
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['errors'], [
+            {"line": 1, "error": f"duplicate of question {existing}"},
+            {"line": 3, "error": "duplicate of line 2"}])
+        for question in Question.query.filter(
+                Question.question.like('Dupe:%')).all():
+            question.delete()
+
+    def test_question_bands_left_to_rebuild(self):
+        path = os.path.join(tempfile.mkdtemp(), 'bands.db')
+        app = create_app({"IMPORT_QUESTION_BANDS": False})
+        setup_db(app, f'sqlite:///{path}')
+        body = "\n".join(json.dumps({**self.new_question, "category": 1,
+                                     "question": f"Unbanded {number}?"})
+                         for number in range(3))
+        with app.app_context():
+            Category(type="Science").insert()
+        response = app.test_client().post(
+            '/questions/bulk', data=body,
+            content_type='application/x-ndjson')
+        self.assertEqual(json.loads(response.data)['inserted'], 3)
+
+        engine = create_engine(f'sqlite:///{path}')
+        with engine.begin() as connection:
+            self.assertEqual(connection.execute(text(
+                'SELECT count(*) FROM question_bands')).scalar(), 0)
+            connection.execute(text('DROP TABLE question_bands'))
+        # startup only creates the table again
+        app = create_app()
+        setup_db(app, f'sqlite:///{path}')
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text(
+                'SELECT count(*) FROM question_bands')).scalar(), 0)
+
+        result = app.test_cli_runner().invoke(
+            args=['find-duplicates', '--rebuild'])
+        self.assertEqual(result.exit_code, 0)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text(
+                'SELECT count(DISTINCT question_id) FROM question_bands'
+            )).scalar(), 3)
+
+    def test_find_duplicates_command(self):
+        ids = self.create_questions(
+            1, question="Cluster: what is the boiling point of water?")
+        ids += self.create_questions(
+            1, question="Cluster - What is the boiling point of water")
+        lone = self.create_questions(1, question="Cluster: lone question")
+
+        result = self.app.test_cli_runner().invoke(
+            args=['find-duplicates', '--json'])
+        clusters = json.loads(result.output.splitlines()[0])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn(sorted(ids), clusters)
+        self.assertFalse(any(lone[0] in cluster for cluster in clusters))
+        for question_id in ids + lone:
+            self.client().delete(f'/questions/{question_id}')
+
+    def test_export_questions_ndjson(self):
+        response = self.client().get('/questions/export')
+        rows = [json.loads(line) for line in response.data.splitlines()]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), Question.query.count())
+        self.assertEqual(set(rows[0].keys()), {
+            'id', 'question', 'answer', 'category', 'difficulty'})
+
+    def test_export_questions_csv_filtered(self):
+        response = self.client().get(
+            '/questions/export?format=csv&category=4&difficulty=2')
+        lines = response.data.decode().splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        self.assertEqual(len(lines) - 1, Question.query.filter(
+            Question.category == 4, Question.difficulty == 2).count())
+
+    def test_export_unknown_format_error(self):
+        response = self.client().get('/leaderboard/export?format=xml')
+
+        self.assertEqual(response.status_code, 400)
+
     def test_search_for_questions_success(self):
         response = self.client().post('/questions', json=self.search_term)
         data = json.loads(response.data)
@@ -260,6 +772,166 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_search_for_questions_fulltext(self):
+        response = self.client().post('/questions', json={
+            "searchTerm": "soccer world cup",
+            "mode": "fulltext"
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_questions'], 2)
+        for question in data['questions']:
+            self.assertIn('soccer', question['question'].lower())
+
+    def test_search_for_questions_in_memory_index(self):
+        app = create_app({"SEARCH_BACKEND": "memory"})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+
+        substring = json.loads(client.post(
+            '/questions', json=self.search_term).data)
+        database = json.loads(self.client().post(
+            '/questions', json=self.search_term).data)
+        self.assertEqual(substring['questions'], database['questions'])
+        self.assertEqual(
+            substring['total_questions'], database['total_questions'])
+
+        fulltext = json.loads(client.post('/questions', json={
+            "searchTerm": "Soccer",
+            "mode": "fulltext"
+        }).data)
+        self.assertEqual(fulltext['total_questions'], 2)
+
+    def test_search_for_questions_cursor(self):
+        for count in range(1, 13):
+            self.create_questions(1, question=' '.join(
+                ['Blorpcursor'] * count) + ' question')
+        memory = create_app({"SEARCH_BACKEND": "memory"})
+        setup_db(memory, self.database_path)
+
+        for client in (self.client(), memory.test_client()):
+            for mode in ('substring', 'fulltext'):
+                search = {"searchTerm": "blorpcursor", "mode": mode}
+                first = json.loads(client.post(
+                    '/questions', json=search).data)
+                pages = first['questions'] + json.loads(client.post(
+                    '/questions?page=2', json=search).data)['questions']
+
+                walked, data = [], first
+                while True:
+                    walked += data['questions']
+                    if data['next_cursor'] is None:
+                        break
+                    data = json.loads(client.post(
+                        f"/questions?cursor={data['next_cursor']}",
+                        json=search).data)
+                self.assertEqual(walked, pages)
+                self.assertEqual(len(walked), first['total_questions'])
+
+    def test_search_for_questions_number_term(self):
+        self.create_questions(1, question='Who won the 1996 Olympic final?')
+        memory = create_app({"SEARCH_BACKEND": "memory"})
+        setup_db(memory, self.database_path)
+
+        for client in (self.client(), memory.test_client()):
+            for mode in ('substring', 'fulltext'):
+                response = client.post('/questions', json={
+                    "searchTerm": 1996, "mode": mode})
+                self.assertEqual(response.status_code, 200)
+
+    def test_search_for_questions_in_memory_index_follows_insert(self):
+        app = create_app({"SEARCH_BACKEND": "memory"})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+        search = {"searchTerm": "Azikwe", "mode": "fulltext"}
+
+        self.assertEqual(client.post('/questions', json=search).status_code,
+                         404)
+        question = self.new_question.copy()
+        question["question"] = "Who was Azikwe?"
+        created = json.loads(client.post(
+            '/questions', json=question).data)['created']['id']
+        self.assertEqual(client.post('/questions', json=search).status_code,
+                         200)
+
+        client.delete(f'/questions/{created}')
+        self.assertEqual(client.post('/questions', json=search).status_code,
+                         404)
+
+    def test_suggest_questions(self):
+        question = self.new_question.copy()
+        question["question"] = "Which river runs through Zanzibarville?"
+        question["answer"] = "Quagmireflow"
+        created = json.loads(self.client().post(
+            '/questions', json=question).data)['created']['id']
+
+        for prefix in ('zanzib', 'Which riv', 'quagmire'):
+            response = self.client().get(
+                f'/questions/suggest?prefix={prefix}')
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(created, [s['id'] for s in data['suggestions']])
+
+        data = json.loads(self.client().get(
+            '/questions/suggest?prefix=unlike zanzib').data)
+        self.assertEqual(data['suggestions'], [])
+
+        self.client().delete(f'/questions/{created}')
+        data = json.loads(self.client().get(
+            '/questions/suggest?prefix=zanzib').data)
+        self.assertEqual(data['suggestions'], [])
+
+    def test_suggest_questions_limit(self):
+        self.create_questions(5, question="Zorblax trivia question")
+
+        data = json.loads(self.client().get(
+            '/questions/suggest?prefix=zorb&limit=3').data)
+        self.assertEqual(len(data['suggestions']), 3)
+        ids = [s['id'] for s in data['suggestions']]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+    def test_suggest_questions_bad_request(self):
+        for query in ('', '?prefix=', '?prefix=a&limit=0'):
+            response = self.client().get(f'/questions/suggest{query}')
+            self.assertEqual(response.status_code, 400)
+
+    def test_suggest_index_depth(self):
+        index = PrefixIndex(depth=2)
+        with self.app.app_context():
+            index.warm()
+            for question_id in (900001, 900002, 900003):
+                index.on_change('questions', 'insert', [{
+                    'id': question_id, 'question': 'Quuxword here',
+                    'answer': 'x'}])
+        self.assertEqual([s['id'] for s in index.suggest('quux')],
+                         [900003, 900002])
+
+    def test_create_question_with_number_text(self):
+        question = {**self.new_question, "question": 12345}
+        created = []
+        for query, status in (('', 200), ('?duplicates=allow', 200),
+                              ('?duplicates=reject', 409)):
+            response = self.client().post(f'/questions{query}',
+                                          json=question)
+            self.assertEqual(response.status_code, status)
+            if status == 200:
+                created.append(response.get_json()['created']['id'])
+        self.client().delete('/questions', json={"ids": created})
+
+    def test_search_for_questions_literal_wildcards(self):
+        response = self.client().post('/questions', json={"searchTerm": "%"})
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_for_questions_unknown_mode_error(self):
+        response = self.client().post('/questions', json={
+            "searchTerm": "title",
+            "mode": "regex"
+        })
+
+        self.assertEqual(response.status_code, 400)
+
     def test_get_question_for_quiz_success(self):
         res = self.client().post("/quizzes", json={
             "previous_questions": [],
@@ -290,6 +962,313 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["error"], 400)
         self.assertEqual(data['message'], 'bad request')
 
+    def test_get_question_for_quiz_malformed_body_error(self):
+        for body in ({"quiz_category": "x"}, {"quiz_category": {}},
+                     {"quiz_category": {"id": 0}, "previous_questions": 5},
+                     {"quiz_category": {"id": 0},
+                      "previous_questions": ["one"]}):
+            res = self.client().post("/quizzes", json=body)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(json.loads(res.data)['message'], 'bad request')
+
+    def test_get_question_for_quiz_never_repeats(self):
+        played = []
+        while True:
+            res = self.client().post("/quizzes", json={
+                "previous_questions": played,
+                "quiz_category": {"type": "History", "id": 4}
+            })
+            question = json.loads(res.data)["question"]
+            if question is None:
+                break
+            self.assertNotIn(question["id"], played)
+            self.assertEqual(int(question["category"]), 4)
+            played.append(question["id"])
+
+        self.assertTrue(played)
+
+    def test_get_question_for_quiz_skips_ids_sent_as_strings(self):
+        res = self.client().post("/quizzes", json={
+            "previous_questions": ["5", "9", "12"],
+            "quiz_category": {"id": 4}})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["question"]["id"], 23)
+        for previous in (["5", "9", "12"], [5, 9, 12]):
+            self.assertEqual(
+                self.app.extensions['trivia']['pool'].sample_ids(
+                    4, previous, 5), [23])
+        with self.assertRaises(ValueError):
+            self.app.extensions['trivia']['pool'].sample_ids(4, ["x"], 1)
+
+    def test_get_question_for_quiz_follows_insert_and_delete(self):
+        question = self.new_question.copy()
+        question["category"] = 6
+        created = json.loads(self.client().post(
+            '/questions', json=question).data)['created']['id']
+
+        played = []
+        while True:
+            res = self.client().post("/quizzes", json={
+                "previous_questions": played,
+                "quiz_category": {"type": "Sports", "id": 6}
+            })
+            data = json.loads(res.data)
+            if data["question"] is None:
+                break
+            played.append(data["question"]["id"])
+        self.assertIn(created, played)
+
+        self.client().delete(f'/questions/{created}')
+        played.remove(created)
+        res = self.client().post("/quizzes", json={
+            "previous_questions": played,
+            "quiz_category": {"type": "Sports", "id": 6}
+        })
+        self.assertIsNone(json.loads(res.data)["question"])
+
+    def test_get_question_for_quiz_round(self):
+        res = self.client().post("/quizzes", json={
+            "previous_questions": [5],
+            "quiz_category": {"type": "History", "id": 4},
+            "count": 2
+        })
+        data = json.loads(res.data)
+        ids = [question["id"] for question in data["questions"]]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(len(set(ids)), 2)
+        self.assertNotIn(5, ids)
+        self.assertTrue(all(int(question["category"]) == 4
+                            for question in data["questions"]))
+
+    def test_get_question_for_quiz_round_runs_short(self):
+        res = self.client().post("/quizzes", json={
+            "previous_questions": [5, 9],
+            "quiz_category": {"type": "History", "id": 4},
+            "count": 10
+        })
+        questions = json.loads(res.data)["questions"]
+
+        self.assertEqual(sorted(question["id"] for question in questions),
+                         [12, 23])
+
+    def test_get_question_for_quiz_by_difficulty(self):
+        played = []
+        while True:
+            res = self.client().post("/quizzes", json={
+                "previous_questions": played,
+                "quiz_category": {"id": 0},
+                "difficulty": 1
+            })
+            question = json.loads(res.data)["question"]
+            if question is None:
+                break
+            self.assertEqual(question["difficulty"], 1)
+            played.append(question["id"])
+
+        self.assertEqual(len(played), Question.query.filter(
+            Question.difficulty == 1).count())
+
+    def test_get_question_for_quiz_round_bad_count_error(self):
+        for count in (0, "many"):
+            res = self.client().post("/quizzes", json={
+                "previous_questions": [],
+                "quiz_category": {"id": 0},
+                "count": count
+            })
+
+            self.assertEqual(res.status_code, 400)
+
+    def shared_apps(self, count=2):
+        directory = tempfile.mkdtemp()
+        apps = []
+        for _ in range(count):
+            app = create_app({"SHARED_POOL_DIR": directory})
+            setup_db(app, self.database_path)
+            apps.append(app)
+        return apps
+
+    def test_bulk_import_rebuilds_shared_pool_once(self):
+        app, = self.shared_apps(1)
+        client = app.test_client()
+        before = json.loads(client.get('/questions').data)['total_questions']
+        store = app.extensions['trivia']['shared'].store
+        builds, build = [], store.build
+
+        def counted_build(*args, **kwargs):
+            builds.append(args)
+            return build(*args, **kwargs)
+        store.build = counted_build
+        body = "\n".join(json.dumps({**self.new_question,
+                                     "question": f"Once: question {number}"})
+                         for number in range(3))
+
+        data = json.loads(client.post(
+            '/questions/bulk?batch_size=1&duplicates=allow', data=body,
+            content_type='application/x-ndjson').data)
+        after = json.loads(client.get('/questions').data)['total_questions']
+        with app.app_context():
+            for question in Question.query.filter(
+                    Question.question.like('Once:%')).all():
+                question.delete()
+
+        self.assertEqual(data['inserted'], 3)
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(after, before + 3)
+
+    def test_if_modified_since_sees_other_workers(self):
+        first, second = self.shared_apps()
+        listing = second.test_client().get('/questions')
+        board = second.test_client().get('/leaderboard')
+
+        created = json.loads(first.test_client().post(
+            '/questions', json=self.new_question).data)['created']['id']
+        first.test_client().post(
+            '/leaderboard', json={"name": "Elsewhere", "score": 3})
+        relisted = second.test_client().get('/questions', headers={
+            'If-Modified-Since': listing.headers['Last-Modified']})
+        reboard = second.test_client().get('/leaderboard', headers={
+            'If-Modified-Since': board.headers['Last-Modified']})
+        first.test_client().delete(f'/questions/{created}')
+
+        self.assertEqual(relisted.status_code, 200)
+        self.assertEqual(json.loads(relisted.data)['total_questions'],
+                         json.loads(listing.data)['total_questions'] + 1)
+        self.assertEqual(reboard.status_code, 200)
+
+    def test_shared_pool_follows_other_workers(self):
+        first, second = self.shared_apps()
+        etag = second.test_client().get(
+            '/categories/6/questions').headers['ETag']
+        before = json.loads(second.test_client().get(
+            '/categories/6/questions').data)['total_questions']
+
+        created = json.loads(first.test_client().post(
+            '/questions', json={**self.new_question, "category": 6}).data)[
+                'created']['id']
+        listed = second.test_client().get('/categories/6/questions')
+        drawn = second.extensions['trivia']['pool'].ids(6)
+        second.test_client().delete(f'/questions/{created}')
+        remaining = first.extensions['trivia']['pool'].ids(6)
+
+        self.assertEqual(json.loads(listed.data)['total_questions'],
+                         before + 1)
+        self.assertNotEqual(listed.headers['ETag'], etag)
+        self.assertIn(created, drawn)
+        self.assertNotIn(created, remaining)
+
+    def test_shared_pool_listing_matches_database(self):
+        [shared] = self.shared_apps(1)
+        for path in ('/questions?page=2', '/categories/4/questions',
+                     '/questions?after=10'):
+            expected = json.loads(self.client().get(path).data)
+            data = json.loads(shared.test_client().get(path).data)
+
+            self.assertEqual(data, expected)
+        cursor = expected['next_cursor']
+        self.assertEqual(
+            json.loads(shared.test_client().get(
+                f'/questions?cursor={cursor}').data),
+            json.loads(self.client().get(f'/questions?cursor={cursor}').data))
+
+    def test_shared_store_swaps_snapshots(self):
+        store = SharedIdStore(tempfile.mkdtemp())
+        store.build(lambda: [(3, 1, 2), (1, 1, 1), (2, 2, None)])
+        old = store.snapshot()
+        store.apply('insert', [{'id': 4, 'category': 1, 'difficulty': 2}])
+        store.apply('delete', [{'id': 1}])
+        new = store.snapshot()
+
+        self.assertEqual(list(old.get((1, None)).ids), [1, 3])
+        self.assertEqual(list(new.get((1, None)).ids), [3, 4])
+        self.assertEqual(list(new.get((0, None)).ids), [2, 3, 4])
+        self.assertEqual(list(new.get((1, 2)).ids), [3, 4])
+        self.assertEqual(new.generation, old.generation + 2)
+        self.assertEqual(store.generation, new.generation)
+
+    def test_quiz_session_deals_every_question_once(self):
+        res = self.client().post("/quizzes/sessions", json={
+            "quiz_category": {"type": "History", "id": 4}
+        })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["session_id"])
+
+        dealt = []
+        while True:
+            res = self.client().post(
+                f'/quizzes/sessions/{data["session_id"]}/next')
+            question = json.loads(res.data)["question"]
+            if question is None:
+                break
+            dealt.append(question["id"])
+
+        self.assertEqual(len(dealt), data["total_questions"])
+        self.assertEqual(len(set(dealt)), len(dealt))
+
+    def test_quiz_session_deals_from_any_worker(self):
+        other = create_app()
+        setup_db(other, self.database_path)
+        data = json.loads(self.client().post("/quizzes/sessions", json={
+            "quiz_category": {"type": "History", "id": 4}
+        }).data)
+
+        dealt = []
+        for client in [other.test_client(), self.client()] * \
+                data["total_questions"]:
+            res = client.post(f'/quizzes/sessions/{data["session_id"]}/next')
+            self.assertEqual(res.status_code, 200)
+            question = json.loads(res.data)["question"]
+            if question is None:
+                break
+            dealt.append(question["id"])
+        ended = other.test_client().delete(
+            f'/quizzes/sessions/{data["session_id"]}')
+
+        self.assertEqual(len(set(dealt)), data["total_questions"])
+        self.assertEqual(ended.status_code, 200)
+
+    def test_quiz_session_unknown_session_error(self):
+        res = self.client().post('/quizzes/sessions/missing/next')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_quiz_session_expires(self):
+        app = create_app({"QUIZ_SESSION_TTL": 0})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+
+        session_id = json.loads(client.post("/quizzes/sessions", json={
+            "quiz_category": {"type": "History", "id": 4}
+        }).data)["session_id"]
+        res = client.post(f'/quizzes/sessions/{session_id}/next')
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_quiz_session_bad_request_error(self):
+        res = self.client().post("/quizzes/sessions", json={})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_quiz_session_bad_category_error(self):
+        for category in ({}, 4, "History", {"id": None}, {"id": "four"}):
+            res = self.client().post("/quizzes/sessions", json={
+                "quiz_category": category})
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(json.loads(res.data)['message'], 'bad request')
+
+        res = self.client().post("/quizzes/sessions", json={
+            "quiz_category": {"id": "4"}})
+        self.assertEqual(res.status_code, 200)
+
     def test_post_to_leaderboard_success(self):
         res = self.client().post("/leaderboard", json={
             "name": "Test",
@@ -307,6 +1286,216 @@ class TriviaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 200)
 
+    def test_get_leaderboard_ordered_by_score(self):
+        for score in [3, 30, 17]:
+            self.client().post("/leaderboard", json={
+                "name": "Ordered",
+                "score": score
+            })
+        res = self.client().get("/leaderboard")
+        data = json.loads(res.data)
+
+        scores = [result['score'] for result in data['results']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertGreaterEqual(data['totalResults'], 3)
+
+    def test_get_leaderboard_cursor_matches_pages(self):
+        for score in range(12):
+            self.client().post("/leaderboard", json={
+                "name": "Paged",
+                "score": score % 3
+            })
+        first = json.loads(self.client().get("/leaderboard").data)
+        by_cursor = json.loads(self.client().get(
+            f"/leaderboard?cursor={first['next_cursor']}").data)
+        by_page = json.loads(self.client().get("/leaderboard?page=2").data)
+
+        self.assertEqual(by_cursor['results'], by_page['results'])
+
+    def test_get_rank_of_entry(self):
+        added = json.loads(self.client().post("/leaderboard", json={
+            "name": "Ranked",
+            "score": 1000000
+        }).data)["added"]
+        res = self.client().get(f"/leaderboard/{added}/rank")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["result"]["id"], added)
+        higher = Leaderboard.query.filter(
+            Leaderboard.score > 1000000).count()
+        self.assertEqual(data["rank"], higher + 1)
+
+    def test_get_rank_of_score(self):
+        res = self.client().get("/leaderboard/rank?score=5")
+        data = json.loads(res.data)
+
+        higher = Leaderboard.query.filter(Leaderboard.score > 5).count()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["rank"], higher + 1)
+
+    def test_get_rank_of_missing_entry_error(self):
+        res = self.client().get("/leaderboard/100000000/rank")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_post_to_leaderboard_write_behind(self):
+        app = create_app({
+            "LEADERBOARD_WRITE_BEHIND": True,
+            "LEADERBOARD_FLUSH_INTERVAL": 0.01
+        })
+        setup_db(app, self.database_path)
+        client = app.test_client()
+
+        added = [json.loads(client.post("/leaderboard", json={
+            "name": "Buffered",
+            "score": score
+        }).data)["added"] for score in range(5)]
+        self.assertEqual(len(set(added)), 5)
+
+        for _ in range(200):
+            stats = json.loads(client.get("/leaderboard/buffer").data)
+            if stats["rows_flushed"] == 5:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["rows_flushed"], 5)
+        for entry_id, score in zip(added, range(5)):
+            self.assertEqual(Leaderboard.query.get(entry_id).score, score)
+
+    def test_write_behind_drops_rows_the_database_rejects(self):
+        app = create_app({
+            "LEADERBOARD_WRITE_BEHIND": True,
+            "LEADERBOARD_FLUSH_INTERVAL": 60
+        })
+        setup_db(app, self.database_path)
+        writer = app.extensions["trivia"]["writer"]
+
+        with app.app_context():
+            good = writer.submit(player="Kept", score=1,
+                                 created_at=datetime.utcnow())
+            bad = writer.submit(player="Too big", score=10 ** 12,
+                                created_at=datetime.utcnow())
+            after = writer.submit(player="Kept", score=2,
+                                  created_at=datetime.utcnow())
+            self.assertEqual(writer.flush(), 2)
+
+            stats = writer.stats()
+            self.assertEqual(stats["depth"], 0)
+            self.assertEqual(stats["rows_dropped"], 1)
+            self.assertEqual(writer.dead_letters[-1]["id"], bad)
+            self.assertEqual(Leaderboard.query.get(good).score, 1)
+            self.assertEqual(Leaderboard.query.get(after).score, 2)
+            self.assertIsNone(Leaderboard.query.get(bad))
+
+    def test_post_to_leaderboard_score_out_of_range(self):
+        res = self.client().post(
+            "/leaderboard", json={"name": "Ada", "score": 10 ** 12})
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)["message"], 'bad request')
+
+    def test_get_leaderboard_buffer_disabled(self):
+        res = self.client().get("/leaderboard/buffer")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(data["enabled"])
+
+    def test_get_leaderboard_etag_changes_after_post(self):
+        etag = self.client().get('/leaderboard').headers['ETag']
+        self.client().post("/leaderboard", json={"name": "Tag", "score": 1})
+        res = self.client().get(
+            '/leaderboard', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_get_leaderboard_windows(self):
+        added = json.loads(self.client().post("/leaderboard", json={
+            "name": "Windowed", "score": 2100000000}).data)["added"]
+
+        for window in ('day', 'week', 'all'):
+            res = self.client().get(f'/leaderboard?window={window}')
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data["window"], window)
+            self.assertIn(added, [entry["id"] for entry in data["results"]])
+            self.assertEqual(data["totalResults"], len(data["results"]))
+            scores = [entry["score"] for entry in data["results"]]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual(data["period"], '1970-01-01')
+
+    def test_leaderboard_rollups_keep_the_top_entries(self):
+        app = create_app({"LEADERBOARD_TOP_N": 3})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+        for score in (5, 9, 1, 7):
+            client.post("/leaderboard", json={"name": "Top", "score": score})
+
+        with app.app_context():
+            today = datetime.utcnow().date()
+            stored = LeaderboardRollup.query.filter_by(
+                span='day', period=today).count()
+            expected = [entry.id for entry in Leaderboard.query.filter(
+                Leaderboard.created_at >= datetime.combine(
+                    today, datetime.min.time())).order_by(
+                        Leaderboard.score.desc(), Leaderboard.id).limit(3)]
+        results = json.loads(client.get(
+            '/leaderboard?window=day').data)["results"]
+        rebuilt = app.test_cli_runner().invoke(
+            args=['leaderboard-rollups', '--rebuild'])
+
+        self.assertEqual(stored, 3)
+        self.assertEqual([entry["id"] for entry in results], expected)
+        self.assertEqual(rebuilt.exit_code, 0)
+
+    def test_leaderboard_rollups_compacted(self):
+        expired = datetime.utcnow() - timedelta(days=60)
+        with self.app.app_context():
+            self.db.session.add(LeaderboardRollup(
+                span='day', period=rollup_period('day', expired),
+                entry_id=0, player='Old', score=1))
+            self.db.session.commit()
+
+            result = self.app.test_cli_runner().invoke(
+                args=['leaderboard-rollups'])
+            remaining = LeaderboardRollup.query.filter(
+                LeaderboardRollup.span == 'day',
+                LeaderboardRollup.period < rollup_period(
+                    'day', expired + timedelta(days=1))).count()
+
+        self.assertIn('1 expired rollup entries deleted', result.output)
+        self.assertEqual(remaining, 0)
+
+    def test_quiz_and_leaderboard_sparse_fields(self):
+        quiz = json.loads(self.client().post(
+            '/quizzes?fields=id,question', json={
+                "previous_questions": [], "quiz_category": {"id": 0}}).data)
+        rounds = json.loads(self.client().post(
+            '/quizzes?fields=question&include=categories', json={
+                "previous_questions": [], "quiz_category": {"id": 0},
+                "count": 3}).data)
+        board = json.loads(self.client().get(
+            '/leaderboard?fields=score&include=categories').data)
+
+        self.assertEqual(set(quiz['question']), {'id', 'question'})
+        self.assertEqual(len(rounds['questions']), 3)
+        for question in rounds['questions']:
+            self.assertNotIn('answer', question)
+        self.assertIn('categories', rounds)
+        self.assertIn('categories', board)
+        for entry in board['results']:
+            self.assertEqual(set(entry), {'id', 'score'})
+
+    def test_get_leaderboard_window_bad_request_error(self):
+        res = self.client().get('/leaderboard?window=month')
+
+        self.assertEqual(res.status_code, 400)
+
     def test_post_to_leaderboard_error(self):
         res = self.client().post("/leaderboard", json={})
         data = json.loads(res.data)
@@ -315,6 +1504,521 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], 'bad request')
 
+    def test_post_to_leaderboard_bad_name(self):
+        res = self.client().post(
+            "/leaderboard", json={"name": {"first": "Ada"}, "score": 3})
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)["message"], 'bad request')
+
+    def asgi_requests(self, requests, app=None):
+        """Run (method, path, body) requests through the ASGI app."""
+        asgi = create_asgi_app(app or self.app)
+
+        async def call(method, path, body):
+            path, _, query = path.partition('?')
+            scope = {'type': 'http', 'method': method, 'path': path,
+                     'query_string': query.encode(), 'root_path': '',
+                     'scheme': 'http', 'server': ('localhost', 80),
+                     'http_version': '1.1', 'headers': [
+                         (b'content-type', b'application/json')]}
+            received = [{'type': 'http.request',
+                         'body': json.dumps(body).encode() if body else b''}]
+            sent = []
+
+            async def receive():
+                return received.pop() if received else \
+                    {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            await asgi(scope, receive, send)
+            headers = {name.decode(): value.decode()
+                       for name, value in sent[0]['headers']}
+            body = b''.join(message.get('body', b'') for message in sent[1:])
+            return sent[0]['status'], headers, json.loads(body)
+
+        async def run():
+            try:
+                return [await call(*request) for request in requests]
+            finally:
+                await asgi.close()
+        return asyncio.run(run())
+
+    @requires_asgi
+    def test_asgi_get_questions_matches_flask(self):
+        expected = self.client().get('/questions?page=1')
+        (_, _, cold), (status, headers, warm) = self.asgi_requests([
+            ('GET', '/questions?page=1', None),
+            ('GET', '/questions?page=1', None)])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(cold, json.loads(expected.data))
+        self.assertEqual(warm, json.loads(expected.data))
+        self.assertEqual(headers['etag'], expected.headers['ETag'])
+
+    @requires_asgi
+    def test_asgi_get_questions_for_category_not_found(self):
+        [(status, _, data)] = self.asgi_requests([
+            ('GET', '/categories/1000/questions', None)])
+
+        self.assertEqual(status, 404)
+        self.assertEqual(data["message"], 'resource not found')
+
+    @requires_asgi
+    def test_asgi_post_to_leaderboard(self):
+        self.client().get('/leaderboard')
+        [(status, _, data)] = self.asgi_requests([
+            ('POST', '/leaderboard', {"name": "Async", "score": 7})])
+        res = self.client().get('/leaderboard/%d/rank' % data["added"])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["result"]["player"], "Async")
+
+    @requires_asgi
+    def test_asgi_delegates_other_routes(self):
+        [(status, _, data)] = self.asgi_requests([
+            ('GET', '/leaderboard/0/rank', None)])
+
+        self.assertEqual(status, 404)
+        self.assertEqual(data["success"], False)
+
+    @requires_asgi
+    def test_asgi_post_to_leaderboard_error(self):
+        [(status, _, data)] = self.asgi_requests([
+            ('POST', '/leaderboard', {"name": "Async"})])
+
+        self.assertEqual(status, 400)
+        self.assertEqual(data["message"], 'bad request')
+
+    @requires_asgi
+    def test_asgi_post_to_leaderboard_bad_name(self):
+        [(status, _, data)] = self.asgi_requests([
+            ('POST', '/leaderboard', {"name": ["Async"], "score": 7})])
+        [(number, _, added)] = self.asgi_requests([
+            ('POST', '/leaderboard', {"name": 42, "score": 7})])
+        res = self.client().get('/leaderboard/%d/rank' % added["added"])
+
+        self.assertEqual(status, 400)
+        self.assertEqual(data["message"], 'bad request')
+        self.assertEqual(number, 200)
+        self.assertEqual(json.loads(res.data)["result"]["player"], "42")
+
+    @requires_asgi
+    def test_asgi_quiz_skips_previous_questions(self):
+        self.client().post('/quizzes', json={
+            "previous_questions": [], "quiz_category": {"id": 0}})
+        ids = list(self.app.extensions['trivia']['pool'].ids(0))
+        last = ids.pop()
+        [(status, _, data)] = self.asgi_requests([
+            ('POST', '/quizzes', {"previous_questions": ids,
+                                  "quiz_category": {"id": 0}})])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data["question"]["id"], last)
+
+    @requires_asgi
+    def test_asgi_quiz_round(self):
+        self.client().post('/quizzes', json={
+            "previous_questions": [], "quiz_category": {"id": 0}})
+        [(status, _, data)] = self.asgi_requests([
+            ('POST', '/quizzes', {"previous_questions": [5, 9],
+                                  "quiz_category": {"id": 4},
+                                  "count": 5})])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(question["id"]
+                                for question in data["questions"]), [12, 23])
+
+    @requires_asgi
+    def test_asgi_quiz_malformed_body_error(self):
+        self.client().post('/quizzes', json={
+            "previous_questions": [], "quiz_category": {"id": 0}})
+        responses = self.asgi_requests([
+            ('POST', '/quizzes', body) for body in (
+                {"quiz_category": "x"}, {"quiz_category": {}},
+                {"quiz_category": {"id": 0}, "previous_questions": 5})])
+
+        for status, _, data in responses:
+            self.assertEqual(status, 400)
+            self.assertEqual(data['message'], 'bad request')
+
+    @requires_asgi
+    def test_asgi_leaderboard_window(self):
+        [(status, _, data)] = self.asgi_requests([
+            ('POST', '/leaderboard', {"name": "Async", "score": 2000000000})])
+        expected = self.client().get('/leaderboard?window=week')
+        [(_, headers, board)] = self.asgi_requests([
+            ('GET', '/leaderboard?window=week', None)])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(board, json.loads(expected.data))
+        self.assertIn(data["added"],
+                      [entry["id"] for entry in board["results"]])
+        self.assertEqual(headers['etag'], expected.headers['ETag'])
+
+    @requires_asgi
+    def test_asgi_leaderboard_write_behind_off_the_loop(self):
+        app = create_app({
+            "LEADERBOARD_WRITE_BEHIND": True,
+            "LEADERBOARD_FLUSH_INTERVAL": 0.01
+        })
+        setup_db(app, self.database_path)
+        writer = app.extensions['trivia']['writer']
+        threads, submit = [], writer.submit
+
+        def recorded_submit(**values):
+            threads.append(threading.current_thread())
+            return submit(**values)
+        writer.submit = recorded_submit
+
+        [(status, _, data)] = self.asgi_requests([
+            ('POST', '/leaderboard', {"name": "Async", "score": 7})], app)
+        writer.flush()
+
+        self.assertEqual(status, 200)
+        self.assertNotIn(threading.main_thread(), threads)
+        self.assertEqual(len(threads), 1)
+        with app.app_context():
+            self.assertEqual(Leaderboard.query.get(data["added"]).score, 7)
+
+    @requires_asgi
+    def test_asgi_sparse_fields_match_flask(self):
+        self.client().get('/categories')
+        path = '/categories/1/questions?fields=question&include=categories'
+        expected = self.client().get(path)
+        [(status, headers, data)] = self.asgi_requests([('GET', path, None)])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data, json.loads(expected.data))
+        self.assertEqual(headers['etag'], expected.headers['ETag'])
+
+    def test_benchmark_percentile(self):
+        samples = sorted(range(1, 101))
+
+        self.assertEqual(runner.percentile(samples, 50), 50)
+        self.assertEqual(runner.percentile(samples, 99), 99)
+        self.assertEqual(runner.percentile([7], 95), 7)
+        self.assertIsNone(runner.percentile([], 50))
+
+    def test_benchmark_run_reports_every_scenario(self):
+        database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        report = runner.run(f'sqlite:///{database}', questions=50,
+                            leaderboard=30, requests=3, warmup=1,
+                            quiz_history=10)
+        setup_db(self.app, self.database_path)
+
+        self.assertEqual(report['meta']['sizes']['questions'], 50)
+        self.assertEqual(report['meta']['database'], 'sqlite')
+        for result in report['results'].values():
+            self.assertEqual(result['status_codes'], {'200': 3})
+            self.assertIn('p99', result['latency_ms'])
+
+    def test_benchmark_reload_rebuilds_question_bands(self):
+        database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        app = create_app({"SQLALCHEMY_DATABASE_URI": f'sqlite:///{database}'})
+        with app.app_context():
+            datasets.load(20, 5, seed=1, bands=True)
+            datasets.load(30, 5, seed=2, bands=True)
+            question = Question.query.get(1)
+            buckets = {band.bucket for band in QuestionBand.query.filter(
+                QuestionBand.question_id == 1)}
+            self.assertEqual(
+                buckets, set(question_signature(question.question)[1]))
+
+    def test_metrics_count_requests_and_queries(self):
+        self.client().get('/questions?page=1')
+        res = self.client().get('/metrics')
+        text = res.data.decode()
+        labels = '{route="/questions",method="GET"'
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('trivia_http_requests_total' + labels +
+                      ',status="200"} 1', text)
+        self.assertIn('trivia_http_request_duration_seconds_count' +
+                      labels + '} 1', text)
+        queries = [line for line in text.splitlines()
+                   if line.startswith('trivia_db_queries_total' + labels)]
+        self.assertGreater(int(queries[0].split()[-1]), 0)
+
+    def test_metrics_server_timing_header(self):
+        app = create_app({"METRICS_SERVER_TIMING": True})
+        setup_db(app, self.database_path)
+        res = app.test_client().get('/questions?page=1')
+
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+        self.assertNotIn('Server-Timing', self.client().get(
+            '/questions?page=1').headers)
+
+    def test_metrics_disabled(self):
+        app = create_app({"METRICS_ENABLED": False})
+        setup_db(app, self.database_path)
+        res = app.test_client().get('/metrics')
+
+        self.assertEqual(res.status_code, 404)
+
+    def limited_app(self, **options):
+        app = create_app({"ADMISSION_LIMITS": {
+            "GET /categories": {"concurrency": 1, **options}}})
+        setup_db(app, self.database_path)
+        limiter = app.extensions['trivia']['admission'].limiters[
+            ('GET', '/categories')]
+        return app, limiter
+
+    def test_admission_sheds_when_queue_is_full(self):
+        app, limiter = self.limited_app(queue=0)
+        self.assertTrue(limiter.acquire())
+        res = app.test_client().get('/categories')
+        data = json.loads(res.data)
+        limiter.release(0.01)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['message'], 'service unavailable')
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(app.test_client().get('/categories').status_code,
+                         200)
+        self.assertEqual((limiter.admitted, limiter.shed), (2, 1))
+        # cheap routes without a limit are never held back
+        self.assertEqual(app.test_client().get('/questions').status_code,
+                         200)
+
+    def test_admission_queues_until_a_slot_frees(self):
+        app, limiter = self.limited_app(queue=1, budget=5)
+        self.assertTrue(limiter.acquire())
+        threading.Timer(0.1, limiter.release, [0.1]).start()
+        res = app.test_client().get('/categories')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((limiter.queued, limiter.running), (1, 0))
+        text = app.test_client().get('/metrics').data.decode()
+        self.assertIn('trivia_admission_queued_total'
+                      '{route="/categories",method="GET"} 1', text)
+
+    def test_admission_sheds_before_waiting_past_budget(self):
+        app, limiter = self.limited_app(queue=10, budget=0.5)
+        # the route has been taking two seconds a request
+        limiter.acquire()
+        limiter.release(2.0)
+        self.assertTrue(limiter.acquire())
+        started = time.monotonic()
+        res = app.test_client().get('/categories')
+        limiter.release(2.0)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(res.headers['Retry-After'], '2')
+        self.assertEqual(limiter.queued, 0)
+
+    @requires_asgi
+    def test_asgi_fast_paths_take_admission_slots(self):
+        self.client().post('/quizzes', json={
+            "previous_questions": [], "quiz_category": {"id": 0}})
+        limiters = self.app.extensions['trivia']['admission'].limiters
+        limiter = limiters[('POST', '/quizzes')] = Limiter(1, queue=0)
+        body = {"previous_questions": [], "quiz_category": {"id": 0}}
+
+        self.assertTrue(limiter.acquire())
+        [(status, headers, _)] = self.asgi_requests([
+            ('POST', '/quizzes', body)])
+        limiter.release(0.01)
+        [(served, _, _)] = self.asgi_requests([('POST', '/quizzes', body)])
+
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['retry-after'], '1')
+        self.assertEqual(served, 200)
+        self.assertEqual((limiter.admitted, limiter.shed, limiter.running),
+                         (2, 1, 0))
+
+    def test_migrations_upgrade_is_idempotent(self):
+        with self.app.app_context():
+            engine = self.db.get_engine()
+            migrations.upgrade(engine)
+
+            self.assertEqual(migrations.pending(engine), [])
+            self.assertEqual(migrations.upgrade(engine), [])
+            inspector = inspect(engine)
+            indexes = {index['name'] for table in ('questions', 'leaderboard')
+                       for index in inspector.get_indexes(table)}
+        self.assertTrue({'ix_questions_category',
+                         'ix_questions_category_difficulty',
+                         'ix_leaderboard_score'} <= indexes)
+
+    def test_migrations_convert_text_category(self):
+        admin = create_engine(self.database_path)
+        with admin.begin() as connection:
+            connection.execute(text('DROP SCHEMA IF EXISTS legacy CASCADE'))
+            connection.execute(text('CREATE SCHEMA legacy'))
+            connection.execute(text(
+                'CREATE TABLE legacy.categories '
+                '(id serial PRIMARY KEY, type varchar)'))
+            connection.execute(text(
+                'CREATE TABLE legacy.questions (id serial PRIMARY KEY, '
+                'question varchar, answer varchar, category varchar, '
+                'difficulty integer)'))
+            connection.execute(text(
+                'CREATE TABLE legacy.leaderboard '
+                '(id serial PRIMARY KEY, player varchar, score integer)'))
+            connection.execute(text(
+                "INSERT INTO legacy.categories (type) VALUES ('Science')"))
+            connection.execute(text(
+                'INSERT INTO legacy.questions (question, answer, category, '
+                "difficulty) VALUES ('Q1', 'A1', '1', 1), "
+                "('Q2', 'A2', '9', 2)"))
+        legacy = create_engine(self.database_path, connect_args={
+            'options': '-csearch_path=legacy'})
+        try:
+            self.assertEqual(migrations.upgrade(legacy),
+                             [version for version, _ in migrations.REVISIONS])
+            inspector = inspect(legacy)
+            category = [column for column in inspector.get_columns('questions')
+                        if column['name'] == 'category'][0]
+            categories = legacy.execute(text(
+                'SELECT category FROM questions ORDER BY id')).fetchall()
+            foreign_keys = inspector.get_foreign_keys('questions')
+        finally:
+            legacy.dispose()
+            with admin.begin() as connection:
+                connection.execute(text('DROP SCHEMA legacy CASCADE'))
+            admin.dispose()
+
+        self.assertEqual(str(category['type']), 'INTEGER')
+        self.assertEqual([row[0] for row in categories], [1, None])
+        self.assertEqual(foreign_keys[0]['referred_table'], 'categories')
+
+    def test_setup_db_skips_create_all_when_disabled(self):
+        path = os.path.join(tempfile.mkdtemp(), 'empty.db')
+        create_app({"DB_CREATE_ALL": False,
+                    "SQLALCHEMY_DATABASE_URI": f'sqlite:///{path}'})
+        tables = sqlite3.connect(path).execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        setup_db(self.app, self.database_path)
+
+        self.assertEqual(tables, [])
+
+    def test_prepare_warms_caches(self):
+        report = prepare(self.app)
+        engines = self.app.extensions['trivia']
+
+        self.assertTrue(engines['pool'].loaded)
+        self.assertTrue(engines['board'].fresh)
+        self.assertIsNotNone(engines['categories'].cached())
+        self.assertEqual(report['categories'],
+                         len(engines['categories'].cached()))
+        self.assertIn('boot_seconds', report)
+        self.assertEqual(engines['boot'], report)
+
+    def test_connections_are_not_shared_across_fork(self):
+        with self.app.app_context():
+            engine = self.db.get_engine()
+            parent = engine.execute(text('SELECT pg_backend_pid()')).scalar()
+            epoch = self.app.extensions['trivia']['versions'].epoch
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    child = engine.execute(
+                        text('SELECT pg_backend_pid()')).scalar()
+                    forked = self.app.extensions['trivia']['versions'].epoch
+                    os.write(write, json.dumps(
+                        [child, forked]).encode())
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            child, forked = json.loads(os.read(read, 1024))
+            again = engine.execute(text('SELECT pg_backend_pid()')).scalar()
+
+        self.assertNotEqual(child, parent)
+        self.assertEqual(again, parent)
+        self.assertNotEqual(forked, epoch)
+
+    def test_get_categories_with_counts(self):
+        res = self.client().get('/categories?with_counts=1')
+        data = json.loads(res.data)
+        total = json.loads(self.client().get('/questions').data)[
+            'total_questions']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            sum(category['total_questions']
+                for category in data['categories']), total)
+        for category in data['categories']:
+            self.assertEqual(sum(category['difficulties'].values()),
+                             category['total_questions'])
+        self.assertNotIn('total_questions', json.loads(self.client().get(
+            '/categories').data)['categories'][0])
+
+    def test_question_counts_follow_insert_and_delete(self):
+        with self.app.app_context():
+            before = QuestionCount.total(4, 2)
+            question = Question(**{
+                key: self.new_question[key]
+                for key in ('question', 'answer', 'category', 'difficulty')})
+            question.insert()
+            inserted = QuestionCount.total(4, 2)
+            question.delete()
+            deleted = QuestionCount.total(4, 2)
+
+        self.assertEqual(inserted, before + 1)
+        self.assertEqual(deleted, before)
+
+    def test_question_totals_follow_other_workers(self):
+        other = create_app()
+        setup_db(other, self.database_path)
+        before = json.loads(self.client().get(
+            '/categories/4/questions').data)['total_questions']
+        listed = json.loads(self.client().get(
+            '/questions').data)['total_questions']
+
+        created = json.loads(other.test_client().post(
+            '/questions?duplicates=allow', json=self.new_question).data)[
+                'created']['id']
+        after = json.loads(self.client().get(
+            '/categories/4/questions').data)['total_questions']
+        relisted = json.loads(self.client().get(
+            '/questions').data)['total_questions']
+        other.test_client().delete(f'/questions/{created}')
+
+        self.assertEqual(after, before + 1)
+        self.assertEqual(relisted, listed + 1)
+
+    def test_etags_follow_other_workers(self):
+        other = create_app()
+        setup_db(other, self.database_path)
+        paths = ('/questions', '/categories/4/questions',
+                 '/categories?with_counts=1')
+        etags = {path: self.client().get(path).headers['ETag']
+                 for path in paths}
+
+        created = json.loads(other.test_client().post(
+            '/questions?duplicates=allow', json=self.new_question).data)[
+                'created']['id']
+        statuses = {path: self.client().get(path, headers={
+            'If-None-Match': etag}).status_code
+            for path, etag in etags.items()}
+        other.test_client().delete(f'/questions/{created}')
+
+        self.assertEqual(statuses, dict.fromkeys(paths, 200))
+
+    def test_reconcile_counts_repairs_drift(self):
+        runner = self.app.test_cli_runner()
+        with self.app.app_context():
+            Question.query.session.execute(
+                'UPDATE question_counts SET count = count + 5 '
+                'WHERE category = 1 AND difficulty = 4')
+            Question.query.session.commit()
+
+            check = runner.invoke(args=['reconcile-counts', '--check'])
+            repair = runner.invoke(args=['reconcile-counts'])
+            again = runner.invoke(args=['reconcile-counts', '--check'])
+
+        self.assertEqual(check.exit_code, 1)
+        self.assertIn('category 1 difficulty 4', repair.output)
+        self.assertEqual(again.exit_code, 0)
+        self.assertIn('counts are correct', again.output)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":